@@ -2,8 +2,11 @@ import logging
 
 from django import forms
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth import get_user_model
-from django.db.models import Case, When
+from django.contrib.postgres.aggregates import ArrayAgg, StringAgg
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import Case, CharField, OuterRef, Subquery, TextField, When
 from django.urls import reverse
 from django.utils.html import format_html
 from django_admin_listfilter_dropdown.filters import RelatedDropdownFilter
@@ -18,7 +21,7 @@ from .models import (OtherAction, ProcedureType, Session, Surgery, VirusInjectio
 from data.models import Dataset
 from misc.admin import NoteInline
 from subjects.models import Subject
-from .water_control import WaterControl
+from .water_control import WaterControl, water_controls
 
 logger = logging.getLogger(__name__)
 
@@ -245,6 +248,17 @@ class WaterRestrictionForm(forms.ModelForm):
         fields = '__all__'
 
 
+class WaterRestrictionChangeList(ChangeList):
+    """Build the water controls of the subjects in batch, instead of once per row and column."""
+
+    def get_results(self, request):
+        super(WaterRestrictionChangeList, self).get_results(request)
+        wcs = water_controls(obj.subject_id for obj in self.result_list)
+        for obj in self.result_list:
+            if obj.subject:
+                obj.subject._water_control = wcs.get(obj.subject_id)
+
+
 class WaterRestrictionAdmin(BaseActionAdmin):
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == 'subject':
@@ -280,6 +294,9 @@ class WaterRestrictionAdmin(BaseActionAdmin):
                    ActiveFilter,
                    ]
 
+    def get_changelist(self, request, **kwargs):
+        return WaterRestrictionChangeList
+
     def subject_w(self, obj):
         url = reverse('water-history', kwargs={'subject_id': obj.subject.id})
         return format_html('<a href="{url}">{name}</a>', url=url, name=obj.subject.nickname)
@@ -460,23 +477,34 @@ class SessionAdmin(BaseActionAdmin):
     readonly_fields = ['task_protocol']
 
     def get_queryset(self, request):
-        return super(SessionAdmin, self).get_queryset(request).prefetch_related(
-            'subject__projects', 'users', 'data_dataset_session_related',
-            'data_dataset_session_related__dataset_type')
+        # The dataset types and projects are aggregated in SQL, so that the changelist does
+        # not load every dataset of every session on the page.
+        dataset_types = Dataset.objects.filter(session=OuterRef('pk')).order_by().values(
+            'session').annotate(
+            names=StringAgg('dataset_type__name', ', ', distinct=True)).values('names')
+        subject_projects = Subject.projects.through.objects.filter(
+            subject=OuterRef('subject')).order_by().values('subject').annotate(
+            names=ArrayAgg('project__name')).values('names')
+        return super(SessionAdmin, self).get_queryset(request).select_related(
+            'project').prefetch_related('users').annotate(
+            dataset_types_agg=Subquery(dataset_types, output_field=TextField()),
+            subject_projects_agg=Subquery(
+                subject_projects, output_field=ArrayField(CharField(max_length=255))),
+        )
 
     def user_list(self, obj):
         return ', '.join(map(str, obj.users.all()))
     user_list.short_description = 'users'
 
     def project_list(self, obj):
-        projects = tuple(p.name for p in obj.subject.projects.all())
+        projects = tuple(obj.subject_projects_agg or ())
         if obj.project:
             projects += (obj.project.name,)
         return sorted(set(projects))
     project_list.short_description = 'Lab servers'
 
     def dataset_types(self, obj):
-        return ', '.join(ds.dataset_type.name for ds in obj.data_dataset_session_related.all())
+        return obj.dataset_types_agg or ''
 
 
 class NotificationUserFilter(DefaultListFilter):
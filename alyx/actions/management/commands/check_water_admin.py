@@ -1,15 +1,21 @@
 from django.core.management import BaseCommand
 from actions.models import WaterRestriction
-from actions.notifications import check_water_administration
+from actions.notifications import check_water_administration, check_water_administrations
 
 
 class Command(BaseCommand):
     help = "Check all water administrations."
 
     def add_arguments(self, parser):
-        pass
+        parser.add_argument('--per-subject', action='store_true', default=False,
+                            help="Check the subjects one by one instead of in a single sweep")
 
     def handle(self, *args, **options):
+        if not options.get('per_subject'):
+            # Only the queued notifications are sent.
+            for notif in check_water_administrations():
+                notif.send_if_needed()
+            return
         wrs = WaterRestriction.objects.filter(
             start_time__isnull=False, end_time__isnull=True). \
             select_related('subject'). \
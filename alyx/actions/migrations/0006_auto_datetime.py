@@ -0,0 +1,78 @@
+# Generated by Django 2.1.4 on 2019-02-04 10:00
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_auto_datetime(apps, schema_editor):
+    """Set the auto_datetime of the existing objects, so that they appear in the changes feed."""
+    now = timezone.now()
+    for model in apps.get_app_config('actions').get_models():
+        if any(field.name == 'auto_datetime' for field in model._meta.local_fields):
+            model._base_manager.filter(auto_datetime__isnull=True).update(auto_datetime=now)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actions', '0005_auto_20190124_1025'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proceduretype',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='weighing',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='watertype',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='wateradministration',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='virusinjection',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='surgery',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='waterrestriction',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='otheraction',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='notificationrule',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.RunPython(backfill_auto_datetime, migrations.RunPython.noop),
+    ]
@@ -7,8 +7,8 @@ from django.core.validators import MinValueValidator
 from django.db import models
 from django.utils import timezone
 
-from alyx.base import BaseModel, modify_fields, alyx_mail
-from misc.models import Lab, LabLocation, LabMember
+from alyx.base import BaseModel, modify_fields, alyx_mail, bump_table_version
+from misc.models import Lab, LabLocation, LabMember, LabMembership
 
 
 logger = logging.getLogger(__name__)
@@ -107,6 +107,25 @@ class WaterAdministration(BaseModel):
                 self.water_type = WaterType.objects.get(pk=_default_water_type())
         return super(WaterAdministration, self).save(*args, **kwargs)
 
+    @staticmethod
+    def set_default_water_types(water_administrations):
+        """Same default water type as in save(), for unsaved instances, in two queries."""
+        missing = [wa for wa in water_administrations if not wa.water_type_id]
+        if not missing:
+            return
+        # Water type of the last water restriction of each subject (DISTINCT ON).
+        last_wrs = WaterRestriction.objects.filter(
+            subject__in={wa.subject_id for wa in missing}).order_by(
+            'subject', '-start_time').distinct('subject').values_list('subject', 'water_type')
+        last_wrs = dict(last_wrs)
+        default = None
+        for wa in missing:
+            if wa.subject_id in last_wrs:
+                wa.water_type_id = last_wrs[wa.subject_id]
+            else:
+                default = default or _default_water_type()
+                wa.water_type_id = default
+
     def expected(self):
         wc = self.subject.water_control
         return wc.expected_water(date=self.date_time.date())
@@ -319,7 +338,7 @@ def delay_since_last_notification(notification_type, title, subject):
     return inf
 
 
-def check_scope(user, subject, scope):
+def check_scope(user, subject, scope, user_labs=None):
     if subject is None:
         return True
     # Default scope: mine.
@@ -328,14 +347,34 @@ def check_scope(user, subject, scope):
     if scope == 'mine':
         return subject.responsible_user == user
     elif scope == 'lab':
-        return subject.lab.name in (user.lab or ())
+        labs = user.lab if user_labs is None else user_labs.get(user.pk, ())
+        return subject.lab.name in (labs or ())
     elif scope == 'all':
         return True
     elif scope == 'none':
         return False
 
 
-def get_recipients(notification_type, subject=None, users=None):
+def get_recipient_rules(notification_type):
+    """Return the (members, user_rules, user_labs) tuple used by get_recipients(), to be loaded
+    once when computing the recipients of many notifications."""
+    members = list(LabMember.objects.all())
+    rules = NotificationRule.objects.filter(
+        notification_type=notification_type).select_related('user')
+    # Dictionary giving the scope of every user in the database.
+    user_rules = {user: None for user in members}
+    user_rules.update({rule.user: rule.subjects_scope for rule in rules})
+    # Current labs of every user.
+    today = timezone.now().date()
+    user_labs = {}
+    for user_id, lab_name in LabMembership.objects.filter(
+            start_date__lte=today).exclude(end_date__lt=today).values_list(
+            'user', 'lab__name').distinct():
+        user_labs.setdefault(user_id, []).append(lab_name)
+    return members, user_rules, user_labs
+
+
+def get_recipients(notification_type, subject=None, users=None, rules=None):
     """Return the list of users that will receive a notification."""
     # Default: initial list of recipients is the subject's responsible user.
     if users is None and subject and subject.responsible_user:
@@ -344,16 +383,21 @@ def get_recipients(notification_type, subject=None, users=None):
         users = []
     if not subject:
         return users
-    members = LabMember.objects.all()
-    rules = NotificationRule.objects.filter(notification_type=notification_type)
-    # Dictionary giving the scope of every user in the database.
-    user_rules = {user: None for user in members}
-    user_rules.update({rule.user: rule.subjects_scope for rule in rules})
+    if rules is None:
+        members = LabMember.objects.all()
+        rules = NotificationRule.objects.filter(notification_type=notification_type)
+        # Dictionary giving the scope of every user in the database.
+        user_rules = {user: None for user in members}
+        user_rules.update({rule.user: rule.subjects_scope for rule in rules})
+        user_labs = None
+    else:
+        members, user_rules, user_labs = rules
     # Remove 'none' users from the specified users.
     users = [user for user in users if user_rules.get(user, None) != 'none']
     # Return the selected users, and those who opted in in the notification rules.
     return users + [member for member in members
-                    if check_scope(member, subject, user_rules.get(member, None)) and
+                    if check_scope(member, subject, user_rules.get(member, None),
+                                   user_labs=user_labs) and
                     member not in users]
 
 
@@ -380,6 +424,57 @@ def create_notification(notification_type, message, subject=None, users=None, fo
     return notif
 
 
+def create_notifications(notification_type, items, force=None):
+    """Queue notifications of the same type for a list of (message, subject) pairs, with a
+    constant number of queries.
+
+    The notifications sent less than NOTIFICATION_MIN_DELAYS ago are skipped as in
+    create_notification(), but no email is sent here: the notifications are left 'to-send'
+    for send_pending_emails(). Return the list of created notifications.
+
+    """
+    now = timezone.now()
+    if not force:
+        # Date of the last notification of every (title, subject) pair, in a single query.
+        last = {}
+        for title, subject_id, send_at, sent_at in Notification.objects.filter(
+                notification_type=notification_type,
+                title__in={message for message, _ in items},
+        ).exclude(status='no-send').order_by('send_at').values_list(
+                'title', 'subject', 'send_at', 'sent_at'):
+            last[title, subject_id] = sent_at or send_at
+        max_delay = NOTIFICATION_MIN_DELAYS.get(notification_type, 0)
+        kept = []
+        for message, subject in items:
+            date = last.get((message, subject.pk if subject else None), None)
+            if date and (now - date).total_seconds() < max_delay:
+                logger.warning("This notification was sent %d s ago (< %d s), skipping.",
+                               (now - date).total_seconds(), max_delay)
+                continue
+            kept.append((message, subject))
+        items = kept
+    if not items:
+        return []
+    rules = get_recipient_rules(notification_type)
+    notifs, recipients = [], []
+    for message, subject in items:
+        notif = Notification(
+            notification_type=notification_type, title=message, message=message,
+            subject=subject, send_at=now)
+        notifs.append(notif)
+        recipients.append(get_recipients(notification_type, subject=subject, rules=rules))
+    through = Notification.users.through
+    Notification.objects.bulk_create(notifs)
+    through.objects.bulk_create([
+        through(notification_id=notif.pk, labmember_id=user.pk)
+        for notif, users in zip(notifs, recipients) for user in users])
+    # The bulk operations send no signal.
+    bump_table_version(Notification)
+    bump_table_version(through)
+    logger.debug("Queued %d notifications '%s'.", len(notifs), notification_type)
+    return notifs
+
+
 def send_pending_emails():
     """Send all pending notifications."""
     notifications = Notification.objects.filter(status='to-send', send_at__lte=timezone.now())
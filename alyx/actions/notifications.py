@@ -1,8 +1,11 @@
 import logging
 
+import numpy as np
 from django.utils import timezone
 
-from actions.models import create_notification
+from actions.models import (
+    create_notification, create_notifications, WaterAdministration, WaterRestriction)
+from actions.water_control import prefetch_water_control
 
 
 logger = logging.getLogger(__name__)
@@ -43,3 +46,55 @@ def check_water_administration(subject, date=None):
     if remaining > 0 and delay.total_seconds() > 23 * 3600:
         msg = "%.1f mL remaining for %s" % (remaining, subject)
         create_notification('mouse_water', msg, subject)
+
+
+def check_water_administrations(date=None):
+    """Check the water administrations of all subjects under water restriction at once, and
+    queue a notification for those that need water.
+
+    This is the sweep equivalent of calling check_water_administration() on every subject:
+    the water administrations are loaded in a single query, the delay since the last water
+    administration and the water given on the day are computed with array operations, and the
+    water controls are only built, in bulk, for the subjects not given water for 23h.
+
+    """
+    from subjects.models import Subject
+    date = date or timezone.now()
+    subject_ids = list(WaterRestriction.objects.filter(
+        start_time__isnull=False, end_time__isnull=True,
+    ).order_by('subject__nickname').values_list('subject', flat=True).distinct())
+    if not subject_ids:
+        return []
+    index = {pk: i for i, pk in enumerate(subject_ids)}
+    n = len(subject_ids)
+
+    was = list(WaterAdministration.objects.filter(
+        subject__in=subject_ids, date_time__date__lte=date.date(),
+    ).values_list('subject', 'date_time', 'water_administered'))
+    last = np.full(n, -np.inf)
+    given = np.zeros(n)
+    if was:
+        idx = np.array([index[s] for s, _, _ in was])
+        times = np.array([d.timestamp() for _, d, _ in was])
+        volumes = np.array([w or 0. for _, _, w in was])
+        today = np.array([d.date() == date.date() for _, d, _ in was])
+        # Time of the last water administration, and water given on the day, per subject.
+        np.maximum.at(last, idx, times)
+        given = np.bincount(idx[today], weights=volumes[today], minlength=n)
+    # Subjects without any water administration are skipped, as in
+    # check_water_administration().
+    delay = date.timestamp() - last
+    candidates = np.nonzero(np.isfinite(last) & (delay > 23 * 3600))[0]
+    if not len(candidates):
+        return []
+
+    subjects = prefetch_water_control(Subject.objects.filter(
+        pk__in=[subject_ids[i] for i in candidates]).select_related('responsible_user'))
+    subjects = sorted(subjects, key=lambda s: index[s.pk])
+    items = []
+    for subject in subjects:
+        remaining = subject.water_control.expected_water(date=date) - given[index[subject.pk]]
+        if remaining > 0:
+            msg = "%.1f mL remaining for %s" % (remaining, subject)
+            items.append((msg, subject))
+    return create_notifications('mouse_water', items)
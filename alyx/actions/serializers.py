@@ -1,9 +1,14 @@
+import json
+
 from rest_framework import serializers
 from django.contrib.admin.models import LogEntry, ADDITION
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 
+from alyx.base import bump_table_version
 from .models import (ProcedureType, Session, WaterAdministration, Weighing, WaterType)
+from .notifications import check_weighing
 from subjects.models import Subject, Project
 from data.models import Dataset, DatasetType
 from misc.models import LabLocation, Lab
@@ -27,6 +32,70 @@ def _log_entry(instance, user):
     return instance
 
 
+def _log_entries(instances, user):
+    """Bulk version of _log_entry() for instances of the same model."""
+    if not instances:
+        return instances
+    content_type_id = ContentType.objects.get_for_model(instances[0]).pk
+    change_message = json.dumps([{'added': {}}])
+    LogEntry.objects.bulk_create([
+        LogEntry(user_id=user.pk,
+                 content_type_id=content_type_id,
+                 object_id=str(instance.pk),
+                 object_repr=str(instance)[:200],
+                 action_flag=ADDITION,
+                 change_message=change_message,
+                 ) for instance in instances if instance.pk])
+    return instances
+
+
+class BulkSlugRelatedField(serializers.SlugRelatedField):
+    """Slug field whose values can be resolved beforehand by BulkCreateListSerializer."""
+    resolved = None
+
+    def to_internal_value(self, data):
+        if self.resolved is not None and str(data) in self.resolved:
+            return self.resolved[str(data)]
+        return super(BulkSlugRelatedField, self).to_internal_value(data)
+
+
+class BulkCreateListSerializer(serializers.ListSerializer):
+    """
+    Create a list of objects with one query per related field, one bulk insert and one bulk
+    insert of log entries. The child serializer may define `prepare_bulk(instances)`, called
+    before the insert, and `after_bulk(instances)`, called after it.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            for field in self.child.fields.values():
+                if not isinstance(field, BulkSlugRelatedField) or field.read_only:
+                    continue
+                slugs = {row.get(field.field_name) for row in data if isinstance(row, dict)}
+                slugs = [str(slug) for slug in slugs if slug not in (None, '')]
+                objects = field.get_queryset().filter(**{'%s__in' % field.slug_field: slugs})
+                try:
+                    field.resolved = {str(getattr(obj, field.slug_field)): obj
+                                      for obj in objects}
+                except (TypeError, ValueError, ValidationError):
+                    # Malformed values: let the rows be validated one by one.
+                    field.resolved = None
+        return super(BulkCreateListSerializer, self).to_internal_value(data)
+
+    def create(self, validated_data):
+        model = self.child.Meta.model
+        instances = [model(**attrs) for attrs in validated_data]
+        if hasattr(self.child, 'prepare_bulk'):
+            self.child.prepare_bulk(instances)
+        instances = model.objects.bulk_create(instances)
+        # bulk_create() sends no post_save signal.
+        bump_table_version(model)
+        _log_entries(instances, self.context['request'].user)
+        if hasattr(self.child, 'after_bulk'):
+            self.child.after_bulk(instances)
+        return instances
+
+
 class BaseActionSerializer(serializers.HyperlinkedModelSerializer):
     subject = serializers.SlugRelatedField(
         read_only=False,
@@ -147,13 +216,13 @@ class SessionDetailSerializer(BaseActionSerializer):
 
 class WeighingDetailSerializer(serializers.HyperlinkedModelSerializer):
 
-    subject = serializers.SlugRelatedField(
+    subject = BulkSlugRelatedField(
         read_only=False,
         slug_field='nickname',
         queryset=Subject.objects.all()
     )
 
-    user = serializers.SlugRelatedField(
+    user = BulkSlugRelatedField(
         read_only=False,
         slug_field='username',
         queryset=get_user_model().objects.all(),
@@ -167,6 +236,12 @@ class WeighingDetailSerializer(serializers.HyperlinkedModelSerializer):
         _log_entry(instance, user)
         return instance
 
+    @staticmethod
+    def after_bulk(instances):
+        # Weighing.save() checks the weight after each weighing: here once per subject.
+        for subject in {w.subject_id: w.subject for w in instances}.values():
+            check_weighing(subject)
+
     @staticmethod
     def setup_eager_loading(queryset):
         return queryset.select_related('subject', 'user')
@@ -175,6 +250,7 @@ class WeighingDetailSerializer(serializers.HyperlinkedModelSerializer):
         model = Weighing
         fields = ('subject', 'date_time', 'weight',
                   'user', 'url')
+        list_serializer_class = BulkCreateListSerializer
 
 
 class WaterTypeDetailSerializer(serializers.HyperlinkedModelSerializer):
@@ -186,13 +262,13 @@ class WaterTypeDetailSerializer(serializers.HyperlinkedModelSerializer):
 
 class WaterAdministrationDetailSerializer(serializers.HyperlinkedModelSerializer):
 
-    subject = serializers.SlugRelatedField(
+    subject = BulkSlugRelatedField(
         read_only=False,
         slug_field='nickname',
         queryset=Subject.objects.all()
     )
 
-    user = serializers.SlugRelatedField(
+    user = BulkSlugRelatedField(
         read_only=False,
         slug_field='username',
         queryset=get_user_model().objects.all(),
@@ -200,14 +276,14 @@ class WaterAdministrationDetailSerializer(serializers.HyperlinkedModelSerializer
         default=serializers.CurrentUserDefault(),
     )
 
-    water_type = serializers.SlugRelatedField(
+    water_type = BulkSlugRelatedField(
         read_only=False,
         slug_field='name',
         queryset=WaterType.objects.all(),
         required=False,
     )
 
-    session = serializers.SlugRelatedField(
+    session = BulkSlugRelatedField(
         read_only=False,
         required=False,
         slug_field='id',
@@ -224,8 +300,13 @@ class WaterAdministrationDetailSerializer(serializers.HyperlinkedModelSerializer
         _log_entry(instance, user)
         return instance
 
+    @staticmethod
+    def prepare_bulk(instances):
+        WaterAdministration.set_default_water_types(instances)
+
     class Meta:
         model = WaterAdministration
         fields = ('subject', 'date_time', 'water_administered', 'water_type', 'user', 'url',
                   'session', 'adlib')
         extra_kwargs = {'url': {'view_name': 'water-administration-detail'}}
+        list_serializer_class = BulkCreateListSerializer
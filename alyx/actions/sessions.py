@@ -0,0 +1,205 @@
+from collections import OrderedDict
+from datetime import datetime, time
+import logging
+
+from dateutil.parser import parse
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+
+from alyx.base import bump_table_version
+from misc.models import Lab, LabLocation
+from subjects.models import Project, Subject
+from .models import Session
+
+
+logger = logging.getLogger(__name__)
+
+# Fields that can be set or updated by upsert_sessions().
+SESSION_UPSERT_FIELDS = ('start_time', 'end_time', 'type', 'task_protocol', 'narrative',
+                         'n_trials', 'n_correct_trials', 'json')
+# Related fields given by name, with the model and the slug field.
+SESSION_UPSERT_SLUGS = {
+    'lab': (Lab, 'name'),
+    'project': (Project, 'name'),
+    'location': (LabLocation, 'name'),
+}
+
+
+def _parse_datetime(value):
+    if not value or isinstance(value, datetime):
+        return value
+    return parse(value)
+
+
+def _parse_date(value):
+    if not value or not isinstance(value, str):
+        return value
+    return parse(value).date()
+
+
+def _resolve(queryset, slug_field, values):
+    """Return a dictionary {slug: object}, in one query."""
+    values = {value for value in values if value}
+    if not values:
+        return {}
+    objects = {getattr(obj, slug_field): obj
+               for obj in queryset.filter(**{'%s__in' % slug_field: values})}
+    missing = values - set(objects)
+    if missing:
+        raise ValueError("%s %s do(es) not exist." % (
+            queryset.model._meta.verbose_name.capitalize(),
+            ', '.join(sorted(map(str, missing)))))
+    return objects
+
+
+def _parse_key(item):
+    """Return the (subject nickname, date, number) key and the start time of an item."""
+    if not isinstance(item, dict):
+        raise ValueError("a session must be an object.")
+    start_time = _parse_datetime(item.get('start_time', None))
+    date = _parse_date(item.get('date', None)) or (start_time.date() if start_time else None)
+    nickname = item.get('subject', None)
+    if not nickname or not date:
+        raise ValueError("a session requires a subject and a date or a start_time.")
+    number = item.get('number', None)
+    number = int(number) if number not in (None, '') else None
+    return (nickname, date, number), start_time
+
+
+def _parse_items(items, user=None):
+    """Merge the items into one row per (subject nickname, date, number) key."""
+    rows = OrderedDict()
+    for i, item in enumerate(items):
+        try:
+            key, start_time = _parse_key(item)
+            end_time = _parse_datetime(item.get('end_time', None))
+        except (TypeError, ValueError, OverflowError) as e:
+            raise ValueError("Invalid session #%d %s: %s" % (i, item, e))
+        row = rows.setdefault(key, {'users': set(), 'fields': {}})
+        users = item.get('users', None) or ([user.username] if user else [])
+        row['users'].update([users] if isinstance(users, str) else users)
+        for field in SESSION_UPSERT_FIELDS + tuple(SESSION_UPSERT_SLUGS):
+            if field in item:
+                row['fields'][field] = item[field]
+        if start_time:
+            row['fields']['start_time'] = start_time
+        if end_time:
+            row['fields']['end_time'] = end_time
+    return rows
+
+
+def upsert_sessions(items, user=None):
+    """Create or update sessions keyed on (subject, date, number), with a bounded number of
+    queries whatever the number of items.
+
+    Each item is a dictionary with the subject nickname, the date (or the start_time), the
+    optional session number, the usernames of the users and any of the SESSION_UPSERT_FIELDS
+    and SESSION_UPSERT_SLUGS fields. As in data.models._get_session(), a session with a number
+    is attached to the base session of its subject and date, which is created if needed, and
+    the users are added to both. An item without number refers to the base session itself.
+
+    Return a list of (session, created) pairs, in the order of the keys.
+
+    """
+    rows = _parse_items(items, user=user)
+    if not rows:
+        return []
+
+    subjects = _resolve(Subject.objects.prefetch_related('projects'), 'nickname',
+                        [nickname for nickname, _, _ in rows])
+    users = _resolve(get_user_model().objects, 'username',
+                     [username for row in rows.values() for username in row['users']])
+    slugs = {field: _resolve(model.objects, slug_field,
+                             [row['fields'].get(field, None) for row in rows.values()])
+             for field, (model, slug_field) in SESSION_UPSERT_SLUGS.items()}
+
+    # All the existing sessions on these subjects and dates, in a single query.
+    existing = Session.objects.filter(
+        subject__in=subjects.values(),
+        start_time__date__in={date for _, date, _ in rows},
+    ).order_by('start_time')
+    bases, sessions = {}, {}
+    for session in existing:
+        key = (session.subject_id, session.start_time.date())
+        if session.parent_session_id is None:
+            bases.setdefault(key, session)
+        sessions.setdefault(key + (session.number,), session)
+
+    now = timezone.now()
+    created, updated, out = OrderedDict(), OrderedDict(), []
+    members = {}  # session => set of user ids
+
+    def _new_session(subject, **kwargs):
+        projects = list(subject.projects.all())
+        session = Session(subject=subject, lab_id=subject.lab_id,
+                          project=projects[0] if projects else None, **kwargs)
+        created[session.pk] = session
+        return session
+
+    for (nickname, date, number), row in rows.items():
+        subject = subjects[nickname]
+        key = (subject.pk, date)
+        # Get or create the base session.
+        base = bases.get(key, None)
+        if base is None:
+            start_time = row['fields'].get('start_time', None) or datetime.combine(date, time())
+            base = _new_session(subject, type='Base', start_time=start_time)
+            bases[key] = base
+        # Get or create the session.
+        if number is None:
+            session = base
+        else:
+            session = sessions.get(key + (number,), None)
+            if session is None:
+                session = _new_session(subject, number=number, parent_session=base,
+                                       start_time=base.start_time)
+                sessions[key + (number,)] = session
+            elif session.parent_session_id is None and session != base:
+                session.parent_session = base
+                updated[session.pk] = session
+        # Update the fields.
+        for field, value in row['fields'].items():
+            if field in SESSION_UPSERT_SLUGS:
+                value = slugs[field].get(value, None)
+            if getattr(session, field) != value:
+                setattr(session, field, value)
+                if session.pk not in created:
+                    updated[session.pk] = session
+        user_ids = {users[username].pk for username in row['users']}
+        members.setdefault(base, set()).update(user_ids)
+        members.setdefault(session, set()).update(user_ids)
+        out.append((session, session.pk in created))
+
+    users_field = Session._meta.get_field('users')
+    through = users_field.remote_field.through
+    session_col = users_field.m2m_field_name() + '_id'
+    user_col = users_field.m2m_reverse_field_name() + '_id'
+    with transaction.atomic():
+        Session.objects.bulk_create(list(created.values()))
+        # Missing user memberships, checked in one query.
+        current = {}
+        for session_id, user_id in through.objects.filter(
+                **{'%s__in' % session_col: [s.pk for s in members if s.pk not in created]}).\
+                values_list(session_col, user_col):
+            current.setdefault(session_id, set()).add(user_id)
+        new_members = []
+        for session, user_ids in members.items():
+            for user_id in user_ids - current.get(session.pk, set()):
+                new_members.append(through(**{session_col: session.pk, user_col: user_id}))
+                if session.pk not in created:
+                    updated[session.pk] = session
+        through.objects.bulk_create(new_members)
+        # bulk_update() does not renew the auto_now fields.
+        for session in updated.values():
+            session.auto_datetime = now
+        if updated:
+            fields = ('parent_session', 'auto_datetime') + SESSION_UPSERT_FIELDS + \
+                tuple(SESSION_UPSERT_SLUGS)
+            Session.objects.bulk_update(list(updated.values()), fields)
+    # The bulk operations send no signal.
+    bump_table_version(Session)
+    bump_table_version(through)
+    logger.info("Upserted %d sessions: %d created, %d updated.",
+                len(out), len(created), len(updated))
+    return out
@@ -1,14 +1,17 @@
 import datetime
 import numpy as np
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from alyx import base
 from actions.water_control import date
 from actions.models import (
-    WaterAdministration, WaterRestriction, WaterType, Weighing,
+    Session, WaterAdministration, WaterRestriction, WaterType, Weighing,
     Notification, NotificationRule, create_notification)
-from actions.notifications import check_water_administration
+from actions.notifications import check_water_administration, check_water_administrations
+from actions.training import training_matrix
 from misc.models import LabMember, LabMembership, Lab
 from subjects.models import Subject
 
@@ -163,6 +166,38 @@ class NotificationTests(TestCase):
         notif = Notification.objects.last()
         self.assertTrue(notif is not None)
 
+    def test_notif_water_sweep(self):
+        self.assertEqual(check_water_administrations(
+            date=timezone.datetime(2018, 6, 3, 16, 0, 0)), [])
+        when = timezone.datetime(2018, 6, 4, 12, 0, 0)
+        with CaptureQueriesContext(connection) as ctx:
+            notifs = check_water_administrations(date=when)
+        self.assertEqual(len(notifs), 1)
+        notif = Notification.objects.get(pk=notifs[0].pk)
+        self.assertEqual(notif.subject, self.subject)
+        self.assertEqual(notif.status, 'to-send')
+        self.assertEqual(list(notif.users.all()), [self.user1])
+        # A recent notification is not queued again.
+        self.assertEqual(check_water_administrations(date=when), [])
+        # The number of queries does not depend on the number of subjects.
+        Notification.objects.all().delete()
+        for i in range(3):
+            subject = Subject.objects.create(
+                nickname='test%d' % i, birth_date=date('2018-01-01'), lab=self.lab,
+                responsible_user=self.user2)
+            WaterRestriction.objects.create(
+                subject=subject, start_time=timezone.datetime(2018, 6, 2, 12, 0, 0),
+                reference_weight=10.)
+            Weighing.objects.create(
+                subject=subject, weight=10, date_time=timezone.datetime(2018, 6, 1, 12, 0, 0))
+            WaterAdministration.objects.create(
+                subject=subject, date_time=timezone.datetime(2018, 6, 3, 12, 0, 0),
+                water_administered=1)
+        with CaptureQueriesContext(connection) as ctx_more:
+            notifs = check_water_administrations(date=when)
+        self.assertEqual(len(notifs), 4)
+        self.assertEqual(len(ctx_more.captured_queries), len(ctx.captured_queries))
+
     def test_notif_user_change_1(self):
         self.subject.responsible_user = self.user2
         self.subject.save()
@@ -218,3 +253,44 @@ class NotificationTests(TestCase):
         nr.subjects_scope = 'none'
         nr.save()
         _assert_users([self.user2], [self.user2])
+
+
+class TrainingTests(TestCase):
+    def setUp(self):
+        self.user = LabMember.objects.create(username='trainer')
+        self.monday = date('2018-06-04')
+        self.subjects = []
+        for i in range(3):
+            subject = Subject.objects.create(
+                nickname='trained%d' % i, birth_date=date('2018-01-01'),
+                responsible_user=self.user)
+            WaterRestriction.objects.create(
+                subject=subject, start_time=timezone.datetime(2018, 6, 1, 12, 0, 0))
+            self.subjects.append(subject)
+        # Not under water restriction.
+        Subject.objects.create(nickname='free', birth_date=date('2018-01-01'))
+        # trained0: five days, two sessions on Monday; trained1: Tuesday only, plus a session
+        # outside the week; trained2: no session.
+        for day, hour in [(0, 9), (0, 15), (1, 9), (2, 9), (3, 9), (4, 9)]:
+            Session.objects.create(
+                subject=self.subjects[0],
+                start_time=timezone.datetime(2018, 6, 4 + day, hour, 0, 0))
+        Session.objects.create(
+            subject=self.subjects[1], start_time=timezone.datetime(2018, 6, 5, 9, 0, 0))
+        Session.objects.create(
+            subject=self.subjects[1], start_time=timezone.datetime(2018, 6, 11, 9, 0, 0))
+
+    def test_training_matrix(self):
+        with self.assertNumQueries(1):
+            matrix = training_matrix(self.monday)
+        self.assertEqual([m['nickname'] for m in matrix], ['trained0', 'trained1', 'trained2'])
+        self.assertEqual([m['username'] for m in matrix], ['trainer'] * 3)
+        self.assertEqual([m['n_training_days'] for m in matrix], [5, 1, 0])
+        self.assertEqual([m['training_ok'] for m in matrix], [True, False, False])
+        self.assertEqual(matrix[0]['training_days'], [True] * 5 + [False] * 2)
+        self.assertEqual(matrix[1]['training_days'], [False, True] + [False] * 5)
+        self.assertEqual(matrix[1]['dates'], [date('2018-06-05')])
+        # The next week costs one more query.
+        with self.assertNumQueries(1):
+            matrix = training_matrix(date('2018-06-11'))
+        self.assertEqual([m['n_training_days'] for m in matrix], [0, 1, 0])
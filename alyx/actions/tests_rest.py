@@ -8,7 +8,7 @@ from alyx import base
 from alyx.base import BaseTests
 from subjects.models import Subject, Project
 from misc.models import Lab
-from actions.models import Session, WaterType, WaterAdministration
+from actions.models import Session, WaterType, WaterAdministration, Weighing
 
 
 class APIActionsTests(BaseTests):
@@ -54,6 +54,33 @@ class APIActionsTests(BaseTests):
         self.assertEqual(d['water_type'], water_type)
         self.assertEqual(d['session'], ses_uuid)
 
+    def test_create_weighings_bulk(self):
+        url = reverse('weighing-create')
+        n = Weighing.objects.filter(subject=self.subject).count()
+        data = [{'subject': self.subject.nickname, 'weight': 12.3 + i,
+                 'date_time': '2018-06-0%dT09:00:00' % (i + 1)} for i in range(3)]
+        response = self.client.post(url, data, format='json')
+        self.ar(response, 201)
+        self.assertEqual([d['weight'] for d in response.data], [12.3, 13.3, 14.3])
+        self.assertEqual(Weighing.objects.filter(subject=self.subject).count(), n + 3)
+        # Invalid row: nothing is created.
+        data[0]['subject'] = 'unknown-subject'
+        response = self.client.post(url, data, format='json')
+        self.ar(response, 400)
+        self.assertEqual(Weighing.objects.filter(subject=self.subject).count(), n + 3)
+
+    def test_create_water_administrations_bulk(self):
+        url = reverse('water-administration-create')
+        water_type = WaterType.objects.last().name
+        data = [{'subject': self.subject.nickname, 'water_administered': 1.23,
+                 'water_type': water_type},
+                {'subject': self.subject.nickname, 'water_administered': 0.5}]
+        response = self.client.post(url, data, format='json')
+        self.ar(response, 201)
+        self.assertEqual(response.data[0]['water_type'], water_type)
+        # The water type is set by default when not specified.
+        self.assertTrue(response.data[1]['water_type'] is not None)
+
     def test_list_water_administration_1(self):
         url = reverse('water-administration-create')
         response = self.client.get(url)
@@ -184,3 +211,68 @@ class APIActionsTests(BaseTests):
         r = self.client.get(reverse('session-list') + '?date_range=2018-07-09,2018-07-09')
         self.ar(r)
         self.assertEqual(r.data[0]['wateradmin_session_related'][0]['water_administered'], 1)
+
+    def test_session_detail_conditional(self):
+        ses = Session.objects.create(subject=self.subject, number=1, lab=self.lab01,
+                                     start_time='2018-07-09T12:34:56')
+        url = reverse('session-detail', kwargs={'pk': ses.pk})
+        r = self.client.get(url)
+        self.ar(r)
+        etag = r['ETag']
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+        # A related water administration changes the version token.
+        WaterAdministration.objects.create(subject=self.subject, session=ses, water_administered=1)
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.ar(r)
+        self.assertNotEqual(r['ETag'], etag)
+        self.assertEqual(r.data['wateradmin_session_related'][0]['water_administered'], 1)
+
+    def test_subject_history(self):
+        ses = Session.objects.create(subject=self.subject, number=3, lab=self.lab01,
+                                     start_time='2030-01-02T12:00:00', n_trials=42)
+        Weighing.objects.create(subject=self.subject, weight=21.5,
+                                date_time='2030-01-03T12:00:00')
+        url = reverse('subject-history', kwargs={'subject_id': self.subject.id})
+        r = self.client.get(url)
+        self.ar(r)
+        # Most recent first, with the few needed fields.
+        weighing, session = r.context['object_list'][:2]
+        self.assertEqual(weighing['name'], 'Weighing')
+        self.assertEqual(weighing['arg0'], 'weight: 21.5')
+        self.assertEqual(session['name'], 'Session')
+        self.assertEqual(session['url'],
+                         reverse('admin:actions_session_change', args=[ses.id]))
+        self.assertEqual(session['arg0'], 'number: 3')
+        self.assertEqual(session['arg1'], 'n_trials: 42')
+
+    def test_sessions_upsert(self):
+        url = reverse('session-upsert')
+        data = [{'subject': self.subject.nickname, 'date': '2018-08-01', 'number': n,
+                 'task_protocol': self.test_protocol, 'users': ['test', 'test2']}
+                for n in (1, 2)]
+        r = self.client.post(url, data, format='json')
+        self.ar(r)
+        self.assertEqual([d['created'] for d in r.data], [True, True])
+        sessions = Session.objects.filter(subject=self.subject, start_time__date='2018-08-01')
+        # Two sessions and their base session.
+        self.assertEqual(sessions.count(), 3)
+        base = sessions.get(parent_session__isnull=True)
+        self.assertEqual(set(base.users.values_list('username', flat=True)), {'test', 'test2'})
+        # Upserting again updates the existing sessions.
+        data[1]['n_trials'] = 10
+        r = self.client.post(url, data, format='json')
+        self.ar(r)
+        self.assertEqual([d['created'] for d in r.data], [False, False])
+        self.assertEqual(sessions.count(), 3)
+        self.assertEqual(sessions.get(number=2).n_trials, 10)
+        self.assertEqual(sessions.get(number=2).parent_session, base)
+        # Invalid items are rejected, nothing is upserted.
+        r = self.client.post(url, data + [{'subject': self.subject.nickname}], format='json')
+        self.assertEqual(r.status_code, 400)
+        self.assertTrue('#2' in r.data['detail'])
+        r = self.client.post(url, [{'subject': 'unknown', 'date': '2018-08-02'}],
+                             format='json')
+        self.assertEqual(r.status_code, 400)
+        self.assertTrue('unknown' in r.data['detail'])
+        self.assertEqual(sessions.count(), 3)
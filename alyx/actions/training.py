@@ -0,0 +1,58 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta, time
+
+from django.db.models import FilteredRelation, Q
+from django.db.models.functions import TruncDate
+
+from subjects.models import Subject
+from .models import WaterRestriction
+
+
+# Minimum number of training days in a week.
+MIN_TRAINING_DAYS = 5
+
+
+def training_matrix(start_date, n_days=7):
+    """Return the training matrix of all subjects currently under water restriction, for the
+    n_days days starting at start_date, in a single query.
+
+    The query returns one row per (subject, training date), with the subject nickname and the
+    responsible user's username. Subjects without any session in the window have a single row
+    with a null date.
+
+    Return a list of dictionaries, one per subject, ordered by responsible user and nickname,
+    with the subject's sorted training dates and a list of n_days booleans, one per day.
+
+    """
+    start = datetime.combine(start_date, time())
+    end = start + timedelta(days=n_days)
+    active = WaterRestriction.objects.filter(
+        start_time__isnull=False, end_time__isnull=True).values('subject')
+    rows = Subject.objects.filter(pk__in=active).annotate(
+        week_sessions=FilteredRelation(
+            'actions_sessions',
+            condition=Q(actions_sessions__start_time__gte=start,
+                        actions_sessions__start_time__lt=end)),
+    ).annotate(
+        session_date=TruncDate('week_sessions__start_time'),
+    ).values_list(
+        'pk', 'nickname', 'responsible_user__username', 'session_date',
+    ).distinct().order_by('responsible_user__username', 'nickname', 'session_date')
+
+    subjects = OrderedDict()
+    for pk, nickname, username, session_date in rows:
+        item = subjects.setdefault(pk, {
+            'id': pk,
+            'nickname': nickname,
+            'username': username,
+            'dates': [],
+        })
+        if session_date is not None:
+            item['dates'].append(session_date)
+    days = [start_date + timedelta(days=n) for n in range(n_days)]
+    for item in subjects.values():
+        dates = set(item['dates'])
+        item['n_training_days'] = len(dates)
+        item['training_ok'] = len(dates) >= MIN_TRAINING_DAYS
+        item['training_days'] = [day in dates for day in days]
+    return list(subjects.values())
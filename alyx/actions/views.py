@@ -1,9 +1,11 @@
+from collections import OrderedDict
 from datetime import timedelta, date
 import itertools
 from operator import itemgetter
 
-from django.db.models import Count, Q, F, ExpressionWrapper, FloatField
-from django.db.models.deletion import Collector
+from django.db import transaction
+from django.db.models import Count, Q, F, CharField, ExpressionWrapper, FloatField, Value
+from django.db.models.functions import Cast
 from django.http import HttpResponse
 from django.urls import reverse
 from django.utils.safestring import mark_safe
@@ -15,10 +17,13 @@ from rest_framework import generics, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from alyx.base import CachedListMixin, ConditionalDetailMixin
 from subjects.models import Subject
+from .sessions import upsert_sessions
+from .training import training_matrix
 from .water_control import water_control, date as get_date
 from .models import (
-    BaseAction, Session, WaterAdministration, WaterRestriction,
+    OtherAction, Session, Surgery, VirusInjection, WaterAdministration, WaterRestriction,
     Weighing, WaterType)
 from .serializers import (SessionListSerializer,
                           SessionDetailSerializer,
@@ -30,6 +35,17 @@ from .serializers import (SessionListSerializer,
 
 class SubjectHistoryListView(ListView):
     template_name = 'subject_history.html'
+    paginate_by = 100
+
+    # Models in the history, with their date field.
+    HISTORY_MODELS = (
+        (Session, 'start_time'),
+        (Surgery, 'start_time'),
+        (VirusInjection, 'start_time'),
+        (WaterRestriction, 'start_time'),
+        (OtherAction, 'start_time'),
+        (Weighing, 'date_time'),
+    )
 
     CLASS_FIELDS = {
         'Session': ('number', 'n_correct_trials', 'n_trials'),
@@ -39,7 +55,7 @@ class SubjectHistoryListView(ListView):
 
     CLASS_TYPE_FIELD = {
         'Session': 'type',
-        'WaterRestriction': 'water_type',
+        'WaterRestriction': 'water_type__name',
     }
 
     def get_context_data(self, **kwargs):
@@ -51,37 +67,49 @@ class SubjectHistoryListView(ListView):
                         args=[subject.id]),
                 subject.nickname))
         context['site_header'] = 'Alyx'
+        # Only the rows of the current page are formatted.
+        context['object_list'] = [self._make_item(row) for row in context['object_list']]
         return context
 
-    def get_queryset(self):
-        subject = Subject.objects.get(pk=self.kwargs['subject_id'])
-        collector = Collector(using="default")
-        collector.collect([subject])
-        out = []
-        for model, instance in collector.instances_with_model():
-            if model._meta.app_label == 'data':
-                continue
-            if not isinstance(instance, BaseAction):
+    def _history_queryset(self, model, date_field, subject_id):
+        # Same columns, in the same order, for all models, so that they can be UNIONed.
+        name = model.__name__
+        fields = self.CLASS_FIELDS.get(name, ())
+        type_field = self.CLASS_TYPE_FIELD.get(name, None)
+        annotations = OrderedDict([
+            ('h_name', Value(name, output_field=CharField())),
+            ('h_date_time', F(date_field)),
+            ('h_type', Cast(type_field, CharField()) if type_field else
+             Value(None, output_field=CharField())),
+        ])
+        for i in range(3):
+            annotations['h_arg%d' % i] = (Cast(fields[i], CharField()) if i < len(fields) else
+                                          Value(None, output_field=CharField()))
+        return model.objects.filter(subject_id=subject_id).order_by().annotate(
+            **annotations).values('id', *annotations)
+
+    def _make_item(self, row):
+        model = {model.__name__: model for model, _ in self.HISTORY_MODELS}[row['h_name']]
+        item = {
+            'url': reverse('admin:%s_%s_change' % (model._meta.app_label,
+                                                   model._meta.model_name), args=[row['id']]),
+            'name': row['h_name'],
+            'type': row['h_type'],
+            'date_time': row['h_date_time'],
+        }
+        i = 0
+        for j, n in enumerate(self.CLASS_FIELDS.get(row['h_name'], ())):
+            v = row['h_arg%d' % j]
+            if v is None:
                 continue
-            url = reverse('admin:%s_%s_change' % (instance._meta.app_label,
-                                                  instance._meta.model_name), args=[instance.id])
-            item = {}
-            clsname = instance.__class__.__name__
-            item['url'] = url
-            item['name'] = model.__name__
-            item['type'] = getattr(
-                instance, self.CLASS_TYPE_FIELD.get(clsname, ''), None)
-            item['date_time'] = instance.start_time
-            i = 0
-            for n in self.CLASS_FIELDS.get(clsname, ()):
-                v = getattr(instance, n, None)
-                if v is None:
-                    continue
-                item['arg%d' % i] = '%s: %s' % (n, v)
-                i += 1
-            out.append(item)
-        out = sorted(out, key=itemgetter('date_time'), reverse=True)
-        return out
+            item['arg%d' % i] = '%s: %s' % (n, v)
+            i += 1
+        return item
+
+    def get_queryset(self):
+        qs = [self._history_queryset(model, date_field, self.kwargs['subject_id'])
+              for model, date_field in self.HISTORY_MODELS]
+        return qs[0].union(*qs[1:], all=True).order_by('-h_date_time')
 
 
 def date_range(start_date, end_date):
@@ -119,23 +147,14 @@ def last_monday(reqdate=None):
 
 def training_days(reqdate=None):
     monday = last_monday(reqdate=reqdate)
-    wr = WaterRestriction.objects.filter(
-        start_time__isnull=False, end_time__isnull=True,
-    ).order_by('subject__responsible_user__username', 'subject__nickname')
-    next_monday = monday + timedelta(days=7)
-    for w in wr:
-        sessions = Session.objects.filter(
-            subject=w.subject, start_time__gte=monday, start_time__lt=next_monday)
-        dates = sorted(set([_[0] for _ in sessions.order_by('start_time').
-                            values_list('start_time')]))
-        wds = set(date.weekday() for date in dates)
+    for item in training_matrix(monday):
         yield {
-            'nickname': w.subject.nickname,
-            'username': w.subject.responsible_user.username,
-            'url': reverse('admin:subjects_subject_change', args=[w.subject.pk]),
-            'n_training_days': len(wds),
-            'training_ok': len(wds) >= 5,
-            'training_days': [wd in wds for wd in range(7)],
+            'nickname': item['nickname'],
+            'username': item['username'],
+            'url': reverse('admin:subjects_subject_change', args=[item['id']]),
+            'n_training_days': item['n_training_days'],
+            'training_ok': item['training_ok'],
+            'training_days': item['training_days'],
         }
 
 
@@ -266,7 +285,35 @@ class SessionAPIList(generics.ListCreateAPIView):
             return SessionDetailSerializer
 
 
-class SessionAPIDetail(generics.RetrieveUpdateDestroyAPIView):
+class SessionAPIUpsert(APIView):
+    """
+    Create or update many sessions at once, keyed on (subject, date, number). Post a JSON list
+    of objects with `subject`, `date` (or `start_time`), `number` and optionally `users`,
+    `start_time`, `end_time`, `type`, `task_protocol`, `narrative`, `n_trials`,
+    `n_correct_trials`, `json`, `lab`, `project`, `location`. The base sessions are created
+    if needed. An object without `number` refers to the base session of that day.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, format=None):
+        items = request.data if isinstance(request.data, list) else [request.data]
+        try:
+            out = upsert_sessions(items, user=request.user)
+        except ValueError as e:
+            # Unknown subject or user, or session without subject or date.
+            return Response({'detail': str(e)}, status=400)
+        data = [{'id': session.pk,
+                 'url': request.build_absolute_uri(
+                     reverse('session-detail', kwargs={'pk': session.pk})),
+                 'subject': session.subject.nickname,
+                 'date': session.start_time.date(),
+                 'number': session.number,
+                 'created': created,
+                 } for session, created in out]
+        return Response(data, status=200)
+
+
+class SessionAPIDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     Detail of one session
     """
@@ -274,11 +321,30 @@ class SessionAPIDetail(generics.RetrieveUpdateDestroyAPIView):
     queryset = SessionDetailSerializer.setup_eager_loading(queryset)
     serializer_class = SessionDetailSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    etag_related = ('data_dataset_session_related',
+                    'data_dataset_session_related__file_records',
+                    'wateradmin_session_related',
+                    )
+
+
+class BulkCreateMixin(object):
+    """
+    Accept a list of objects in a POST request, all created in a single transaction.
+    """
+
+    def get_serializer(self, *args, **kwargs):
+        if isinstance(kwargs.get('data', None), list):
+            kwargs['many'] = True
+        return super(BulkCreateMixin, self).get_serializer(*args, **kwargs)
+
+    def create(self, request, *args, **kwargs):
+        with transaction.atomic():
+            return super(BulkCreateMixin, self).create(request, *args, **kwargs)
 
 
-class WeighingAPIListCreate(generics.ListCreateAPIView):
+class WeighingAPIListCreate(BulkCreateMixin, generics.ListCreateAPIView):
     """
-    Lists or creates a new weighing.
+    Lists or creates a new weighing. Post a JSON list to create several weighings at once.
     """
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = WeighingDetailSerializer
@@ -287,7 +353,7 @@ class WeighingAPIListCreate(generics.ListCreateAPIView):
     filter_class = WeighingFilter
 
 
-class WeighingAPIDetail(generics.RetrieveDestroyAPIView):
+class WeighingAPIDetail(ConditionalDetailMixin, generics.RetrieveDestroyAPIView):
     """
     Allows viewing of full detail and deleting a weighing.
     """
@@ -296,16 +362,17 @@ class WeighingAPIDetail(generics.RetrieveDestroyAPIView):
     queryset = Weighing.objects.all()
 
 
-class WaterTypeList(generics.ListCreateAPIView):
+class WaterTypeList(CachedListMixin, generics.ListCreateAPIView):
     queryset = WaterType.objects.all()
     serializer_class = WaterTypeDetailSerializer
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = 'name'
 
 
-class WaterAdministrationAPIListCreate(generics.ListCreateAPIView):
+class WaterAdministrationAPIListCreate(BulkCreateMixin, generics.ListCreateAPIView):
     """
-    Lists or creates a new water administration.
+    Lists or creates a new water administration. Post a JSON list to create several water
+    administrations at once.
     """
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = WaterAdministrationDetailSerializer
@@ -314,7 +381,7 @@ class WaterAdministrationAPIListCreate(generics.ListCreateAPIView):
     filter_class = WaterAdministrationFilter
 
 
-class WaterAdministrationAPIDetail(generics.RetrieveUpdateDestroyAPIView):
+class WaterAdministrationAPIDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     Allows viewing of full detail and deleting a water administration.
     """
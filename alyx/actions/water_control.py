@@ -7,6 +7,7 @@ import logging
 from operator import itemgetter
 import os.path as op
 
+from django.db.models import Prefetch
 from django.urls import reverse
 from django.utils.html import format_html
 from django.http import HttpResponse
@@ -514,6 +515,31 @@ class WaterControl(object):
         return return_figure(f)
 
 
+def prefetch_water_control(queryset):
+    """Prefetch the data required by water_control() on a queryset of subjects, so that the
+    water control of all subjects is built with a constant number of queries."""
+    from actions import models as am
+    return queryset.select_related('lab').prefetch_related(
+        Prefetch('actions_waterrestrictions',
+                 queryset=am.WaterRestriction.objects.order_by('start_time'),
+                 to_attr='_prefetched_water_restrictions'),
+        Prefetch('water_administrations',
+                 queryset=am.WaterAdministration.objects.order_by('date_time'),
+                 to_attr='_prefetched_water_administrations'),
+        Prefetch('weighings',
+                 queryset=am.Weighing.objects.order_by('date_time'),
+                 to_attr='_prefetched_weighings'),
+    )
+
+
+def water_controls(subject_ids):
+    """Return a dictionary {subject_id: WaterControl} for the given subjects, built with a
+    constant number of queries."""
+    from subjects.models import Subject
+    subjects = prefetch_water_control(Subject.objects.filter(pk__in=set(subject_ids)))
+    return {subject.pk: subject.water_control for subject in subjects}
+
+
 def water_control(subject):
     from actions import models as am
     assert subject is not None
@@ -538,22 +564,27 @@ def water_control(subject):
     wc.add_threshold(percentage=rw_pct + zw_pct, bgcolor=PALETTE['orange'], fgcolor='#FFC28E')
     wc.add_threshold(percentage=.7, bgcolor=PALETTE['red'], fgcolor='#F08699', line_style='--')
     # Water restrictions.
-    wrs = am.WaterRestriction.objects.filter(subject=subject).order_by('start_time')
+    wrs = getattr(subject, '_prefetched_water_restrictions', None)
+    if wrs is None:
+        wrs = list(am.WaterRestriction.objects.filter(subject=subject).order_by('start_time'))
     # Reference weight.
-    last_wr = wrs.last()
+    last_wr = wrs[-1] if wrs else None
     if last_wr and last_wr.reference_weight:
         wc.set_reference_weight(last_wr.start_time, last_wr.reference_weight)
     for wr in wrs:
         wc.add_water_restriction(wr.start_time, wr.end_time)
 
     # Water administrations.
-    was = am.WaterAdministration.objects.filter(subject=subject)
-    was = was.select_related('water_type').order_by('date_time')
+    was = getattr(subject, '_prefetched_water_administrations', None)
+    if was is None:
+        was = am.WaterAdministration.objects.filter(subject=subject).order_by('date_time')
     for wa in was:
         wc.add_water_administration(wa.date_time, wa.water_administered, session=wa.session_id)
 
     # Weighings
-    ws = am.Weighing.objects.filter(subject=subject).order_by('date_time')
+    ws = getattr(subject, '_prefetched_weighings', None)
+    if ws is None:
+        ws = am.Weighing.objects.filter(subject=subject).order_by('date_time')
     for w in ws:
         wc.add_weighing(w.date_time, w.weight)
 
@@ -1,3 +1,5 @@
+from datetime import date
+import hashlib
 import json
 import logging
 import os
@@ -8,18 +10,25 @@ import uuid
 
 from django import forms
 from django.db import models
-from django.db import connection
+from django.db import connection, transaction
+from django.db.models import Count, Max
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.postgres.fields import JSONField
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.core.mail import send_mail
-from django.core.management import call_command
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.template.response import TemplateResponse
 from django.urls import reverse
-from django.utils import termcolors
+from django.utils import termcolors, timezone
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 
 from dateutil.parser import parse
 from reversion.admin import VersionAdmin
+from rest_framework import status
+from rest_framework.response import Response
 from rest_framework.test import APITestCase
 
 
@@ -67,6 +76,8 @@ class BaseModel(models.Model):
     name = models.CharField(max_length=255, blank=True, help_text="Long name")
     json = JSONField(null=True, blank=True,
                      help_text="Structured data, formatted in a user-defined way")
+    auto_datetime = models.DateTimeField(auto_now=True, blank=True, null=True, db_index=True,
+                                         verbose_name='last updated')
 
     class Meta:
         abstract = True
@@ -186,20 +197,22 @@ def flatten(l):
 
 
 def _show_change(date_time, old, new):
-    date_time = parse(date_time)
+    if isinstance(date_time, str):
+        date_time = parse(date_time)
     return '%s: %s ⇨ %s' % (
         date_time.strftime("%d/%m/%Y at %H:%M"), str(old), str(new))
 
 
 def _iter_history_changes(obj, field):
-    changes = obj.json.get('history', {}).get(field, [])
-    for d1, d2 in zip(changes, changes[1:]):
-        yield _show_change(d1['date_time'], d1['value'], d2['value'])
+    from misc.models import FieldHistory
+    changes = list(FieldHistory.for_object(obj, field).values_list('date_time', 'value'))
+    for (dt, old), (_, new) in zip(changes, changes[1:]):
+        yield _show_change(dt, old, new)
     # Last change to current value.
     if changes:
-        d = changes[-1]
+        dt, old = changes[-1]
         current = getattr(obj, field, None)
-        yield _show_change(d['date_time'], d['value'], current)
+        yield _show_change(dt, old, current)
 
 
 def _get_category_list(app_list):
@@ -304,11 +317,203 @@ class BaseInlineAdmin(admin.TabularInline):
     }
 
 
+# Cached REST endpoints
+# ------------------------------------------------------------------------------------------------
+
+# Tables listed by the endpoints cached with CachedListMixin: only their changes renew the
+# version tokens, the saves and deletions of the other tables do not touch the cache.
+CACHED_TABLES = {
+    'actions.watertype',
+    'data.dataformat',
+    'data.datarepository',
+    'data.datarepositorytype',
+    'data.datasettype',
+    'misc.lab',
+    'misc.labmembership',
+    'subjects.project',
+    'subjects.subject',
+    settings.AUTH_USER_MODEL.lower(),
+}
+
+
+def _table_version_key(model):
+    return 'alyx:table-version:%s' % model._meta.label_lower
+
+
+def get_table_versions(models):
+    """Return the current version token of each model's table, creating missing ones."""
+    keys = [_table_version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # add() so that concurrent requests agree on the same token.
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def _renew_table_version(key):
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+def bump_table_version(model):
+    """Renew the version token of a cached table after a write.
+
+    The token is renewed at once, so that the writing transaction does not read its own
+    cached responses, and again when the transaction commits: a concurrent request may have
+    cached the rows committed before under the first token.
+    """
+    if model._meta.label_lower not in CACHED_TABLES:
+        return
+    key = _table_version_key(model)
+    _renew_table_version(key)
+    transaction.on_commit(lambda: _renew_table_version(key))
+
+
+def etag_matches(request, etag):
+    """Return whether the If-None-Match header of a request matches an unquoted ETag."""
+    etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return '*' in etags or quote_etag(etag) in etags
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def _invalidate_table_on_change(sender, **kwargs):
+    bump_table_version(sender)
+
+
+@receiver(m2m_changed)
+def _invalidate_table_on_m2m_change(sender, instance, action, model, pk_set, **kwargs):
+    # Only once the relations have changed, not for the pre_* actions.
+    if not action.startswith('post_'):
+        return
+    for table in {sender, instance.__class__, model}:
+        bump_table_version(table)
+    # A many-to-many change modifies the objects on both sides: renew their auto_datetime.
+    now = timezone.now()
+    if isinstance(instance, BaseModel):
+        instance.__class__._base_manager.filter(pk=instance.pk).update(auto_datetime=now)
+    if issubclass(model, BaseModel) and pk_set:
+        model._base_manager.filter(pk__in=pk_set).update(auto_datetime=now)
+
+
+class CachedListMixin(object):
+    """Cache the serialized response of a list endpoint of read-mostly data.
+
+    The cache key and the ETag are derived from the version tokens of the tables listed in
+    `cache_models`, which must be in CACHED_TABLES and which are renewed by the
+    post_save/post_delete/m2m_changed signals. A client sending back the ETag in
+    `If-None-Match` gets a 304 without any database query.
+
+    The cache backend is the Django `default` cache (see CACHES in settings.py): use a shared
+    backend when running several worker processes so that invalidations reach all of them.
+    """
+    cache_models = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super(CachedListMixin, cls).__init_subclass__(**kwargs)
+        queryset = getattr(cls, 'queryset', None)
+        models = cls.cache_models or ((queryset.model,) if queryset is not None else ())
+        missing = [model._meta.label_lower for model in models
+                   if model._meta.label_lower not in CACHED_TABLES]
+        if missing:
+            raise ImproperlyConfigured(
+                "%s caches tables missing from CACHED_TABLES: %s." %
+                (cls.__name__, ', '.join(missing)))
+
+    def _get_cache_models(self):
+        return self.cache_models or (self.get_queryset().model,)
+
+    def _get_etag(self, request):
+        versions = get_table_versions(self._get_cache_models())
+        fingerprint = '|'.join([self.__class__.__name__,
+                                request.get_full_path(),
+                                request.accepted_renderer.format or ''] + versions)
+        return hashlib.md5(fingerprint.encode('utf-8')).hexdigest()
+
+    def list(self, request, *args, **kwargs):
+        etag = self._get_etag(request)
+        if etag_matches(request, etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            key = 'alyx:list:%s' % etag
+            data = cache.get(key)
+            if data is None:
+                response = super(CachedListMixin, self).list(request, *args, **kwargs)
+                cache.set(key, response.data)
+            else:
+                response = Response(data)
+        response['ETag'] = quote_etag(etag)
+        return response
+
+
+class ConditionalDetailMixin(object):
+    """Answer conditional GET requests on a detail endpoint from a cheap version token.
+
+    The token is made of the object's auto_datetime and, for each lookup in `etag_related`,
+    the number and the latest auto_datetime of the related objects. When the client already has
+    the current version, a 304 is returned without fetching nor serializing the object.
+    Set `etag_daily` when the representation also depends on the current date.
+    """
+    etag_related = ()
+    etag_daily = False
+
+    def get_version_token(self):
+        """Return the ETag and the last modification datetime, or (None, None) if not found."""
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.filter_queryset(self.get_queryset()).prefetch_related(None)
+        queryset = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        values = queryset.values_list('pk', 'auto_datetime').first()
+        if values is None:
+            return None, None
+        pk, last_modified = values
+        parts = [self.request.accepted_renderer.format or '', str(pk), str(last_modified)]
+        for related in self.etag_related:
+            agg = queryset.model._base_manager.filter(pk=pk).aggregate(
+                count=Count(related, distinct=True), last=Max(related + '__auto_datetime'))
+            parts += [str(agg['count']), str(agg['last'])]
+            if agg['last'] and (not last_modified or agg['last'] > last_modified):
+                last_modified = agg['last']
+        if self.etag_daily:
+            parts.append(str(date.today()))
+            last_modified = None
+        return hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest(), last_modified
+
+    def _not_modified(self, request, etag, last_modified):
+        if 'HTTP_IF_NONE_MATCH' in request.META:
+            return etag_matches(request, etag)
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return bool(last_modified and if_modified_since and
+                    int(last_modified.timestamp()) <= if_modified_since)
+
+    def retrieve(self, request, *args, **kwargs):
+        etag, last_modified = self.get_version_token()
+        if etag is None:
+            # Let the parent raise the 404.
+            return super(ConditionalDetailMixin, self).retrieve(request, *args, **kwargs)
+        if self._not_modified(request, etag, last_modified):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = super(ConditionalDetailMixin, self).retrieve(request, *args, **kwargs)
+        response['ETag'] = quote_etag(etag)
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
+
+
 class BaseTests(APITestCase):
     @classmethod
     def setUpTestData(cls):
         globals()['DISABLE_MAIL'] = True
-        call_command('loaddata', op.join(DATA_DIR, 'all_dumped_anon.json.gz'), verbosity=1)
+        # Imported here as the misc models depend on this module.
+        from misc.backups import load_archive
+        load_archive(op.join(DATA_DIR, 'all_dumped_anon.json.gz'))
+
+    def _pre_setup(self):
+        # Test transactions are rolled back without firing any signal: the cached responses
+        # must not leak from one test to the next.
+        super(BaseTests, self)._pre_setup()
+        cache.clear()
 
     def ar(self, r, code=200):
         self.assertTrue(r.status_code == code, r.data)
@@ -185,6 +185,17 @@ REST_FRAMEWORK = {
     #'PAGE_SIZE': 100
 }
 
+# Cache of the read-mostly REST endpoints (see alyx.base.CachedListMixin). The local memory
+# backend is per process: use a shared backend (memcached, database...) in settings_secret.py
+# when running several workers so that invalidations reach all of them.
+if 'CACHES' not in globals():
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'TIMEOUT': 300,
+        }
+    }
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -202,3 +213,6 @@ STATIC_URL = '/static/'
 MEDIA_ROOT = os.path.realpath(os.path.join(BASE_DIR, '../uploaded/'))
 MEDIA_URL = '/uploaded/'
 UPLOADED_IMAGE_WIDTH = 800
+
+# State kept by the management commands across runs, such as checkpoints.
+STATE_ROOT = os.path.realpath(os.path.join(BASE_DIR, '../state/'))
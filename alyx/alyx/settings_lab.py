@@ -10,3 +10,6 @@ SUPERUSERS = ('charu', 'nick', 'max', 'cyrille')
 STOCK_MANAGERS = ('charu',)
 WEIGHT_THRESHOLD = 0.75
 DEFAULT_LAB_NAME = 'cortexlab'
+# Users always imported by the sync_ucl command.
+SYNC_UCL_USERS = ('cyrille', 'Gaelle', 'kenneth', 'lauren', 'matteo', 'miles', 'nick', 'olivier',
+                  'Karolina_Socha', 'Hamish', 'laura', 'niccolo')
@@ -75,6 +75,9 @@ urlpatterns = [
     path('sessions', av.SessionAPIList.as_view(),
          name="session-list"),
 
+    path('sessions/upsert', av.SessionAPIUpsert.as_view(),
+         name="session-upsert"),
+
     path('sessions/<uuid:pk>', av.SessionAPIDetail.as_view(),
          name="session-detail"),
 
@@ -124,6 +127,9 @@ urlpatterns = [
     path('files', dv.FileRecordList.as_view(),
          name="filerecord-list"),
 
+    path('files/resolve', dv.ResolveFilesView.as_view(),
+         name="filerecord-resolve"),
+
     path('files/<uuid:pk>', dv.FileRecordDetail.as_view(),
          name="filerecord-detail"),
 
@@ -149,6 +155,10 @@ urlpatterns = [
          name='water-requirement'),
 
 
+    path('changes', mv.ChangesView.as_view(),
+         name='changes'),
+
+
     path('admin/', admin.site.urls),
 
     path('admin-subjects/', include('subjects.urls')),
@@ -0,0 +1,53 @@
+# Generated by Django 2.1.4 on 2019-02-04 10:00
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_auto_datetime(apps, schema_editor):
+    """Set the auto_datetime of the existing objects, so that they appear in the changes feed."""
+    now = timezone.now()
+    for model in apps.get_app_config('data').get_models():
+        if any(field.name == 'auto_datetime' for field in model._meta.local_fields):
+            model._base_manager.filter(auto_datetime__isnull=True).update(auto_datetime=now)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0002_auto_20181015_0914'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datarepositorytype',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='datarepository',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='dataformat',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='datasettype',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='filerecord',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.RunPython(backfill_auto_datetime, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.1.4 on 2019-02-05 10:00
+
+import logging
+
+from django.db import migrations
+from django.db.models import Count
+
+logger = logging.getLogger(__name__)
+
+
+def delete_duplicate_file_records(apps, schema_editor):
+    """Keep one file record per path and repository before adding the unique constraint: the
+    one that exists, and then the last modified one."""
+    FileRecord = apps.get_model('data', 'FileRecord')
+    duplicates = FileRecord._base_manager.values('relative_path', 'data_repository').annotate(
+        n=Count('pk')).filter(n__gt=1)
+    for key in duplicates:
+        pks = list(FileRecord._base_manager.filter(
+            relative_path=key['relative_path'], data_repository=key['data_repository']).
+            order_by('-exists', '-auto_datetime').values_list('pk', flat=True))
+        logger.warning("Deleting %d duplicate file records of %s.",
+                       len(pks) - 1, key['relative_path'])
+        FileRecord._base_manager.filter(pk__in=pks[1:]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0003_auto_datetime'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_file_records, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='filerecord',
+            unique_together={('relative_path', 'data_repository')},
+        ),
+    ]
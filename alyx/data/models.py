@@ -338,7 +338,9 @@ class FileRecord(BaseModel):
     exists = models.BooleanField(
         default=False, help_text="Whether the file exists in the data repository", )
 
-    unique_together = (('data_repository', 'relative_path'),)
+    class Meta:
+        # The relative path comes first so that the index also serves lookups by path only.
+        unique_together = (('relative_path', 'data_repository'),)
 
     def data_url(self):
         root = self.data_repository.data_url
@@ -1,10 +1,12 @@
 import datetime
 import os.path as op
+from unittest import mock
 
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 
 from alyx.base import BaseTests
+from data.models import Dataset
 
 
 class APIDataTests(BaseTests):
@@ -71,6 +73,35 @@ class APIDataTests(BaseTests):
         self.ar(r)
         self.assertEqual(r.data['name'], 'df')
 
+    def test_dataformat_cache(self):
+        url = reverse('dataformat-list')
+        r = self.client.get(url)
+        self.ar(r)
+        etag = r['ETag']
+
+        # Unchanged table: 304 without touching the database.
+        self.client.force_authenticate(self.superuser)
+        with self.assertNumQueries(0):
+            r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, 304)
+
+        # A new data format invalidates the cached list.
+        self.client.post(url, {'name': 'df2', 'file_extension': '.df2'})
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.ar(r)
+        self.assertNotEqual(r['ETag'], etag)
+        self.assertTrue('df2' in [_['name'] for _ in r.data])
+
+        # The changes of the tables that are not cached leave the cache alone.
+        with mock.patch('alyx.base.cache.set') as cache_set:
+            Dataset.objects.create(name='notcached').delete()
+        cache_set.assert_not_called()
+
+        # The version token is renewed again when the transaction commits.
+        with mock.patch('alyx.base.transaction.on_commit') as on_commit:
+            self.client.post(url, {'name': 'df3', 'file_extension': '.df3'})
+        on_commit.assert_called()
+
     def test_dataset_filerecord(self):
         # Create a dataset.
         data = {'name': 'mydataset',
@@ -194,3 +225,27 @@ class APIDataTests(BaseTests):
         self.assertEqual(d1['file_records'][0]['data_repository'], 'dr')
         self.assertEqual(d1['file_records'][0]['relative_path'],
                          op.join(data['path'], 'a.c.e2'))
+
+    def test_resolve_files(self):
+        r = self.client.post(reverse('dataset-list'),
+                             {'name': 'mydataset', 'dataset_type': 'dst', 'data_format': 'df'})
+        self.ar(r, 201)
+        data = {'dataset': r.data['url'], 'data_repository': 'dr',
+                'relative_path': 'path/to/file'}
+        r = self.client.post(reverse('filerecord-list'), data)
+        self.ar(r, 201)
+
+        url = reverse('filerecord-resolve')
+        files = [{'data_repository': 'dr', 'relative_path': 'path/to/file'},
+                 {'data_repository': 'dr', 'relative_path': 'path/to/nothing'}]
+        r = self.client.post(url, {'files': files}, format='json')
+        self.ar(r, 200)
+        self.assertEqual(len(r.data), 2)
+        self.assertEqual(r.data[0]['file_records'][0]['dataset_type'], 'dst')
+        self.assertFalse(r.data[0]['file_records'][0]['exists'])
+        self.assertEqual(r.data[1]['file_records'], [])
+
+        # Bare relative paths are looked up in all repositories.
+        r = self.client.post(url, {'paths': ['path\\to\\file']}, format='json')
+        self.ar(r, 200)
+        self.assertEqual(r.data[0]['file_records'][0]['data_repository'], 'dr')
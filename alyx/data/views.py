@@ -2,11 +2,12 @@ import logging
 import re
 
 from django.contrib.auth import get_user_model
-from rest_framework import generics, permissions, viewsets, mixins, serializers
+from rest_framework import generics, permissions, viewsets, mixins, serializers, views
 from rest_framework.response import Response
 import django_filters
 from django_filters.rest_framework import FilterSet
 
+from alyx.base import CachedListMixin, ConditionalDetailMixin
 from subjects.models import Subject, Project
 from .models import (DataRepositoryType,
                      DataRepository,
@@ -32,14 +33,14 @@ logger = logging.getLogger(__name__)
 # DataRepositoryType
 # ------------------------------------------------------------------------------------------------
 
-class DataRepositoryTypeList(generics.ListCreateAPIView):
+class DataRepositoryTypeList(CachedListMixin, generics.ListCreateAPIView):
     queryset = DataRepositoryType.objects.all()
     serializer_class = DataRepositoryTypeSerializer
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = 'name'
 
 
-class DataRepositoryTypeDetail(generics.RetrieveUpdateDestroyAPIView):
+class DataRepositoryTypeDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = DataRepositoryType.objects.all()
     serializer_class = DataRepositoryTypeSerializer
     permission_classes = (permissions.IsAuthenticated,)
@@ -49,14 +50,15 @@ class DataRepositoryTypeDetail(generics.RetrieveUpdateDestroyAPIView):
 # DataRepository
 # ------------------------------------------------------------------------------------------------
 
-class DataRepositoryList(generics.ListCreateAPIView):
+class DataRepositoryList(CachedListMixin, generics.ListCreateAPIView):
     queryset = DataRepository.objects.all()
     serializer_class = DataRepositorySerializer
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = 'name'
+    cache_models = (DataRepository, DataRepositoryType)
 
 
-class DataRepositoryDetail(generics.RetrieveUpdateDestroyAPIView):
+class DataRepositoryDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = DataRepository.objects.all()
     serializer_class = DataRepositorySerializer
     permission_classes = (permissions.IsAuthenticated,)
@@ -66,14 +68,14 @@ class DataRepositoryDetail(generics.RetrieveUpdateDestroyAPIView):
 # DataFormat
 # ------------------------------------------------------------------------------------------------
 
-class DataFormatList(generics.ListCreateAPIView):
+class DataFormatList(CachedListMixin, generics.ListCreateAPIView):
     queryset = DataFormat.objects.all()
     serializer_class = DataFormatSerializer
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = 'name'
 
 
-class DataFormatDetail(generics.RetrieveUpdateDestroyAPIView):
+class DataFormatDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = DataFormat.objects.all()
     serializer_class = DataFormatSerializer
     permission_classes = (permissions.IsAuthenticated,)
@@ -83,14 +85,15 @@ class DataFormatDetail(generics.RetrieveUpdateDestroyAPIView):
 # DatasetType
 # ------------------------------------------------------------------------------------------------
 
-class DatasetTypeList(generics.ListCreateAPIView):
+class DatasetTypeList(CachedListMixin, generics.ListCreateAPIView):
     queryset = DatasetType.objects.all()
     serializer_class = DatasetTypeSerializer
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = 'name'
+    cache_models = (DatasetType, get_user_model())
 
 
-class DatasetTypeDetail(generics.RetrieveUpdateDestroyAPIView):
+class DatasetTypeDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = DatasetType.objects.all()
     serializer_class = DatasetTypeSerializer
     permission_classes = (permissions.IsAuthenticated,)
@@ -124,10 +127,11 @@ class DatasetList(generics.ListCreateAPIView):
     filter_class = DatasetFilter
 
 
-class DatasetDetail(generics.RetrieveUpdateDestroyAPIView):
+class DatasetDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Dataset.objects.all()
     serializer_class = DatasetSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    etag_related = ('file_records',)
 
 
 # FileRecord
@@ -141,7 +145,7 @@ class FileRecordList(generics.ListCreateAPIView):
     filter_fields = ('exists', 'dataset')
 
 
-class FileRecordDetail(generics.RetrieveUpdateDestroyAPIView):
+class FileRecordDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = FileRecord.objects.all()
     serializer_class = FileRecordSerializer
     permission_classes = (permissions.IsAuthenticated,)
@@ -264,6 +268,74 @@ class RegisterFileViewSet(mixins.CreateModelMixin,
         return Response(response, status=201)
 
 
+# Resolve files
+# ------------------------------------------------------------------------------------------------
+
+# Number of paths looked up per query.
+RESOLVE_CHUNK_SIZE = 10000
+
+
+def _resolve_file_records(paths, repositories=None):
+    """Return a dictionary {relative_path: [file record info]} with one query per chunk of
+    paths, through the (relative_path, data_repository) unique index."""
+    out = {}
+    paths = sorted(set(paths))
+    for i in range(0, len(paths), RESOLVE_CHUNK_SIZE):
+        records = FileRecord.objects.filter(relative_path__in=paths[i:i + RESOLVE_CHUNK_SIZE])
+        if repositories:
+            records = records.filter(data_repository__name__in=repositories)
+        records = records.values_list(
+            'pk', 'relative_path', 'data_repository__name', 'dataset',
+            'dataset__dataset_type__name', 'exists')
+        for pk, relative_path, repository, dataset, dataset_type, exists in records:
+            out.setdefault(relative_path, []).append({
+                'id': pk,
+                'data_repository': repository,
+                'dataset': dataset,
+                'dataset_type': dataset_type,
+                'exists': exists,
+            })
+    return out
+
+
+class ResolveFilesView(views.APIView):
+    """
+    Look up many files at once. Post a JSON object with either `files`, a list of
+    `{"data_repository": name, "relative_path": path}` objects, or `paths`, a list of ALF
+    relative paths looked up in all repositories (or in `data_repository` if given).
+    Return, for each file in the order of the request, the matching file records with their
+    dataset, dataset type and `exists` flag.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, format=None):
+        files = request.data.get('files', None)
+        if files is None:
+            repository = request.data.get('data_repository', None)
+            files = [{'data_repository': repository, 'relative_path': path}
+                     for path in request.data.get('paths', ())]
+        if not isinstance(files, list):
+            raise ValueError("The files argument should be a list.")
+        for file in files:
+            if not file.get('relative_path', None):
+                raise ValueError("Each file requires a relative_path.")
+            file['relative_path'] = file['relative_path'].replace('\\', '/')
+        repositories = {file.get('data_repository', None) for file in files}
+        records = _resolve_file_records(
+            [file['relative_path'] for file in files],
+            repositories=None if None in repositories else repositories)
+        response = []
+        for file in files:
+            repository = file.get('data_repository', None)
+            matches = records.get(file['relative_path'], [])
+            if repository:
+                matches = [m for m in matches if m['data_repository'] == repository]
+            response.append({'data_repository': repository,
+                             'relative_path': file['relative_path'],
+                             'file_records': matches})
+        return Response(response, status=200)
+
+
 class SyncViewSet(viewsets.GenericViewSet):
 
     serializer_class = serializers.Serializer
@@ -0,0 +1,305 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+import json
+import logging
+import os
+import os.path as op
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core import serializers
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connection, router, transaction
+from django.db.models import prefetch_related_objects
+from django.db.models.signals import post_delete
+
+from alyx.base import BaseModel, bump_table_version
+from misc.compression import open_text
+from misc.models import Tombstone, create_tombstone
+
+logger = logging.getLogger(__name__)
+
+
+# Manifest of a chain of incremental backups, listing the base archive and its deltas.
+MANIFEST_NAME = 'manifest.json'
+# Number of objects fetched and serialized at once.
+CHUNK_SIZE = 2000
+# Number of objects inserted at once by load_items().
+LOAD_BATCH_SIZE = 5000
+# Modification timestamp of the models that do not derive from BaseModel. The other models
+# have no such field and are exported entirely in every delta.
+CHANGE_FIELDS = {
+    'misc.fieldhistory': 'date_time',
+    'misc.tombstone': 'deleted_datetime',
+}
+# Fields referencing users in the serialized objects, across the versions of the schema.
+USER_FIELDS = ('user', 'users', 'created_by', 'responsible_user')
+
+
+def change_field(model):
+    """Return the name of the field holding the last modification time of a model, or None."""
+    if issubclass(model, BaseModel):
+        return 'auto_datetime'
+    return CHANGE_FIELDS.get(model._meta.label_lower, None)
+
+
+def get_models(labels=(), exclude=()):
+    """Return the models to dump, in the order of dumpdata."""
+    if labels:
+        models = [apps.get_model(label) for label in labels]
+    else:
+        models = [model for app_config in apps.get_app_configs()
+                  if app_config.models_module is not None
+                  for model in app_config.get_models()]
+    exclude = {label.lower() for label in exclude}
+    return [model for model in models
+            if not model._meta.proxy and
+            router.allow_migrate_model(DEFAULT_DB_ALIAS, model) and
+            model._meta.app_label not in exclude and
+            model._meta.label_lower not in exclude]
+
+
+def iter_serialized(queryset, chunk_size=CHUNK_SIZE):
+    """Yield the objects of a queryset serialized with the python serializer, fetched and
+    serialized by chunks."""
+    # Many-to-many fields serialized with the objects, prefetched by chunk.
+    m2m = [field.name for field in queryset.model._meta.many_to_many
+           if field.remote_field.through._meta.auto_created]
+    objects = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(objects, chunk_size))
+        if not chunk:
+            break
+        if m2m:
+            prefetch_related_objects(chunk, *m2m)
+        yield from serializers.serialize('python', chunk)
+
+
+def read_manifest(directory):
+    """Return the manifest of the backup chain in a directory, or None if there is none."""
+    path = op.join(directory, MANIFEST_NAME)
+    if not op.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(directory, manifest):
+    """Write the manifest atomically, so that an interrupted backup leaves the chain intact."""
+    path = op.join(directory, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def iter_json_array(f, buffer_size=1 << 16):
+    """Yield the items of a JSON array read from a text file, without loading the whole
+    array in memory."""
+    decoder = json.JSONDecoder()
+    buf, pos = '', 0
+    started = False
+    while True:
+        # Skip the whitespace, reading more data when needed.
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf):
+                break
+            buf, pos = f.read(buffer_size), 0
+            if not buf:
+                raise ValueError("Truncated JSON array.")
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError("The file does not contain a JSON array.")
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == ']':
+            return
+        if buf[pos] == ',':
+            pos += 1
+            continue
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # The item is incomplete: read more data.
+            chunk = f.read(buffer_size)
+            if not chunk:
+                raise
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield item
+        pos = end
+        if pos >= buffer_size:
+            buf, pos = buf[pos:], 0
+
+
+def remap_users(items, user_keys, new_key=None, fields=USER_FIELDS):
+    """Yield serialized objects with the primary keys of the users, and the references to them
+    in the user fields, replaced through a mapping, in a single pass over the objects.
+
+    The keys of the mapping are the old primary keys as strings. The keys missing from the
+    mapping are kept as they are, unless new_key(pk) is given: it then returns their new
+    primary key, which is added to the mapping.
+
+    """
+    user_models = ('auth.user', settings.AUTH_USER_MODEL.lower())
+
+    def _remap(pk):
+        if pk is None:
+            return None
+        key = user_keys.get(str(pk), None)
+        if key is None and new_key is not None:
+            key = user_keys[str(pk)] = new_key(pk)
+        return pk if key is None else key
+
+    for item in items:
+        if item['model'].lower() in user_models:
+            item['pk'] = _remap(item['pk'])
+        item_fields = item.get('fields', {})
+        for field in fields:
+            value = item_fields.get(field, None)
+            if isinstance(value, list):
+                item_fields[field] = [_remap(pk) for pk in value]
+            elif value is not None:
+                item_fields[field] = _remap(value)
+        yield item
+
+
+@contextmanager
+def _auto_now_disabled(model):
+    """Keep the auto_now and auto_now_add fields of a model as they are in the dump."""
+    fields = [field for field in model._meta.concrete_fields
+              if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)]
+    saved = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, saved):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+@contextmanager
+def _tombstones_disabled(disabled=True):
+    """Do not create tombstones for the objects deleted in the block."""
+    if not disabled:
+        yield
+        return
+    post_delete.disconnect(create_tombstone)
+    try:
+        yield
+    finally:
+        post_delete.connect(create_tombstone)
+
+
+class BulkLoader(object):
+    """Create or update the serialized objects of a dump by batches of consecutive objects of
+    the same model, with bulk queries that call neither save() nor the signals."""
+
+    def __init__(self, batch_size=LOAD_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.counts = OrderedDict()
+        self.n_deleted = 0
+        self._model = None
+        self._items = []
+        self._deleted = OrderedDict()
+
+    def add(self, item):
+        model = apps.get_model(item['model'])
+        if item.get('deleted', None):
+            self._deleted.setdefault(model, []).append(item['pk'])
+            return
+        if model is not self._model or len(self._items) >= self.batch_size:
+            self.flush()
+            self._model = model
+        self._items.append(item)
+
+    def flush(self):
+        if not self._items:
+            return
+        model, items = self._model, self._items
+        self._items = []
+        objects = list(serializers.deserialize('python', items, ignorenonexistent=True))
+        instances = [obj.object for obj in objects]
+        existing = set(model._base_manager.filter(
+            pk__in=[instance.pk for instance in instances]).values_list('pk', flat=True))
+        with _auto_now_disabled(model):
+            model._base_manager.bulk_create(
+                [instance for instance in instances if instance.pk not in existing])
+            updated = [instance for instance in instances if instance.pk in existing]
+            if updated:
+                fields = [field.name for field in model._meta.concrete_fields
+                          if not field.primary_key]
+                model._base_manager.bulk_update(updated, fields, batch_size=500)
+        # Replace the many-to-many relations of the objects.
+        for name in sorted({name for obj in objects for name in obj.m2m_data}):
+            field = model._meta.get_field(name)
+            through = field.remote_field.through
+            source = field.m2m_field_name() + '_id'
+            target = field.m2m_reverse_field_name() + '_id'
+            if existing:
+                through._base_manager.filter(**{'%s__in' % source: existing}).delete()
+            through._base_manager.bulk_create([
+                through(**{source: obj.object.pk, target: pk})
+                for obj in objects for pk in obj.m2m_data.get(name, ())])
+            bump_table_version(through)
+        bump_table_version(model)
+        self.counts[model] = self.counts.get(model, 0) + len(instances)
+
+    def finish(self):
+        self.flush()
+        # The sequences of the integer primary keys are reset after inserting explicit values.
+        sequence_sql = connection.ops.sequence_reset_sql(no_style(), list(self.counts))
+        if sequence_sql:
+            with connection.cursor() as cursor:
+                for sql in sequence_sql:
+                    cursor.execute(sql)
+        # When the tombstones of the deleted objects were loaded with them, as in the backups,
+        # the deletions must not create them again.
+        with _tombstones_disabled(Tombstone in self.counts):
+            for model, pks in self._deleted.items():
+                self.n_deleted += model._base_manager.filter(pk__in=pks).delete()[0]
+
+
+def load_items(items, batch_size=LOAD_BATCH_SIZE, name='items'):
+    """Create or update serialized objects, and delete those marked as deleted, with bulk
+    queries in a single transaction.
+
+    Unlike loaddata, the objects are inserted (or updated when they exist) with bulk queries,
+    so that neither the save() methods nor the signals such as the genotyping, the
+    notifications and the reversion history are triggered. The foreign key constraints are
+    deferred until the end of the transaction, so that the objects can be loaded in any
+    order. The deleted objects are deleted last. Return the number of loaded objects per
+    model and the number of deleted objects.
+
+    """
+    t0 = time.time()
+    loader = BulkLoader(batch_size=batch_size)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+        for item in items:
+            loader.add(item)
+        loader.finish()
+    elapsed = max(time.time() - t0, 1e-6)
+    for model, count in loader.counts.items():
+        logger.debug("%d %s loaded.", count, model._meta.label_lower)
+    n = sum(loader.counts.values())
+    logger.info("Loaded %d objects and deleted %d from %s in %.1f s (%d objects/s).",
+                n, loader.n_deleted, name, elapsed, n / elapsed)
+    return loader.counts, loader.n_deleted
+
+
+def load_archive(path, batch_size=LOAD_BATCH_SIZE, user_keys=None):
+    """Load a dump or an archive of a backup chain, possibly compressed, streaming the JSON.
+    The user primary keys are replaced on the fly through the user_keys mapping, if any (see
+    remap_users()). See load_items()."""
+    with open_text(path) as f:
+        items = iter_json_array(f)
+        if user_keys:
+            items = remap_users(items, user_keys)
+        return load_items(items, batch_size=batch_size, name=path)
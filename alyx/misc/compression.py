@@ -0,0 +1,104 @@
+import gzip
+import io
+import os.path as op
+
+
+# Compression inferred from the file extension.
+COMPRESSIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+}
+# Extension of the compressed files for each compression.
+EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+    None: '',
+}
+
+
+def compression_from_path(path):
+    """Return the compression ('gzip', 'zstd' or None) given by the extension of a path."""
+    return COMPRESSIONS.get(op.splitext(path)[1].lower(), None)
+
+
+class _ByteCounter(io.RawIOBase):
+    """Binary file wrapper counting the bytes actually written to the disk."""
+
+    def __init__(self, f):
+        self._f = f
+        self.n_bytes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._f.write(data)
+        self.n_bytes += len(data)
+        return len(data)
+
+
+class CompressedWriter(object):
+    """Write a file through an optional streaming compression, in constant memory.
+
+    The writer accepts bytes or strings (encoded in UTF-8), and counts the number of bytes
+    written before (n_bytes_in) and after (n_bytes_out) compression. The zstd compression
+    requires the optional zstandard package.
+
+    """
+
+    def __init__(self, path, compression=None, level=None):
+        self.path = path
+        self.compression = compression
+        self.n_bytes_in = 0
+        self._raw = open(path, 'wb')
+        self._counter = _ByteCounter(self._raw)
+        if compression == 'gzip':
+            self._f = gzip.GzipFile(
+                filename=op.basename(path), mode='wb', fileobj=self._counter,
+                compresslevel=level or 6)
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:  # pragma: no cover
+                self._raw.close()
+                raise ImportError("The zstandard package is required for the zstd compression.")
+            self._f = zstandard.ZstdCompressor(level=level or 3).stream_writer(self._counter)
+        elif compression is None:
+            self._f = self._counter
+        else:
+            self._raw.close()
+            raise ValueError("Unknown compression %s." % compression)
+
+    @property
+    def n_bytes_out(self):
+        return self._counter.n_bytes
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._f.write(data)
+        self.n_bytes_in += len(data)
+        return len(data)
+
+    def close(self):
+        if self._f is not self._counter:
+            self._f.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_text(path):
+    """Open a text file for reading, decompressed on the fly according to its extension."""
+    compression = compression_from_path(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    elif compression == 'zstd':
+        import zstandard
+        f = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        return io.TextIOWrapper(f, encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 import csv
 from datetime import datetime
 import glob
@@ -10,7 +12,10 @@ import sys
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from django.core.management.base import BaseCommand
-from django.db import connection
+from django.db import connection, transaction
+import psycopg2
+
+from misc.compression import EXTENSIONS, CompressedWriter, open_text
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)-15s %(message)s')
@@ -27,34 +32,91 @@ def get_gc():
     return gc
 
 
-def backup_tsv(sql_dir, output_dir):
+@contextmanager
+def exported_snapshot():
+    """Open a repeatable read transaction on the default connection and yield the identifier
+    of its exported snapshot, which other connections can share while the transaction is
+    open."""
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cursor.execute("SELECT pg_export_snapshot()")
+            snapshot = cursor.fetchone()[0]
+        yield snapshot
+
+
+def _copy(params, snapshot, cmd, path, compression=None):
+    """Run a COPY ... TO STDOUT command on a new connection, in the given snapshot, and
+    stream the output to a file. Return the number of bytes before and after compression."""
+    conn = psycopg2.connect(**params)
+    try:
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with conn.cursor() as cursor:
+            cursor.execute("SET TRANSACTION SNAPSHOT %s", [snapshot])
+            with CompressedWriter(path, compression=compression) as f:
+                cursor.copy_expert(cmd, f)
+        conn.rollback()
+    finally:
+        conn.close()
+    return f.n_bytes_in, f.n_bytes_out
+
+
+def _run_copies(copies, compression=None, workers=4):
+    """Run the (name, cmd, path) COPY commands concurrently, on separate connections sharing
+    a consistent snapshot of the database."""
+    params = connection.get_connection_params()
+    with exported_snapshot() as snapshot:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_copy, params, snapshot, cmd, path, compression=compression):
+                (name, path) for name, cmd, path in copies}
+            for future in as_completed(futures):
+                name, path = futures[future]
+                size, compressed = future.result()
+                logger.info("Dumped %s to %s (%d bytes, %d compressed).",
+                            name, path, size, compressed)
+
+
+def backup_tsv(sql_dir, output_dir, compression='gzip', workers=4):
     path = op.abspath(op.join(sql_dir, '*.sql'))
     files = sorted(glob.glob(path))
+    copies = []
     for file in files:
         with open(file, 'r') as f:
             sql = f.read()
         name = op.splitext(op.basename(file))[0]
-        path = op.abspath(op.join(output_dir, name + '.tsv'))
+        path = op.abspath(op.join(output_dir, name + '.tsv' + EXTENSIONS[compression]))
         cmd = ("copy (%s) to STDOUT with CSV DELIMITER E'\t' header encoding 'utf-8'" %
                sql)
-        with connection.cursor() as cursor:
-            with open(path, 'w') as f:
-                cursor.copy_expert(cmd, f)
-        with open(path, 'r') as f:
-            size = len(f.read())
-        logger.info("Dumped %s to %s (%d bytes).", name, path, size)
+        copies.append((name, cmd, path))
+    _run_copies(copies, compression=compression, workers=workers)
     print("TSV backup done!")
 
 
+def backup_tables(output_dir, compression='gzip', workers=4):
+    """Copy every Alyx table in PostgreSQL binary format, for a fast restore with
+    COPY ... FROM STDIN WITH (FORMAT binary)."""
+    if not op.exists(output_dir):
+        os.makedirs(output_dir)
+    tables = sorted(connection.introspection.django_table_names(only_existing=True))
+    copies = []
+    for table in tables:
+        path = op.abspath(op.join(output_dir, table + '.bin' + EXTENSIONS[compression]))
+        cmd = "COPY %s TO STDOUT WITH (FORMAT binary)" % connection.ops.quote_name(table)
+        copies.append((table, cmd, path))
+    _run_copies(copies, compression=compression, workers=workers)
+    print("Binary backup of %d tables done!" % len(tables))
+
+
 def upload_table(doc, path):
     alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-    with open(path) as csvfile:
+    with open_text(path) as csvfile:
         reader = csv.reader(csvfile, delimiter='\t')
         headers = next(reader)
         items = list(reader)
 
     # Get the sheet.
-    name = op.splitext(op.basename(path))[0]
+    name = op.basename(path).split('.')[0]
     ws = doc.worksheet(name)
     n_rows = len(items)
     n_cols = len(headers)
@@ -87,11 +149,11 @@ def upload_table(doc, path):
 
 def upload_gsheets(output_dir):
     gc = get_gc()
-    files = sorted(glob.glob(op.join(output_dir, output_dir, '*.tsv')))
+    files = sorted(glob.glob(op.join(output_dir, output_dir, '*.tsv*')))
     logger.info("Found %d files in %s.", len(files), output_dir)
     doc = gc.open('Alyx Backup')
     for path in files:
-        name = op.splitext(op.basename(path))[0]
+        name = op.basename(path).split('.')[0]
         n = upload_table(doc, path)
         logger.info("%d items uploaded to `%s` sheet of Google Sheet backup document.",
                     n, name)
@@ -105,6 +167,12 @@ class Command(BaseCommand):
         super(Command, self).add_arguments(parser)
         parser.add_argument('output_dir', nargs=1, type=str)
         parser.add_argument('-ng', '--no-google', action='store_true')
+        parser.add_argument('--compression', choices=('gzip', 'zstd', 'none'), default='gzip',
+                            help="Compression of the backup files")
+        parser.add_argument('--workers', type=int, default=4,
+                            help="Number of queries run concurrently")
+        parser.add_argument('--full', action='store_true',
+                            help="Also copy every table in binary format for a fast restore")
 
     def handle(self, *args, **options):
         output_dir = op.abspath(options.get('output_dir')[0])
@@ -118,7 +186,13 @@ class Command(BaseCommand):
             self.stdout.write('Error: %s is not a directory' % output_dir)
             return
 
+        compression = options.get('compression')
+        compression = None if compression == 'none' else compression
+        workers = options.get('workers')
         sql_path = op.abspath(op.join(op.dirname(__file__), 'queries'))
-        backup_tsv(sql_path, output_dir)
+        backup_tsv(sql_path, output_dir, compression=compression, workers=workers)
+        if options.get('full', None):
+            backup_tables(op.join(output_dir, 'tables'), compression=compression,
+                          workers=workers)
         if not options.get('no_google', None):
             upload_gsheets(output_dir)
@@ -8,7 +8,6 @@ from pickle import load, dump
 import re
 import uuid
 
-from datetime import datetime
 from django.utils import timezone
 from dateutil.parser import parse as parse_
 import gspread
@@ -170,6 +169,7 @@ class GoogleSheetImporter(object):
         self.subjects = self._get_subjects(self.line_tables)
         self.litters = self._get_litters(self.subjects)
         self._set_autoname_indices(self.line_tables)
+        self.field_history = []
         self.surgeries = self._get_surgeries(self.procedure_table)
         self.breeding_pairs = self._get_breeding_pairs(self.breeding_pairs_table)
         self.litter_breeding_pairs = self._get_litter_breeding_pairs()
@@ -441,11 +441,16 @@ class GoogleSheetImporter(object):
             subject['protocol_number'] = row['Protocol #']
             subject['responsible_user'] = [get_username(row['Responsible User'])]
 
-            # Save the old nickname.
-            date_time = datetime.now(timezone.utc).isoformat()
-            subject['json'] = {'history': {'nickname': [
-                {'date_time': date_time, 'value': old_name}
-            ]}}
+            # Save the old nickname in the field history of the subject.
+            if old_name != new_name:
+                subject['pk'] = subject.get('pk', None) or str(uuid.uuid4())
+                self.field_history.append(Bunch(
+                    content_type=['subjects', 'subject'],
+                    object_id=subject['pk'],
+                    field_name='nickname',
+                    value=old_name,
+                    date_time=timezone.now().isoformat(),
+                ))
 
             # Add the surgery.
             surgery = Bunch()
@@ -701,6 +706,7 @@ class Command(BaseCommand):
         make_fixture('actions.weighing', importer.weighings, path='12-weighings')
         make_fixture('actions.wateradministration', importer.administrations,
                      path='13-water-administrations')
+        make_fixture('misc.fieldhistory', importer.field_history, path='14-field-history')
 
         json_dir = op.join(DATA_DIR, 'json')
 
@@ -712,6 +718,9 @@ class Command(BaseCommand):
             for file in sorted(files):
                 if file.endswith('.json'):
                     fullpath = op.join(json_dir, file)
+                    # loaddata rather than load_archive(): these fixtures have objects
+                    # without primary key and references by natural key to the objects of
+                    # the previous files.
                     call_command('loaddata', fullpath, verbosity=3, interactive=False)
 
         self.stdout.write(self.style.SUCCESS('Loaded all JSON files from %s' % json_dir))
@@ -1,87 +1,141 @@
-from collections import defaultdict
-import gzip
+from itertools import chain
 import json
 import logging
 import os
 import os.path as op
 import sys
 
-from django.core.management import call_command
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from dateutil.parser import parse
+
+from misc.backups import (
+    change_field, get_models, iter_serialized, read_manifest, write_manifest)
+from misc.compression import EXTENSIONS, compression_from_path, CompressedWriter
+from misc.models import Tombstone
+from misc.views import CHANGES_SAFETY_WINDOW
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)-15s %(message)s')
 
 
-def _dump_all(path):
-    call_command('dumpdata',
-                 '-e', 'contenttypes',
-                 '-e', 'auth.permission',
-                 '-e', 'admin.logentry',
-                 '-e', 'authtoken',
-                 '-e', 'reversion',
-                 '--indent', '1', '-o', path)
-
-
-def _dump_static(path):
-    call_command('dumpdata',
-                 '-e', 'contenttypes',
-                 'auth.user',
-                 'subjects.species',
-                 'subjects.source',
-                 'equipment.lablocation',
-                 'actions.proceduretype',
-                 '--indent', '1', '-o', path)
-
-
-def _anonymize(path):
-    """Anonymize a JSON dump so that it can be uploaded publicly on GitHub to be used by CI."""
-    with open(path, 'r') as f:
-        data = json.load(f)
-
-    N_MAX = 50
-    LIMIT_MODELS = ('actions.wateradministration',
-                    'actions.weighing',
-                    'subjects.session',
-                    'subjects.surgery',
-                    'subjects.zygosity',
-                    'subjects.genotypetest',
-                    )
-
-    counter = defaultdict(int)
-    data_out = []
-    for item in data:
-        # Max number of items per model.
-        if item['model'] in LIMIT_MODELS and counter[item['model']] >= N_MAX:
-            continue
-        pk = item['pk']
-        # Remove user password and email.
-        if item['model'] == 'auth.user':
-            item['fields']['password'] = ''
-            item['fields']['email'] = ''
-        # Remove names.
-        for field, value in item['fields'].items():
-            if field.endswith('name'):
-                item['fields'][field] = pk[:6] if isinstance(pk, str) else str(pk)
-            # Remote notes and description.
-            if field in ('notes', 'description'):
-                item['fields'][field] = '-'
-            if field == 'user_permissions':
-                item['fields'][field] = []
-        # Increment model counter.
-        counter[item['model']] += 1
-        data_out.append(item)
-    # Output file.
-    bn, ext = op.splitext(path)
-    fn_out = bn + '_anon' + ext
-    with open(fn_out, 'w') as f:
-        json.dump(data_out, f, indent=1, sort_keys=True)
-    return fn_out
-
-
-def _gzip(path):
-    with open(path, 'rb') as f_in, open(path + '.gz', 'wb') as f_out:
-        f_out.write(gzip.compress(f_in.read()))
+# Excluded apps and models in a full dump.
+DUMP_EXCLUDE = ('contenttypes', 'auth.permission', 'admin.logentry', 'authtoken', 'reversion')
+# Models in the static dump.
+DUMP_STATIC = (settings.AUTH_USER_MODEL,
+               'subjects.species',
+               'subjects.source',
+               'misc.lablocation',
+               'actions.proceduretype',
+               )
+# Max number of items per model in the anonymized dump.
+N_MAX = 50
+LIMIT_MODELS = ('actions.wateradministration',
+                'actions.weighing',
+                'subjects.session',
+                'subjects.surgery',
+                'subjects.zygosity',
+                'subjects.genotypetest',
+                )
+
+
+def _iter_items(models, limit=False, since=None):
+    """Yield the serialized objects of the models, fetched and serialized by chunks. With
+    since, only the objects modified since then, for the models with a modification field."""
+    for model in models:
+        queryset = model._base_manager.order_by(model._meta.pk.name)
+        field = change_field(model)
+        if since is not None and field:
+            queryset = queryset.filter(**{'%s__gte' % field: since})
+        if limit and model._meta.label_lower in LIMIT_MODELS:
+            queryset = queryset[:N_MAX]
+        yield from iter_serialized(queryset)
+
+
+def _anonymize_item(item):
+    """Anonymize a serialized object so that the dump can be uploaded publicly on GitHub to be
+    used by CI."""
+    pk = item['pk']
+    # Remove user password and email.
+    if item['model'] in ('auth.user', settings.AUTH_USER_MODEL.lower()):
+        item['fields']['password'] = ''
+        item['fields']['email'] = ''
+    # Remove names.
+    for field, value in item['fields'].items():
+        if field.endswith('name'):
+            item['fields'][field] = pk[:6] if isinstance(pk, str) else str(pk)
+        # Remote notes and description.
+        if field in ('notes', 'description'):
+            item['fields'][field] = '-'
+        if field == 'user_permissions':
+            item['fields'][field] = []
+    return item
+
+
+def _iter_deletions(models, since):
+    """Yield the objects of the models deleted since a given time, as
+    {'model': ..., 'pk': ..., 'deleted': true} items."""
+    labels = {model._meta.label_lower for model in models}
+    tombstones = Tombstone.objects.filter(deleted_datetime__gte=since).select_related(
+        'content_type').order_by('deleted_datetime')
+    for tombstone in tombstones.iterator():
+        label = '%s.%s' % (tombstone.content_type.app_label, tombstone.content_type.model)
+        if label in labels:
+            yield {'model': label, 'pk': str(tombstone.object_id), 'deleted': True}
+
+
+def _dump(path, models, compression=None, anonymize=False, since=None):
+    """Stream the objects of the models to a JSON file, compressed on the fly. With since,
+    the file only contains the objects modified since then, followed by the deleted ones."""
+    items = _iter_items(models, limit=anonymize, since=since)
+    if since is not None:
+        items = chain(items, _iter_deletions(models, since))
+    if anonymize:
+        items = map(_anonymize_item, items)
+    n = 0
+    with CompressedWriter(path, compression=compression) as f:
+        f.write('[\n')
+        for item in items:
+            if n:
+                f.write(',\n')
+            f.write(json.dumps(item, cls=DjangoJSONEncoder, indent=1, sort_keys=anonymize))
+            n += 1
+        f.write('\n]\n')
+    logger.info("Dumped %d objects to %s (%d bytes, %d compressed).",
+                n, path, f.n_bytes_in, f.n_bytes_out)
+    return n
+
+
+def _dump_incremental(directory, compression='gzip', new_chain=False):
+    """Add an archive to the chain of backups in a directory: a full base archive for a new
+    chain, or a delta with the objects modified and deleted since the previous archive.
+
+    Each archive records a cursor lagging behind its start time by a safety window, from
+    which the next delta starts, so that the successive archives overlap instead of missing
+    concurrent changes. The chain is restored with the restore command.
+
+    """
+    manifest = None if new_chain else read_manifest(directory)
+    archives = manifest['archives'] if manifest else []
+    since = parse(archives[-1]['cursor']) if archives else None
+    now = timezone.now()
+    cursor = now - CHANGES_SAFETY_WINDOW
+    kind = 'delta' if since else 'base'
+    # The extension gives the compression to the restore command.
+    name = '%04d-%s-%s.json%s' % (len(archives), kind, now.strftime('%Y%m%dT%H%M%S'),
+                                  EXTENSIONS[compression])
+    n = _dump(op.join(directory, name), get_models(exclude=DUMP_EXCLUDE),
+              compression=compression, since=since)
+    archives.append({
+        'file': name,
+        'since': since.isoformat() if since else None,
+        'cursor': cursor.isoformat(),
+        'count': n,
+    })
+    write_manifest(directory, {'archives': archives})
+    return name
 
 
 class Command(BaseCommand):
@@ -92,6 +146,14 @@ class Command(BaseCommand):
         parser.add_argument('--output-path', '-o', nargs=1, type=str)
         parser.add_argument('--test', action='store_true', default=False)
         parser.add_argument('--static', action='store_true', default=False)
+        parser.add_argument('--compression', choices=('gzip', 'zstd'),
+                            help="Compression of the dump, by default given by the extension "
+                            "of the output path (.gz or .zst)")
+        parser.add_argument('--incremental', action='store_true', default=False,
+                            help="Add a delta with the changes since the last backup to the "
+                            "chain of backups in the output directory")
+        parser.add_argument('--new-chain', action='store_true', default=False,
+                            help="With --incremental, start a new chain with a full backup")
 
     def handle(self, *args, **options):
         cur_dir = op.realpath(op.dirname(__file__))
@@ -104,18 +166,26 @@ class Command(BaseCommand):
             self.stdout.write('Error: %s is not a directory' % output_dir)
             return
 
+        # Incremental backups: the output path is the directory of the chain.
+        if options.get('incremental', None):
+            if not op.exists(output_path):
+                os.makedirs(output_path)
+            name = _dump_incremental(output_path, compression=options.get('compression') or
+                                     'gzip', new_chain=options.get('new_chain'))
+            self.stdout.write('Backup %s added to %s' % (name, output_path))
+
         # Anonymize the dump, used for tests.
-        if options.get('test', None):
-            output_path = op.join(cur_dir, '../../../../data/all_dumped.json')
-            _dump_all(output_path)
-            # Anonymize and gzip.
-            _gzip(_anonymize(output_path))
+        elif options.get('test', None):
+            output_path = op.join(cur_dir, '../../../../data/all_dumped_anon.json.gz')
+            _dump(output_path, get_models(exclude=DUMP_EXCLUDE),
+                  compression='gzip', anonymize=True)
 
         # Dump just static information.
         elif options.get('static', None):
             output_path = op.join(cur_dir, '../../../../data/json/00-dumped-static.json')
-            _dump_static(output_path)
+            _dump(output_path, get_models(labels=DUMP_STATIC))
 
         elif output_path:
             # Make the dump.
-            _dump_all(output_path)
+            compression = options.get('compression') or compression_from_path(output_path)
+            _dump(output_path, get_models(exclude=DUMP_EXCLUDE), compression=compression)
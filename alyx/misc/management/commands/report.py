@@ -1,18 +1,23 @@
+from collections import OrderedDict
 from datetime import timedelta, date
 import inspect
 from itertools import groupby
 import json
 import logging
+from multiprocessing import Pool
 from operator import itemgetter
 from textwrap import dedent
 
 from django.contrib.admin.models import LogEntry
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
+from django.db import connections
 from django.utils import timezone
 
 from alyx.base import alyx_mail
-from actions.models import Surgery, WaterRestriction, Session
+from actions.models import Surgery, WaterRestriction
+from actions.training import training_matrix
+from actions.water_control import prefetch_water_control
 from subjects.models import Subject
 
 logger = logging.getLogger(__name__)
@@ -46,6 +51,58 @@ def _repr_log_entry(l):
     return s
 
 
+def _water_summary(subject, today):
+    """Return the figures of the water restriction and mouse weight reports for a subject."""
+    wc = subject.water_control
+    user = subject.responsible_user
+    summary = {
+        'subject': str(subject),
+        'lab': subject.lab.name if subject.lab else None,
+        'user': str(user) if user else None,
+        'email': user.email if user else None,
+        'threshold': max(wc.zscore_weight_pct, wc.reference_weight_pct),
+        'restriction': None,
+        'underweight': None,
+    }
+    # Weight yesterday.
+    yesterday = (today - timedelta(days=1)).date()
+    wy = wc.last_weighing_before(date=yesterday)
+    if wy is not None:
+        # Last date with weighing, might be yesterday or earlier.
+        last_date = wy[0].date()
+        summary['restriction'] = dict(
+            # Number of days ago.
+            n=(today.date() - last_date).days,
+            wy=wy[1],
+            # Expected weight at the last date.
+            wye=wc.expected_weight(date=last_date),
+            wyep=wc.percentage_weight(date=last_date),
+            # Water
+            way=wc.given_water_total(date=last_date),
+            waym=wc.expected_water(date=last_date),
+            waye=wc.excess_water(date=last_date),
+            wr=wc.remaining_water(),  # remaining water TODAY
+        )
+    last_weighing = wc.last_weighing_before()
+    if last_weighing and wc.weight_status() > 0:
+        summary['underweight'] = dict(
+            weight=wc.weight(),
+            expected=wc.expected_weight(),
+            percentage=wc.percentage_weight(),
+            date=last_weighing[0],
+        )
+    return summary
+
+
+def _water_summaries(args):
+    """Return a dictionary {subject_id: summary} for a partition of subjects, built with a
+    constant number of queries."""
+    subject_ids, today = args
+    subjects = prefetch_water_control(
+        Subject.objects.filter(pk__in=subject_ids).select_related('responsible_user'))
+    return {subject.pk: _water_summary(subject, today) for subject in subjects}
+
+
 class Command(BaseCommand):
     help = "Generate daily reports"
 
@@ -59,11 +116,16 @@ class Command(BaseCommand):
         parser.add_argument('--no-email', action='store_true', default=False,
                             help="Show report without sending an email")
         parser.add_argument('--lab', help='Lab for which to run the report')
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Number of processes computing the water summaries of the "
+                            "labs in parallel")
 
     def handle(self, *args, **options):
         # Sort the list of pairs (user, text) by user to collate all emails for every user.
         # This is because groupby() requires the items to be already sorted.
         self.lab = options.get('lab')
+        self.workers = options.get('workers') or 1
+        self._datasets = {}
         tuples = list(self._generate_email(*args, **options))
         tuples = sorted(tuples, key=lambda k: k[0].username)
         for user, texts in groupby(tuples, itemgetter(0)):
@@ -95,6 +157,64 @@ class Command(BaseCommand):
                 for user in users:
                     yield user, text
 
+    # Shared datasets
+    # --------------------------------------------------------------------------------------------
+
+    def _dataset(self, name):
+        """Load a dataset shared by the reports of all users, once per run."""
+        if name not in self._datasets:
+            logger.debug("Loading dataset %s." % name)
+            self._datasets[name] = getattr(self, '_load_%s' % name)()
+        return self._datasets[name]
+
+    def _load_active_restrictions(self):
+        return list(WaterRestriction.objects.filter(
+            start_time__isnull=False, end_time__isnull=True,
+        ).order_by('subject__nickname').values(
+            'start_time', 'subject', 'subject__lab', 'subject__responsible_user'))
+
+    def _load_water(self):
+        """Water control summaries of all subjects under water restriction, computed per lab,
+        in parallel processes if requested."""
+        partitions = OrderedDict()
+        for w in self._dataset('active_restrictions'):
+            partitions.setdefault(w['subject__lab'], set()).add(w['subject'])
+        today = timezone.now()
+        args = [(sorted(ids), today) for ids in partitions.values()]
+        summaries = {}
+        if self.workers > 1 and len(args) > 1:
+            # The workers must not share the connection of the parent process.
+            connections.close_all()
+            with Pool(min(self.workers, len(args))) as pool:
+                for partition in pool.imap_unordered(_water_summaries, args):
+                    summaries.update(partition)
+        else:
+            for arg in args:
+                summaries.update(_water_summaries(arg))
+        return summaries
+
+    def _load_surgery_pending(self):
+        """Nicknames of the subjects without surgery, per responsible user."""
+        done = Surgery.objects.filter(subject__isnull=False).values('subject')
+        pending = {}
+        for user_id, nickname in Subject.objects.exclude(pk__in=done).filter(
+                responsible_user__isnull=False).order_by('nickname').values_list(
+                'responsible_user', 'nickname'):
+            pending.setdefault(user_id, []).append(nickname)
+        return pending
+
+    def _load_past_changes(self):
+        """Yesterday's log entries, per user."""
+        yesterday = (timezone.now() - timedelta(days=1)).date()
+        logs = {}
+        for l in LogEntry.objects.filter(action_time__date=yesterday).order_by('action_time'):
+            logs.setdefault(l.user_id, []).append(l)
+        return logs
+
+    def _load_training(self):
+        last_monday = date.today() - timedelta(days=date.today().weekday() + 5)
+        return last_monday, training_matrix(last_monday)
+
     def _send(self, to, subject, text=''):
         self.stdout.write('"%s" to be sent to <%s>.\n\n' % (subject, to))
         self.stdout.write(text)
@@ -106,79 +226,46 @@ class Command(BaseCommand):
             logger.debug("NOT sending an empty email.")
 
     def make_water_restriction(self, user):
-        wr = WaterRestriction.objects.filter(start_time__isnull=False,
-                                             end_time__isnull=True,
-                                             subject__responsible_user=user,
-                                             ).order_by('subject__nickname')
+        wr = [w for w in self._dataset('active_restrictions')
+              if w['subject__responsible_user'] == user.pk]
         if not wr:
             return
+        summaries = self._dataset('water')
         text = "Mice on water restriction:\n"
         # Hench since 2017-04-20. Weight yesterday 27.2g (expected 30.0g, 90.7%).
         # Yesterday given 1.02mL (min 0.96mL, excess 0.06mL). Today requires 0.97mL.
         for w in wr:
-            s = w.subject
-            wc = s.water_control
-            sn = w.subject.nickname
-            sd = w.start_time.date()
-            today = timezone.now()
-            yesterday = (today - timedelta(days=1)).date()
-            # Weight yesterday.
-            wy = wc.last_weighing_before(date=yesterday)
-            if wy is None:
+            summary = summaries[w['subject']]
+            if summary['restriction'] is None:
                 continue
-            # Last date with weighing, might be yesterday or earlier.
-            last_date = wy[0].date()
-            # Number of days ago.
-            n = (today.date() - last_date).days
-            wy = wy[1]
-            # Expected weight at the last date.
-            wye = wc.expected_weight(date=last_date)
-            wyep = wc.percentage_weight(date=last_date)
-            # Water
-            way = wc.given_water_total(date=last_date)
-            waym = wc.expected_water(date=last_date)
-            waye = wc.excess_water(date=last_date)
-            wr = wc.remaining_water()  # remaining water TODAY
             s = '''
                 * {sn} since {sd}.
                 Weight {n} day(s) ago: {wy:.1f}g (expected {wye:.1f}g, {wyep:.1f}%).
                 Given  {n} day(s) ago: {way:.2f}mL (min {waym:.2f}mL, excess {waye:.2f}mL).
                 Today requires {wr:.2f}mL.
-                '''.format(sn=sn, sd=sd, wy=wy, wye=wye, wyep=wyep,
-                           n=n,
-                           way=way, waym=waym, waye=waye, wr=wr)  # noqa
+                '''.format(sn=summary['subject'], sd=w['start_time'].date(),
+                           **summary['restriction'])  # noqa
             text += dedent(s)
         return text
 
     def make_mouse_weight(self):
-        wr = WaterRestriction.objects.filter(start_time__isnull=False,
-                                             end_time__isnull=True,
-                                             )
-        if self.lab:
-            wr = wr.filter(subject__lab__name=self.lab)
-        subject_ids = [_[0] for _ in wr.values_list('subject').distinct()]
+        summaries = self._dataset('water')
+        subject_ids = OrderedDict(
+            (w['subject'], None) for w in self._dataset('active_restrictions'))
+        threshold = 0
         text = ''
         for subject_id in subject_ids:
-            subject = Subject.objects.get(pk=subject_id)
-            wc = subject.water_control
-            w = wc.weight()
-            e = wc.expected_weight()
-            p = wc.percentage_weight()
-            last_weighing = wc.last_weighing_before()
-            if not last_weighing:
+            summary = summaries[subject_id]
+            if self.lab and summary['lab'] != self.lab:
                 continue
-            date = last_weighing[0]
-            threshold = max(wc.zscore_weight_pct, wc.reference_weight_pct)
-            if wc.weight_status() > 0:
+            threshold = summary['threshold']
+            if summary['underweight']:
                 text += ('* {subject} ({user} <{email}>) weighed {weight:.1f}g '
                          'instead of {expected:.1f}g ({percentage:.1f}%) on {date}\n').format(
-                             subject=subject,
-                             user=subject.responsible_user,
-                             email=subject.responsible_user.email,
-                             weight=w,
-                             expected=e,
-                             percentage=p,
-                             date=date,
+                             subject=summary['subject'],
+                             user=summary['user'],
+                             email=summary['email'],
+                             **summary['underweight']
                 )
         text = 'Mice under the {t}% +2% weight limit:\n\n'.format(t=int(100 * threshold)) + text
         return text
@@ -187,11 +274,7 @@ class Command(BaseCommand):
         # Skip surgeries on stock managers.
         if user.is_stock_manager:
             return
-        surgery_done = set([surgery.subject.nickname for surgery in
-                            Surgery.objects.filter(subject__responsible_user=user)])
-        subjects_user = set([subject.nickname for subject in
-                             Subject.objects.filter(responsible_user=user)])
-        surgery_pending = sorted(subjects_user - surgery_done)
+        surgery_pending = self._dataset('surgery_pending').get(user.pk, [])
         if not surgery_pending:
             return
         text = "Mice awaiting surgery:\n"
@@ -199,29 +282,19 @@ class Command(BaseCommand):
         return text
 
     def make_past_changes(self, user):
-        today = timezone.now()
-        yesterday = (today - timedelta(days=1)).date()
-        logs = LogEntry.objects.filter(user=user,
-                                       action_time__date=yesterday,
-                                       ).order_by('action_time')
+        logs = self._dataset('past_changes').get(user.pk, [])
         return 'Your actions yesterday:\n\n' + '\n'.join('* ' + _repr_log_entry(l) for l in logs)
 
     def make_training(self, user):
         """Send training report to the specified user."""
-        wr = WaterRestriction.objects.filter(
-            start_time__isnull=False, end_time__isnull=True,
-        ).order_by('subject__responsible_user__username', 'subject__nickname')
-        last_monday = date.today() - timedelta(days=date.today().weekday() + 5)
+        last_monday, matrix = self._dataset('training')
         next_monday = last_monday + timedelta(days=7)
         text = "Sessions between %s and %s:\n\n" % (last_monday, next_monday)
-        for w in wr:
-            sessions = Session.objects.filter(
-                subject=w.subject, start_time__gte=last_monday, start_time__lt=next_monday)
-            dates = sorted(set([_[0] for _ in sessions.order_by('start_time').
-                                values_list('start_time__date')]))
+        for item in matrix:
+            dates = item['dates']
             if len(dates) < 5:
                 text += '* %s (%s) was trained %d days: %s\n' % (
-                    w.subject.nickname, w.subject.responsible_user.username, len(dates),
+                    item['nickname'], item['username'], len(dates),
                     ', '.join(d.strftime('%a %d %b') for d in dates)
                 )
         return text
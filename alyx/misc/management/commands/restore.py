@@ -0,0 +1,43 @@
+import json
+import logging
+import os.path as op
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from misc.backups import LOAD_BATCH_SIZE, load_archive, read_manifest
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)-15s %(message)s')
+
+
+class Command(BaseCommand):
+    help = ("Restore a JSON dump, or a chain of incremental backups made with "
+            "`dump --incremental`, with bulk queries")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="JSON dump (possibly compressed) or directory of a "
+                            "backup chain")
+        parser.add_argument('--batch-size', type=int, default=LOAD_BATCH_SIZE,
+                            help="Number of objects inserted at once")
+        parser.add_argument('--user-keys',
+                            help="JSON file mapping old user primary keys to new ones, "
+                            "replaced in the loaded objects")
+
+    def handle(self, *args, **options):
+        path = op.abspath(options.get('path'))
+        batch_size = options.get('batch_size')
+        user_keys = None
+        if options.get('user_keys'):
+            with open(options.get('user_keys'), 'r') as f:
+                user_keys = {str(key): value for key, value in json.load(f).items()}
+        if not op.isdir(path):
+            load_archive(path, batch_size=batch_size, user_keys=user_keys)
+            return
+        manifest = read_manifest(path)
+        if manifest is None:
+            raise CommandError("No backup chain in %s." % path)
+        # Replay the base archive and its deltas in order.
+        for archive in manifest['archives']:
+            load_archive(op.join(path, archive['file']), batch_size=batch_size,
+                         user_keys=user_keys)
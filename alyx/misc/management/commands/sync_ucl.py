@@ -0,0 +1,284 @@
+from datetime import datetime
+import json
+import logging
+import os
+import os.path as op
+import sys
+
+from dateutil.parser import parse
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Q
+
+from actions.models import Notification, Session, Surgery
+from data.models import Dataset, DatasetType, FileRecord
+from misc.backups import LOAD_BATCH_SIZE, change_field, get_models, iter_serialized, load_items
+from misc.models import Lab, LabLocation, Tombstone
+from misc.views import CHANGES_SAFETY_WINDOW
+from subjects.models import Subject
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)-15s %(message)s')
+
+# Objects matched between the two databases by a unique field rather than by primary key:
+# those existing in the target are not imported, and the references to them are remapped to
+# the primary keys of the target.
+MATCH_FIELDS = {
+    'data.dataformat': 'name',
+    'data.datarepository': 'name',
+    'data.datarepositorytype': 'name',
+    'data.datasettype': 'name',
+    'misc.lab': 'name',
+    'subjects.project': 'name',
+    'subjects.sequence': 'name',
+    settings.AUTH_USER_MODEL.lower(): 'username',
+}
+# Models never imported: the init fixtures, which are only matched, and the system tables.
+SYNC_EXCLUDE = ('admin.logentry', 'auth.group', 'auth.permission', 'authtoken', 'contenttypes',
+                'reversion', 'sessions',
+                'data.dataformat', 'data.datarepositorytype', 'data.datasettype', 'misc.lab',
+                'subjects.project',
+                'actions.notificationrule', 'misc.fieldhistory', 'misc.tombstone',
+                'subjects.subjectrequest',
+                )
+# Lab of the imported sessions and lab locations, created in the target if needed.
+UCL_LAB = {'pk': '4027da48-7be3-43ec-a222-f75dffe36872', 'name': 'cortexlab'}
+
+
+class UCLSync(object):
+    """Import the IBL objects of the UCL database, given by a second database alias, into the
+    default database.
+
+    The IBL subjects are those with a session in an IBL project; their objects are imported,
+    with the sessions of the IBL project, their datasets of the IBL dataset types and the
+    relevant users. With a `since` time, only the objects modified since then are imported,
+    plus all the objects of the subjects and sessions new to the target, and the objects
+    deleted since then in the source are deleted in the target.
+
+    """
+
+    def __init__(self, source='cortexlab', project='ibl_cortexlab', since=None, users=None):
+        self.source = source
+        self.project = project
+        self.since = since
+        # Usernames of the users always imported, in addition to the users of the imported
+        # subjects, sessions and datasets.
+        self.users = settings.SYNC_UCL_USERS if users is None else users
+        self.user_model = apps.get_model(settings.AUTH_USER_MODEL)
+        # Primary keys of the source matched objects => primary keys in the target.
+        self.pk_map = {}
+
+    def _match(self):
+        for label, field in MATCH_FIELDS.items():
+            model = apps.get_model(label)
+            target = {key: str(pk) for key, pk in model._base_manager.values_list(field, 'pk')}
+            for pk, key in model._base_manager.using(self.source).values_list('pk', field):
+                if key in target:
+                    self.pk_map[str(pk)] = target[key]
+        lab = Lab.objects.filter(name=UCL_LAB['name']).first() or Lab.objects.create(**UCL_LAB)
+        self.lab_pk = str(lab.pk)
+
+    def _new(self, queryset):
+        """Primary keys of the source objects that do not exist in the target."""
+        pks = list(queryset.values_list('pk', flat=True))
+        existing = set(queryset.model._base_manager.filter(pk__in=pks).
+                       values_list('pk', flat=True))
+        return [pk for pk in pks if pk not in existing]
+
+    def _select(self):
+        """Select the IBL subjects, sessions and users of the source."""
+        src = self.source
+        subjects = Subject.objects.using(src).filter(pk__in=Session.objects.using(src).filter(
+            project__name__icontains='ibl').values('subject'))
+        sessions = Session.objects.using(src).filter(
+            project__name=self.project, subject__in=subjects).exclude(type='Base')
+        dtypes = DatasetType.objects.exclude(name__iexact='unknown').values_list('name')
+        self.dtypes = [name for name, in dtypes]
+        datasets = Dataset.objects.using(src).filter(
+            session__in=sessions, dataset_type__name__in=self.dtypes)
+        surgeries = Surgery.objects.using(src).filter(subject__in=subjects)
+        users = self.user_model._base_manager.using(src).filter(
+            Q(username__in=self.users) |
+            Q(pk__in=datasets.values('created_by')) |
+            Q(pk__in=sessions.values('users')) |
+            Q(pk__in=subjects.values('responsible_user')) |
+            Q(pk__in=surgeries.values('users')))
+        # Source querysets and primary keys of the selected objects, that the other objects
+        # may reference.
+        self.selected = {Subject: subjects, Session: sessions, self.user_model: users}
+        self.selected_pks = {model: {str(pk) for pk in queryset.values_list('pk', flat=True)}
+                             for model, queryset in self.selected.items()}
+        # The objects of the subjects and sessions new to the target are all imported.
+        self.new = {Subject: self._new(subjects), Session: self._new(sessions)} \
+            if self.since else {}
+
+    def _querysets(self):
+        """Yield the source querysets of the objects to import, for every model."""
+        for model in get_models(exclude=SYNC_EXCLUDE):
+            if model is self.user_model:
+                continue
+            queryset = self.selected.get(model, model._base_manager.using(self.source).all())
+            new = [Q(pk__in=self.new[model])] if model in self.new else []
+            # The objects that cannot exist without an unselected object are not imported.
+            for field in model._meta.concrete_fields:
+                related = field.related_model if field.is_relation else None
+                if related in self.selected and not field.null and related is not model:
+                    queryset = queryset.filter(**{'%s__in' % field.name: self.selected[related]})
+                    if related in self.new:
+                        new.append(Q(**{'%s__in' % field.name: self.new[related]}))
+            if model is Dataset:
+                queryset = queryset.filter(
+                    session__in=self.selected[Session], dataset_type__name__in=self.dtypes)
+                if self.since:
+                    new.append(Q(session__in=self.new[Session]))
+            elif model is FileRecord:
+                queryset = queryset.filter(
+                    dataset__session__in=self.selected[Session],
+                    dataset__dataset_type__name__in=self.dtypes)
+                if self.since:
+                    new.append(Q(dataset__session__in=self.new[Session]))
+            elif model is Notification:
+                # The notifications not sent yet are sent by UCL.
+                queryset = queryset.filter(sent_at__isnull=False)
+            field = change_field(model)
+            if self.since and field:
+                changed = Q(**{'%s__gte' % field: self.since})
+                for q in new:
+                    changed |= q
+                queryset = queryset.filter(changed)
+            yield model, queryset.order_by('pk')
+
+    def _remap(self, field, value):
+        """Return the primary key of the target referenced by a relation, or None when the
+        referenced object is not imported."""
+        related = field.related_model
+        if related in self.selected_pks and str(value) not in self.selected_pks[related]:
+            return None
+        return self.pk_map.get(str(value), value)
+
+    def _transform(self, model, item):
+        fields = item['fields']
+        for field in model._meta.concrete_fields + model._meta.many_to_many:
+            if not field.is_relation or fields.get(field.name, None) is None:
+                continue
+            if field.many_to_many:
+                fields[field.name] = [pk for pk in (self._remap(field, pk)
+                                                    for pk in fields[field.name])
+                                      if pk is not None]
+            else:
+                fields[field.name] = self._remap(field, fields[field.name])
+        if model is Session:
+            # The base sessions are not imported.
+            fields['lab'] = self.lab_pk
+            fields['parent_session'] = None
+        elif model is LabLocation:
+            fields['lab'] = self.lab_pk
+        elif model is Subject:
+            # The subject requests are not imported.
+            fields['request'] = None
+        return item
+
+    def _iter_users(self):
+        for item in iter_serialized(self.selected[self.user_model].order_by('pk')):
+            if str(item['pk']) in self.pk_map:
+                continue
+            # The groups and permissions are specific to each database.
+            item['fields']['groups'] = []
+            item['fields']['user_permissions'] = []
+            yield item
+
+    def _iter_deletions(self, labels):
+        if self.since:
+            tombstones = Tombstone.objects.using(self.source).filter(
+                deleted_datetime__gte=self.since).select_related('content_type')
+            for tombstone in tombstones.iterator():
+                label = '%s.%s' % (tombstone.content_type.app_label,
+                                   tombstone.content_type.model)
+                if label in labels:
+                    yield {'model': label, 'pk': str(tombstone.object_id), 'deleted': True}
+            return
+        # Full synchronization: the IBL sessions removed at UCL are removed.
+        source = set(Session.objects.using(self.source).values_list('pk', flat=True))
+        for pk in Session.objects.filter(project__name=self.project).values_list(
+                'pk', flat=True):
+            if pk not in source:
+                yield {'model': 'actions.session', 'pk': str(pk), 'deleted': True}
+
+    def cursor(self):
+        """Return the time of the next sync: the last change or deletion in the source, minus
+        the safety window, or `since` when the source has none. It is to be computed before
+        reading the objects, so that the changes made during the sync are imported next time.
+        """
+        last = []
+        for model in get_models(exclude=SYNC_EXCLUDE) + [Tombstone]:
+            field = change_field(model)
+            if field:
+                last.append(model._base_manager.using(self.source).aggregate(
+                    last=Max(field))['last'])
+        last = [value for value in last if value is not None]
+        if not last:
+            return self.since
+        cursor = max(last) - CHANGES_SAFETY_WINDOW
+        return max(self.since, cursor) if self.since else cursor
+
+    def iter_items(self):
+        """Yield the serialized objects to import into the target, then the deleted ones."""
+        self._match()
+        self._select()
+        labels = set()
+        for model, queryset in self._querysets():
+            labels.add(model._meta.label_lower)
+            for item in iter_serialized(queryset):
+                if str(item['pk']) in self.pk_map:
+                    continue
+                yield self._transform(model, item)
+        yield from self._iter_users()
+        yield from self._iter_deletions(labels)
+
+
+def _load_state(path):
+    if not path or not op.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _save_state(path, state):
+    os.makedirs(op.dirname(op.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+class Command(BaseCommand):
+    help = "Import the changes of the IBL objects of the UCL database since the last sync"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default='cortexlab',
+                            help="Database alias of the UCL database")
+        parser.add_argument('--project', default='ibl_cortexlab',
+                            help="Project of the imported sessions")
+        parser.add_argument('--state', default=op.join(settings.STATE_ROOT, 'sync_ucl.json'),
+                            help="File keeping the time of the last sync, by default in the "
+                            "STATE_ROOT setting directory")
+        parser.add_argument('--users', nargs='*',
+                            help="Users always imported, SYNC_UCL_USERS setting by default")
+        parser.add_argument('--full', action='store_true', default=False,
+                            help="Import all objects, whatever the time of the last sync")
+        parser.add_argument('--batch-size', type=int, default=LOAD_BATCH_SIZE,
+                            help="Number of objects inserted at once")
+
+    def handle(self, *args, **options):
+        path = options.get('state')
+        state = {} if options.get('full') else _load_state(path)
+        since = parse(state['cursor']) if state.get('cursor', None) else None
+        logger.info("Synchronizing %s since %s.", options.get('source'), since or 'the start')
+        sync = UCLSync(source=options.get('source'), project=options.get('project'),
+                       since=since, users=options.get('users'))
+        # The cursor comes from the clock of the source, not from the local one.
+        cursor = sync.cursor()
+        load_items(sync.iter_items(), batch_size=options.get('batch_size'),
+                   name=options.get('source'))
+        _save_state(path, {'cursor': cursor.isoformat() if cursor else None,
+                           'date': datetime.now().isoformat()})
@@ -0,0 +1,54 @@
+# Generated by Django 2.1.4 on 2019-02-04 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def backfill_auto_datetime(apps, schema_editor):
+    """Set the auto_datetime of the existing objects, so that they appear in the changes feed."""
+    now = django.utils.timezone.now()
+    for model in apps.get_app_config('misc').get_models():
+        if any(field.name == 'auto_datetime' for field in model._meta.local_fields):
+            model._base_manager.filter(auto_datetime__isnull=True).update(auto_datetime=now)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('misc', '0003_auto_20190124_1025'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('object_id', models.UUIDField()),
+                ('deleted_datetime', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='lab',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='labmembership',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='lablocation',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.RunPython(backfill_auto_datetime, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.1.4 on 2019-02-18 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('misc', '0004_auto_datetime'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FieldHistory',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('object_id', models.UUIDField()),
+                ('field_name', models.CharField(max_length=64)),
+                ('value', models.TextField(blank=True, null=True)),
+                ('date_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name_plural': 'field history',
+                'ordering': ('date_time', 'id'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='fieldhistory',
+            index=models.Index(fields=['object_id', 'field_name', 'date_time'], name='misc_fieldh_object__729a8b_idx'),
+        ),
+    ]
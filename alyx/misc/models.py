@@ -12,6 +12,8 @@ from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
 from alyx.base import BaseModel, modify_fields
@@ -127,3 +129,64 @@ class Note(BaseModel):
                     super(Note, self).save()
         else:
             super(Note, self).save()
+
+
+class Tombstone(models.Model):
+    """
+    Trace of a deleted object, so that the change feed can propagate deletions to mirrors.
+    """
+    id = models.BigAutoField(primary_key=True)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.UUIDField()
+    deleted_datetime = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return "<Tombstone %s %s>" % (self.content_type, self.object_id)
+
+
+class FieldHistory(models.Model):
+    """
+    Previous value of a tracked field of an object, appended when the field changes. The
+    value was current until date_time.
+    """
+    id = models.BigAutoField(primary_key=True)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.UUIDField()
+    content_object = GenericForeignKey()
+    field_name = models.CharField(max_length=64)
+    value = models.TextField(null=True, blank=True)
+    date_time = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ('date_time', 'id')
+        verbose_name_plural = 'field history'
+        indexes = [models.Index(fields=['object_id', 'field_name', 'date_time'])]
+
+    def __str__(self):
+        return "<FieldHistory %s %s.%s>" % (self.content_type, self.object_id, self.field_name)
+
+    @staticmethod
+    def for_object(obj, field_name=None):
+        qs = FieldHistory.objects.filter(
+            content_type=ContentType.objects.get_for_model(obj), object_id=obj.pk)
+        if field_name:
+            qs = qs.filter(field_name=field_name)
+        return qs
+
+    @staticmethod
+    def value_at(obj, field_name, date_time):
+        """Return the value, as a string, of a field of an object at a given time, using a
+        single indexed query."""
+        h = FieldHistory.for_object(obj, field_name).filter(date_time__gt=date_time).first()
+        if h is not None:
+            return h.value
+        value = getattr(obj, obj._meta.get_field(field_name).attname)
+        return str(value) if value is not None else None
+
+
+@receiver(post_delete)
+def create_tombstone(sender, instance, **kwargs):
+    if not isinstance(instance, BaseModel):
+        return
+    Tombstone.objects.create(content_type=ContentType.objects.get_for_model(sender),
+                             object_id=instance.pk)
@@ -1,3 +1,256 @@
-# from django.test import TestCase
+import datetime
+import gzip
+import importlib.util
+from io import StringIO
+import json
+import os.path as op
+import tempfile
+import unittest
+from unittest import mock
+import uuid
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from actions.models import Notification, Session, WaterRestriction, Weighing
+from alyx.base import DATA_DIR
+from misc.backups import iter_json_array, read_manifest, remap_users
+from misc.compression import EXTENSIONS, open_text
+from misc.management.commands.dump import _anonymize_item
+from misc.management.commands.sync_ucl import UCLSync
+from misc.models import Lab, LabMember, Tombstone
+from misc.views import CHANGES_SAFETY_WINDOW
+from subjects.models import Project, Subject
+
+
+class ReportTests(TestCase):
+    def setUp(self):
+        self.lab = Lab.objects.create(name='reportlab', reference_weight_pct=.85)
+        self.date = timezone.now() - datetime.timedelta(days=10)
+
+    def _add_user(self, i):
+        user = LabMember.objects.create(username='user%d' % i, email='user%d@test' % i)
+        for j in range(2):
+            subject = Subject.objects.create(
+                nickname='mouse%d_%d' % (i, j), birth_date='2018-01-01', lab=self.lab,
+                responsible_user=user)
+            Weighing.objects.create(subject=subject, weight=20, date_time=self.date)
+            WaterRestriction.objects.create(
+                subject=subject, start_time=self.date, reference_weight=20)
+            # Underweight since yesterday.
+            Weighing.objects.create(subject=subject, weight=15,
+                                    date_time=timezone.now() - datetime.timedelta(days=1))
+
+    def _report(self):
+        out = StringIO()
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('report', 'water_restriction', 'mouse_weight', 'surgery',
+                         'past_changes', 'training', 'todo', no_email=True, stdout=out)
+        return out.getvalue(), len(ctx.captured_queries)
+
+    def test_report_queries(self):
+        self._add_user(0)
+        text, n_queries = self._report()
+        self.assertTrue('Mice on water restriction' in text)
+        self.assertTrue('* mouse0_1 (user0 <user0@test>) weighed 15.0g' in text)
+        self.assertTrue('Mice awaiting surgery:\n* mouse0_0\n* mouse0_1' in text)
+        # The number of queries does not depend on the number of users and subjects.
+        for i in range(1, 4):
+            self._add_user(i)
+        text, n_queries_more = self._report()
+        self.assertTrue('* mouse3_0 (user3 <user3@test>) weighed 15.0g' in text)
+        self.assertEqual(n_queries_more, n_queries)
+
+
+class DumpTests(TestCase):
+    def test_dump_gzip(self):
+        Lab.objects.create(name='dumplab')
+        LabMember.objects.create(username='dumper', password='secret')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = op.join(tmpdir, 'dump.json.gz')
+            call_command('dump', '-o', path)
+            with gzip.open(path, 'rt') as f:
+                items = json.load(f)
+        labs = [item['fields']['name'] for item in items if item['model'] == 'misc.lab']
+        self.assertTrue('dumplab' in labs)
+        self.assertFalse(any(item['model'].startswith('contenttypes.') for item in items))
+
+    def test_anonymize_item(self):
+        item = {'model': 'misc.labmember', 'pk': 'abcdef-123',
+                'fields': {'username': 'me', 'password': 'secret', 'email': 'me@test',
+                           'description': 'private', 'user_permissions': [1]}}
+        fields = _anonymize_item(item)['fields']
+        self.assertEqual(fields['username'], 'abcdef')
+        self.assertEqual(fields['password'], '')
+        self.assertEqual(fields['email'], '')
+        self.assertEqual(fields['description'], '-')
+        self.assertEqual(fields['user_permissions'], [])
+
+    def test_incremental_dump_restore(self):
+        self._test_incremental_dump_restore('gzip')
+
+    @unittest.skipIf(importlib.util.find_spec('zstandard') is None, "requires zstandard")
+    def test_incremental_dump_restore_zstd(self):
+        self._test_incremental_dump_restore('zstd')
+
+    def _test_incremental_dump_restore(self, compression):
+        lab1 = Lab.objects.create(name='lab1')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            call_command('dump', '--incremental', '-o', tmpdir, compression=compression,
+                         stdout=StringIO())
+            lab2 = Lab.objects.create(name='lab2')
+            lab1.delete()
+            call_command('dump', '--incremental', '-o', tmpdir, compression=compression,
+                         stdout=StringIO())
+
+            archives = read_manifest(tmpdir)['archives']
+            self.assertEqual(len(archives), 2)
+            self.assertEqual(archives[1]['since'], archives[0]['cursor'])
+            self.assertTrue(archives[1]['file'].endswith('.json' + EXTENSIONS[compression]))
+            with open_text(op.join(tmpdir, archives[1]['file'])) as f:
+                delta = [(item['model'], item['pk'], item.get('deleted', False))
+                         for item in iter_json_array(f) if item['model'] == 'misc.lab']
+            self.assertTrue(('misc.lab', str(lab2.pk), False) in delta)
+            self.assertTrue(('misc.lab', str(lab1.pk), True) in delta)
+
+            # Replaying the base and the delta.
+            lab2.delete()
+            call_command('restore', tmpdir)
+        self.assertTrue(Lab.objects.filter(pk=lab2.pk).exists())
+        self.assertFalse(Lab.objects.filter(pk=lab1.pk).exists())
+        # The replayed deletions do not duplicate the restored tombstones.
+        self.assertEqual(Tombstone.objects.filter(object_id=lab1.pk).count(), 1)
+
+    def test_restore_fixture(self):
+        path = op.join(DATA_DIR, 'all_dumped_anon.json.gz')
+        with open_text(path) as f:
+            n_subjects = sum(1 for item in iter_json_array(f)
+                             if item['model'] == 'subjects.subject')
+        call_command('restore', path)
+        self.assertEqual(Subject.objects.count(), n_subjects)
+        # The save() methods and the signals are bypassed.
+        self.assertEqual(Notification.objects.count(), 0)
+        # Restoring again updates the existing objects.
+        call_command('restore', path, batch_size=100)
+        self.assertEqual(Subject.objects.count(), n_subjects)
+
+    def test_iter_json_array(self):
+        items = [{'a': i, 'b': 'x' * i} for i in range(100)]
+        f = StringIO(json.dumps(items, indent=1))
+        self.assertEqual(list(iter_json_array(f, buffer_size=7)), items)
+        self.assertEqual(list(iter_json_array(StringIO(' [ ] '))), [])
+
+    def test_remap_users(self):
+        items = [{'model': 'misc.labmember', 'pk': 1, 'fields': {'username': 'a'}},
+                 {'model': 'subjects.subject', 'pk': 'x',
+                  'fields': {'responsible_user': 1, 'lab': 2}},
+                 {'model': 'actions.session', 'pk': 'y', 'fields': {'users': [1, 3]}}]
+        user_keys = {'1': 'uuid1'}
+        items = list(remap_users(iter(items), user_keys, new_key=lambda pk: 'uuid%d' % pk))
+        self.assertEqual(items[0]['pk'], 'uuid1')
+        self.assertEqual(items[1]['fields'], {'responsible_user': 'uuid1', 'lab': 2})
+        self.assertEqual(items[2]['fields']['users'], ['uuid1', 'uuid3'])
+        self.assertEqual(user_keys['3'], 'uuid3')
+
+
+class SyncUCLTests(TestCase):
+    def setUp(self):
+        self.lab = Lab.objects.create(name='synclab')
+        self.user = LabMember.objects.create(username='syncer')
+        self.project = Project.objects.create(name='ibl_sync')
+        self.ibl = Subject.objects.create(
+            nickname='ibl', birth_date='2018-01-01', lab=self.lab, responsible_user=self.user)
+        self.other = Subject.objects.create(
+            nickname='other', birth_date='2018-01-01', lab=self.lab, responsible_user=self.user)
+        self.session = Session.objects.create(
+            subject=self.ibl, project=self.project, type='Experiment', start_time=timezone.now())
+        for subject in (self.ibl, self.other):
+            Weighing.objects.create(subject=subject, weight=20, date_time=timezone.now())
+
+    def _sync(self, since=None, users=()):
+        # The default database stands for the source: the matched objects are their own
+        # targets.
+        sync = UCLSync(source='default', project='ibl_sync', since=since, users=users)
+        sync._match()
+        sync._select()
+        return sync
+
+    def test_querysets(self):
+        querysets = dict(self._sync()._querysets())
+        self.assertEqual(list(querysets[Subject]), [self.ibl])
+        self.assertEqual(list(querysets[Session]), [self.session])
+        # The weighings require their subject, which is not imported for the other subject.
+        self.assertEqual([w.subject for w in querysets[Weighing]], [self.ibl])
+        # The matched models and the tombstones are not imported, the users are separately.
+        for model in (Lab, LabMember, Project, Tombstone):
+            self.assertFalse(model in querysets)
+
+    def test_users(self):
+        extra = LabMember.objects.create(username='sync_extra')
+        LabMember.objects.create(username='sync_other')
+        users = self._sync(users=['sync_extra']).selected[LabMember]
+        self.assertEqual(set(users), {self.user, extra})
+
+    def test_remap(self):
+        sync = self._sync()
+        field = Weighing._meta.get_field('subject')
+        self.assertEqual(sync._remap(field, self.ibl.pk), self.ibl.pk)
+        self.assertIsNone(sync._remap(field, self.other.pk))
+        # The matched objects are replaced by their target.
+        field = Subject._meta.get_field('lab')
+        self.assertEqual(sync._remap(field, self.lab.pk), str(self.lab.pk))
+
+    def test_match(self):
+        sync = self._sync()
+        self.assertEqual(sync.pk_map[str(self.project.pk)], str(self.project.pk))
+        # A source project with another primary key is replaced by the target one.
+        source_pk = str(uuid.uuid4())
+        sync.pk_map[source_pk] = str(self.project.pk)
+        item = {'model': 'actions.session', 'pk': str(uuid.uuid4()),
+                'fields': {'subject': str(self.ibl.pk), 'project': source_pk,
+                           'users': [str(self.user.pk)], 'lab': str(self.lab.pk)}}
+        fields = sync._transform(Session, item)['fields']
+        self.assertEqual(fields['project'], str(self.project.pk))
+        self.assertEqual(fields['users'], [str(self.user.pk)])
+        self.assertEqual(fields['lab'], sync.lab_pk)
+        # The matched users are not imported.
+        self.assertFalse(any(item['model'] == 'misc.labmember' for item in sync.iter_items()))
+
+    def test_since(self):
+        since = timezone.now()
+        weighing = Weighing.objects.create(subject=self.ibl, weight=21, date_time=since)
+        querysets = dict(self._sync(since=since)._querysets())
+        self.assertEqual(list(querysets[Weighing]), [weighing])
+        self.assertEqual(list(querysets[Session]), [])
+        # All the objects of the subjects new to the target are imported.
+        ibl = self.ibl
+        with mock.patch.object(UCLSync, '_new', lambda sync, queryset: (
+                [ibl.pk] if queryset.model is Subject else [])):
+            querysets = dict(self._sync(since=since)._querysets())
+        self.assertEqual(list(querysets[Subject]), [self.ibl])
+        self.assertEqual(list(querysets[Session]), [self.session])
+        self.assertEqual(querysets[Weighing].count(), 2)
+
+    def test_deletions(self):
+        since = timezone.now()
+        weighing = self.ibl.weighings.get()
+        weighing.delete()
+        sync = self._sync(since=since)
+        self.assertEqual(list(sync._iter_deletions({'actions.weighing'})),
+                         [{'model': 'actions.weighing', 'pk': str(weighing.pk), 'deleted': True}])
+        # Only the deletions of the imported models, since the last sync, are propagated.
+        self.assertEqual(list(sync._iter_deletions({'actions.session'})), [])
+        sync.since = timezone.now()
+        self.assertEqual(list(sync._iter_deletions({'actions.weighing'})), [])
+
+    def test_cursor(self):
+        self.other.weighings.get().delete()
+        tombstone = Tombstone.objects.latest('deleted_datetime')
+        sync = self._sync()
+        self.assertEqual(sync.cursor(), tombstone.deleted_datetime - CHANGES_SAFETY_WINDOW)
+        # The cursor never goes back.
+        sync.since = timezone.now()
+        self.assertEqual(sync.cursor(), sync.since)
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.urls import reverse
 from django.contrib.auth import get_user_model
@@ -42,3 +42,40 @@ class APIActionsTests(BaseTests):
     def test_user_rest(self):
         response = self.client.get(reverse('user-list') + '/test')
         self.ar(response, 200)
+
+    def test_changes(self):
+        r = self.client.get(reverse('changes') + '?since=2000-01-01')
+        self.ar(r, 200)
+        cursor = r.data['cursor']
+        self.assertTrue(str(self.lab.pk) in map(str, r.data['changes']['misc.lab']['saved']))
+
+        # Deletions are listed from the tombstones.
+        lab = Lab.objects.create(name='attic')
+        pk = lab.pk
+        lab.delete()
+        r = self.client.get(reverse('changes') + '?since=%s&models=misc.lab' % cursor.isoformat())
+        self.ar(r, 200)
+        self.assertEqual(list(r.data['changes']), ['misc.lab'])
+        self.assertTrue(pk in r.data['changes']['misc.lab']['deleted'])
+
+    def test_changes_pages(self):
+        for i in range(3):
+            Lab.objects.create(name='lab%d' % i)
+        # Changes older than the safety window.
+        for i, pk in enumerate(Lab.objects.values_list('pk', flat=True)):
+            date = datetime(2010, 1, 1) + timedelta(days=i)
+            Lab.objects.filter(pk=pk).update(auto_datetime=date)
+        # An aware since is accepted.
+        url = reverse('changes') + '?models=misc.lab&limit=2&since=2000-01-01T00:00:00Z'
+        r = self.client.get(url)
+        self.ar(r, 200)
+        self.assertTrue(r.data['more'])
+        self.assertTrue(len(r.data['changes']['misc.lab']['saved']) >= 2)
+        # Following the cursor lists all the labs.
+        pks = set(r.data['changes']['misc.lab']['saved'])
+        while r.data['more']:
+            r = self.client.get(reverse('changes') + '?models=misc.lab&limit=2&since=%s' %
+                                r.data['cursor'].isoformat())
+            self.ar(r, 200)
+            pks.update(r.data['changes'].get('misc.lab', {}).get('saved', []))
+        self.assertEqual(pks, set(Lab.objects.values_list('pk', flat=True)))
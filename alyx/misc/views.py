@@ -1,8 +1,13 @@
+from datetime import timedelta
 import os.path as op
 
+from dateutil.parser import parse
 import magic
+from django.apps import apps
 from django.contrib.auth import get_user_model
+from django.db.models import Q
 from django.http import HttpResponse
+from django.utils import timezone
 
 from rest_framework import viewsets, views
 from rest_framework.response import Response
@@ -10,8 +15,10 @@ from rest_framework.decorators import api_view
 from rest_framework.reverse import reverse
 from rest_framework import generics, permissions
 
+from subjects.models import Subject
 from .serializers import UserSerializer, LabSerializer
-from .models import Lab
+from .models import Lab, LabMembership, Tombstone
+from alyx.base import BaseModel, CachedListMixin, ConditionalDetailMixin
 from alyx.settings import MEDIA_ROOT
 
 
@@ -52,13 +59,15 @@ def api_root(request, format=None):
         'water-administrations-url': reverse(
             'water-administration-create', request=request, format=format),
 
+        'changes-url': reverse('changes', request=request, format=format),
+
         #'water-requirement-url': reverse(
         #    'water-requirement', request=request, format=format),
 
     })
 
 
-class UserViewSet(viewsets.ReadOnlyModelViewSet):
+class UserViewSet(CachedListMixin, viewsets.ReadOnlyModelViewSet):
     """
     Lists all users with the subjects which they are responsible for.
     """
@@ -67,22 +76,111 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = UserSerializer
     lookup_field = 'username'
     permission_classes = (permissions.IsAuthenticated,)
+    cache_models = (get_user_model(), Subject, Lab, LabMembership)
 
 
-class LabList(generics.ListCreateAPIView):
+class LabList(CachedListMixin, generics.ListCreateAPIView):
     queryset = Lab.objects.all()
     serializer_class = LabSerializer
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = 'name'
 
 
-class LabDetail(generics.RetrieveUpdateDestroyAPIView):
+class LabDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Lab.objects.all()
     serializer_class = LabSerializer
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = 'name'
 
 
+# Objects saved by transactions still running when the feed is queried may commit later with
+# an earlier timestamp: the returned cursor never gets closer than this to the current time.
+CHANGES_SAFETY_WINDOW = timedelta(seconds=60)
+# Default maximum number of changes returned by one call of the changes feed.
+CHANGES_LIMIT = 10000
+
+
+def _changed_models(labels=None):
+    for model in apps.get_models():
+        if not issubclass(model, BaseModel) or model._meta.proxy:
+            continue
+        if labels and model._meta.label_lower not in labels:
+            continue
+        yield model
+
+
+class ChangesView(views.APIView):
+    """
+    Lists, per model, the ids of the objects saved (created or updated) and deleted since
+    a cursor, in the order of the changes: `GET /changes?since=2019-01-01T12:00:00`.
+    The optional `models` parameter restricts the feed to some models, for example
+    `?models=subjects.subject,actions.session`.
+
+    Pass the returned `cursor` as `since` in the next call. At most `limit` changes are
+    returned (10000 by default, more when several changes share the last timestamp): `more`
+    is then true and the cursor continues after the returned changes, unless they reach the
+    safety window. As the cursor lags behind the current time by this safety window, objects
+    may be listed again in successive calls.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request=None, format=None):
+        since = request.query_params.get('since', None)
+        if not since:
+            raise ValueError("The since argument is required.")
+        since = parse(since)
+        if timezone.is_aware(since):
+            since = timezone.make_naive(since)
+        limit = int(request.query_params.get('limit', CHANGES_LIMIT))
+        if limit <= 0:
+            raise ValueError("The limit argument must be positive.")
+        labels = request.query_params.get('models', None)
+        labels = set(labels.lower().split(',')) if labels else None
+        cursor = max(since, timezone.now() - CHANGES_SAFETY_WINDOW)
+
+        saved = {model: model._base_manager.filter(auto_datetime__gte=since)
+                 for model in _changed_models(labels)}
+        tombstones = Tombstone.objects.filter(deleted_datetime__gte=since)
+        if labels:
+            in_labels = Q(pk__in=[])
+            for label in labels:
+                app_label, _, model_name = label.partition('.')
+                in_labels |= Q(content_type__app_label=app_label,
+                               content_type__model=model_name)
+            tombstones = tombstones.filter(in_labels)
+
+        # The timestamp of the limit-th change is among the first limit changes of each table.
+        dates = [d for queryset in saved.values() for d in queryset.order_by(
+            'auto_datetime').values_list('auto_datetime', flat=True)[:limit + 1]]
+        dates += tombstones.order_by('deleted_datetime').values_list(
+            'deleted_datetime', flat=True)[:limit + 1]
+        more = len(dates) > limit
+        if more:
+            # All the changes at the last timestamp are returned, so that the next call
+            # starts strictly after it.
+            until = sorted(dates)[limit - 1]
+            saved = {model: queryset.filter(auto_datetime__lte=until)
+                     for model, queryset in saved.items()}
+            tombstones = tombstones.filter(deleted_datetime__lte=until)
+            if until + timedelta(microseconds=1) <= cursor:
+                cursor = max(since, until + timedelta(microseconds=1))
+            else:
+                # The rest is within the safety window: it will be listed by later calls.
+                more = False
+
+        changes = {}
+        for model, queryset in saved.items():
+            pks = list(queryset.order_by('auto_datetime').values_list('pk', flat=True))
+            if pks:
+                changes[model._meta.label_lower] = {'saved': pks, 'deleted': []}
+        tombstones = tombstones.select_related('content_type').order_by('deleted_datetime')
+        for tombstone in tombstones:
+            label = '%s.%s' % (tombstone.content_type.app_label, tombstone.content_type.model)
+            changes.setdefault(label, {'saved': [], 'deleted': []})
+            changes[label]['deleted'].append(tombstone.object_id)
+        return Response({'since': since, 'cursor': cursor, 'more': more, 'changes': changes})
+
+
 class UploadedView(views.APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
@@ -5,18 +5,21 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
-from django.db.models import Case, When
+from django.db.models import (Case, Count, Exists, IntegerField, OuterRef, Q, Subquery,
+                              When)
+from django.db.models.functions import Coalesce
 from django.forms import BaseInlineFormSet
 from django.utils.html import format_html
 from django.urls import reverse
 
 from alyx.base import (BaseAdmin, BaseInlineAdmin, DefaultListFilter, get_admin_url,
-                       _iter_history_changes)
+                       _iter_history_changes, bump_table_version)
 from .models import (Allele, BreedingPair, GenotypeTest, Line, Litter, Sequence, Source,
                      Species, Strain, Subject, SubjectRequest, Zygosity, ZygosityRule,
-                     Project,
+                     Project, bulk_create_subjects,
                      )
 from actions.models import Surgery, Session, OtherAction
+from actions.water_control import prefetch_water_control
 from misc.models import LabMember
 from misc.admin import NoteInline
 
@@ -97,19 +100,18 @@ class BreederListFilter(DefaultListFilter):
         )
 
     def queryset(self, request, queryset):
-        if self.value == 'all':
+        if self.value() == 'all':
             return queryset.all()
-        bp = BreedingPair.objects.filter(start_date__isnull=False,
-                                         end_date__isnull=True,
-                                         )
-        f = bp.filter(father__isnull=False).values_list('father', flat=True)
-        m1 = bp.filter(mother1__isnull=False).values_list('mother1', flat=True)
-        m2 = bp.filter(mother2__isnull=False).values_list('mother2', flat=True)
-        subjects = f.union(m1, m2)
+        # Current breeding pairs of which the subject is a parent.
+        bp = BreedingPair.objects.filter(
+            Q(father=OuterRef('pk')) | Q(mother1=OuterRef('pk')) | Q(mother2=OuterRef('pk')),
+            start_date__isnull=False, end_date__isnull=True,
+        )
+        queryset = queryset.annotate(is_breeder=Exists(bp))
         if self.value() is None:
-            return queryset.exclude(pk__in=subjects)
+            return queryset.filter(is_breeder=False)
         elif self.value() == 'yes':
-            return queryset.filter(pk__in=subjects)
+            return queryset.filter(is_breeder=True)
 
 
 class ZygosityFilter(DefaultListFilter):
@@ -127,12 +129,14 @@ class ZygosityFilter(DefaultListFilter):
         if self.value() is None:
             return queryset.all()
         elif self.value() in ('p', 'h'):
-            # Only keep subjects with a non-null geontype.
-            queryset = queryset.filter(genotype__isnull=False).distinct()
-            # Exclude subjects that have a specific zygosity/
+            zygosities = Zygosity.objects.filter(subject=OuterRef('pk'))
+            # Exclude subjects that have a specific zygosity.
             d = dict(zygosity=0) if self.value() == 'p' else dict(zygosity__in=(0, 1, 3))
-            nids = set([z.subject.id.hex for z in Zygosity.objects.filter(**d)])
-            return queryset.exclude(pk__in=nids)
+            # Only keep subjects with a non-null genotype.
+            return queryset.annotate(
+                has_genotype=Exists(zygosities),
+                has_excluded_zygosity=Exists(zygosities.filter(**d)),
+            ).filter(has_genotype=True, has_excluded_zygosity=False)
 
 
 class TodoFilter(DefaultListFilter):
@@ -335,8 +339,9 @@ class SubjectAdmin(BaseAdmin):
                ]
 
     def session_count(self, sub):
-        return Session.objects.filter(subject=sub).count()
+        return sub.session_count
     session_count.short_description = '# sess'
+    session_count.admin_order_field = 'session_count'
 
     def weight_percent(self, sub):
         wc = sub.water_control
@@ -419,10 +424,29 @@ class SubjectAdmin(BaseAdmin):
         return format_html('<br />\n'.join(_iter_history_changes(obj, 'cage')))
 
     def get_queryset(self, request):
-        return super(SubjectAdmin, self).get_queryset(request).select_related(
+        # The list columns are computed from annotations and prefetched data, so that the
+        # number of queries does not depend on the number of subjects on the page.
+        sessions = Session.objects.filter(subject=OuterRef('pk')).order_by().values(
+            'subject').annotate(n=Count('pk')).values('n')
+        qs = super(SubjectAdmin, self).get_queryset(request).select_related(
             'request', 'request__user'
         ).prefetch_related(
-            'zygosity_set')
+            'zygosity_set__allele', 'line__alleles',
+        ).annotate(
+            session_count=Coalesce(Subquery(sessions, output_field=IntegerField()), 0))
+        return prefetch_water_control(qs)
+
+    def formfield_for_dbfield(self, db_field, **kwargs):
+        user = kwargs['request'].user
+        if db_field.name == 'responsible_user':
+            kwargs['initial'] = user
+        field = super(SubjectAdmin, self).formfield_for_dbfield(db_field, **kwargs)
+        if db_field.name == 'responsible_user' and field is not None:
+            # Evaluate the choices once, instead of once per row of the editable list.
+            choices = list(field.choices)
+            field.choices = choices
+            getattr(field.widget, 'widget', field.widget).choices = choices
+        return field
 
     def get_form(self, request, obj=None, **kwargs):
         # just save obj reference for future processing in Inline
@@ -439,12 +463,6 @@ class SubjectAdmin(BaseAdmin):
 
         return AdminFormWithRequest
 
-    def formfield_for_dbfield(self, db_field, **kwargs):
-        user = kwargs['request'].user
-        if db_field.name == 'responsible_user':
-            kwargs['initial'] = user
-        return super(SubjectAdmin, self).formfield_for_dbfield(db_field, **kwargs)
-
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == 'request' and request.resolver_match:
             try:
@@ -769,14 +787,24 @@ class BreedingPairAdmin(BaseAdmin):
         obj = formset.instance
         line = obj.line
         # Set the line of all inline litters.
+        new_litters = []
         for instance in instances:
             if isinstance(instance, Litter):
                 instance.line = line
+                if instance._state.adding:
+                    new_litters.append(instance)
+                    continue
             elif isinstance(instance, Subject):
                 # Default user is the logged user.
                 if instance.responsible_user is None:
                     instance.responsible_user = request.user
             instance.save()
+        # Name and insert the new litters in bulk.
+        if new_litters:
+            if line:
+                line.set_autonames(new_litters)
+            Litter.objects.bulk_create(new_litters)
+            bump_table_version(Litter)
         formset.save_m2m()
 
 
@@ -830,6 +858,7 @@ class LitterAdmin(BaseAdmin):
         to_copy = 'species,strain,source'.split(',')
         user = (father.responsible_user
                 if father and father.responsible_user else request.user)
+        new_subjects = []
         for instance in instances:
             # Copy the birth date and breeding_pair from the litter.
             instance.breeding_pair = bp
@@ -840,7 +869,12 @@ class LitterAdmin(BaseAdmin):
             # Copy some fields from the mother to the subject.
             for field in to_copy:
                 setattr(instance, field, getattr(father, field, None))
-            instance.save()
+            if instance._state.adding:
+                new_subjects.append(instance)
+            else:
+                instance.save()
+        # Name and insert the new subjects in bulk.
+        bulk_create_subjects(new_subjects)
         formset.save_m2m()
 
 
@@ -1,6 +1,21 @@
+from collections import OrderedDict
+import json
+import logging
+from multiprocessing import Pool
+import os
+import os.path as op
+import time
+
+from django.conf import settings
 from django.core.management import BaseCommand
-from subjects.models import (ZygosityFinder, ZygosityRule, Subject, Line, Allele, Sequence,
-                             ZYGOSITY_SYMBOLS)
+from django.db import connections
+from subjects.models import (BatchZygosityFinder, ZygosityRule, Subject, Line, Allele,
+                             Sequence, Zygosity, ZYGOSITY_SYMBOLS)
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+DEFAULT_CHECKPOINT = op.join(settings.STATE_ROOT, 'update_zygosities.json')
 
 
 def _parse_rule(rule):
@@ -17,6 +32,72 @@ def _parse_rule(rule):
     return out
 
 
+def _genotype_partition(partition):
+    """Genotype the subjects of a partition, in batches and in order, so that the parents
+    processed in earlier batches are seen with their updated zygosities."""
+    key, pks = partition
+    zf = BatchZygosityFinder()
+    for i in range(0, len(pks), BATCH_SIZE):
+        zf.update_subjects(Subject.objects.filter(pk__in=pks[i:i + BATCH_SIZE]))
+    return key, len(pks)
+
+
+def _partition_by_family(subjects):
+    """Return an ordered dictionary {key: [subject_pk, ...]} of the connected components of the
+    breeding pair graph, each in the subjects order.
+
+    As genotyping a subject from its litter reads the zygosities of its parents, which may be
+    in other lines, the subjects of a family are processed in order by the same worker, as in
+    a serial run.
+
+    """
+    rows = list(subjects.values_list(
+        'pk', 'litter__breeding_pair__father', 'litter__breeding_pair__mother1',
+        'litter__breeding_pair__mother2'))
+    selected = {row[0] for row in rows}
+    parent = {pk: pk for pk in selected}
+
+    def _find(pk):
+        while parent[pk] != pk:
+            parent[pk] = parent[parent[pk]]
+            pk = parent[pk]
+        return pk
+
+    for pk, *parents in rows:
+        for other in parents:
+            # The parents that are not updated in this run are not dependencies.
+            if other in selected:
+                root, other_root = _find(pk), _find(other)
+                if root != other_root:
+                    parent[other_root] = root
+    partitions = OrderedDict()
+    for pk, *_ in rows:
+        partitions.setdefault(_find(pk), []).append(pk)
+    # The key of a family is its first subject, stable across runs for the checkpoint.
+    return OrderedDict((str(pks[0]), pks) for pks in partitions.values())
+
+
+def _load_checkpoint(path, signature):
+    if not path or not op.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('signature', None) != signature:
+        logger.warning("Ignoring the checkpoint %s of another run.", path)
+        return set()
+    return set(checkpoint.get('done', []))
+
+
+def _save_checkpoint(path, signature, done):
+    if not path:
+        return
+    os.makedirs(op.dirname(op.abspath(path)), exist_ok=True)
+    # Write atomically, so that an interruption does not corrupt the checkpoint.
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'signature': signature, 'done': sorted(done)}, f)
+    os.replace(path + '.tmp', path)
+
+
 class Command(BaseCommand):
     help = "Updates all automatically generated zygosities from genotype tests"
 
@@ -25,20 +106,26 @@ class Command(BaseCommand):
                             help='Subject nicknames')
         parser.add_argument('--migrate_rules', action='store_true')
         parser.add_argument('--add_line_alleles', action='store_true')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes, each with its own database '
+                            'connection')
+        parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+                            help='Checkpoint file used to resume an interrupted run, by '
+                            'default in the STATE_ROOT setting directory')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore the checkpoint of an interrupted run')
 
     def handle(self, *args, **options):
 
         if options.get('add_line_alleles'):
-            from collections import defaultdict
-            lines = defaultdict(set)
-            for subject in Subject.objects.all():
-                if not subject.line:
-                    continue
-                alleles = subject.genotype.all()
-                lines[subject.line].update([al for al in alleles])
-            for line, alleles in lines.items():
-                line.alleles.add(*alleles)
-                return
+            lines = {}
+            for line_id, allele_id in Zygosity.objects.filter(
+                    subject__line__isnull=False).values_list(
+                    'subject__line', 'allele').distinct():
+                lines.setdefault(line_id, set()).add(allele_id)
+            for line in Line.objects.filter(pk__in=lines):
+                line.alleles.add(*lines[line.pk])
+            return
 
         if options.get('migrate_rules'):
             from subjects.zygosities import ZYGOSITY_RULES
@@ -70,15 +157,46 @@ class Command(BaseCommand):
                         print(e)
             return
 
-        zf = ZygosityFinder()
-
         self.stdout.write("Updating zygosities...")
         if options.get('subjects'):
             subjects = Subject.objects.filter(nickname__in=options.get('subjects'))
         else:
             subjects = Subject.objects.all()
-        for subject in subjects:
-            zf.genotype_from_litter(subject)
-            zf.update_subject(subject)
+        # The subjects of a family are processed in order by the same worker.
+        partitions = _partition_by_family(subjects)
+        path = options.get('checkpoint')
+        signature = sorted(options.get('subjects') or [])
+        done = set() if options.get('restart') else _load_checkpoint(path, signature)
+        todo = [(key, pks) for key, pks in partitions.items() if key not in done]
+        total = sum(len(pks) for _, pks in todo)
+        if done:
+            self.stdout.write("Resuming: %d/%d families already done." % (
+                len(partitions) - len(todo), len(partitions)))
+
+        workers = max(1, min(options.get('workers') or 1, len(todo)))
+        t0 = time.time()
+        count = 0
+        if workers > 1:
+            # The workers must not share the connection of the parent process.
+            connections.close_all()
+            pool = Pool(workers)
+            results = pool.imap_unordered(_genotype_partition, todo)
+        else:
+            pool = None
+            results = map(_genotype_partition, todo)
+        try:
+            for key, n in results:
+                done.add(key)
+                _save_checkpoint(path, signature, done)
+                count += n
+                dt = time.time() - t0
+                self.stdout.write("%d/%d subjects (%d/%d families), %.0f subjects/s." % (
+                    count, total, len(done), len(partitions), count / dt if dt else 0))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
+        if path and op.exists(path):
+            os.remove(path)
         self.stdout.write(self.style.SUCCESS('Updated zygosities!'))
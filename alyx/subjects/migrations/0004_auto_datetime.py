@@ -0,0 +1,93 @@
+# Generated by Django 2.1.4 on 2019-02-04 10:00
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_auto_datetime(apps, schema_editor):
+    """Set the auto_datetime of the existing objects, so that they appear in the changes feed."""
+    now = timezone.now()
+    for model in apps.get_app_config('subjects').get_models():
+        if any(field.name == 'auto_datetime' for field in model._meta.local_fields):
+            model._base_manager.filter(auto_datetime__isnull=True).update(auto_datetime=now)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subjects', '0003_auto_20190124_1025'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='subject',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='subjectrequest',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='litter',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='breedingpair',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='line',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='species',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='strain',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='zygosityrule',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='allele',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='zygosity',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='sequence',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.AddField(
+            model_name='genotypetest',
+            name='auto_datetime',
+            field=models.DateTimeField(auto_now=True, blank=True, db_index=True, null=True, verbose_name='last updated'),
+        ),
+        migrations.RunPython(backfill_auto_datetime, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.1.4 on 2019-02-11 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subjects', '0004_auto_datetime'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='breedingpair',
+            index=models.Index(fields=['end_date', 'start_date'], name='subjects_br_end_dat_4fd340_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='zygosity',
+            index=models.Index(fields=['subject', 'zygosity'], name='subjects_zy_subject_28d51e_idx'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 2.1.4 on 2019-02-18 10:00
+
+from dateutil.parser import parse
+from django.db import migrations
+from django.utils import timezone
+
+
+BATCH_SIZE = 1000
+
+
+def _parse_date_time(date_time):
+    date_time = parse(date_time)
+    if timezone.is_aware(date_time):
+        date_time = timezone.make_naive(date_time)
+    return date_time
+
+
+def json_to_field_history(apps, schema_editor):
+    """Move the history of the subject fields from the JSON to the FieldHistory table."""
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    FieldHistory = apps.get_model('misc', 'FieldHistory')
+    Subject = apps.get_model('subjects', 'Subject')
+    content_type, _ = ContentType.objects.get_or_create(app_label='subjects', model='subject')
+    subjects = Subject.objects.filter(json__has_key='history').only('id', 'json')
+    entries, updated = [], []
+    for subject in subjects.iterator():
+        for field, changes in (subject.json.pop('history') or {}).items():
+            for change in changes:
+                value = change.get('value', None)
+                entries.append(FieldHistory(
+                    content_type=content_type, object_id=subject.id, field_name=field,
+                    value=value if value not in (None, 'None') else None,
+                    date_time=_parse_date_time(change['date_time'])))
+        updated.append(subject)
+    FieldHistory.objects.bulk_create(entries, batch_size=BATCH_SIZE)
+    for subject in updated:
+        Subject.objects.filter(pk=subject.pk).update(json=subject.json or None)
+
+
+def field_history_to_json(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    FieldHistory = apps.get_model('misc', 'FieldHistory')
+    Subject = apps.get_model('subjects', 'Subject')
+    content_type = ContentType.objects.filter(app_label='subjects', model='subject').first()
+    history = {}
+    for h in FieldHistory.objects.filter(content_type=content_type).order_by('date_time', 'id'):
+        history.setdefault(h.object_id, {}).setdefault(h.field_name, []).append(
+            {'date_time': h.date_time.isoformat(), 'value': h.value})
+    for subject in Subject.objects.filter(pk__in=list(history)).only('id', 'json'):
+        json = subject.json or {}
+        json['history'] = history[subject.pk]
+        Subject.objects.filter(pk=subject.pk).update(json=json)
+    FieldHistory.objects.filter(content_type=content_type).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('misc', '0005_fieldhistory'),
+        ('subjects', '0005_subject_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(json_to_field_history, field_history_to_json),
+    ]
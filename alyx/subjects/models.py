@@ -1,18 +1,22 @@
+from collections import OrderedDict
 from datetime import datetime
+import functools
 import logging
-from operator import attrgetter
 import urllib
 
 import pytz
+import reversion
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core import validators
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import DEFERRED, Q
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 
-from alyx.base import BaseModel, alyx_mail, modify_fields
+from alyx.base import BaseModel, alyx_mail, bump_table_version, modify_fields
 from actions.models import WaterRestriction
 from actions.notifications import responsible_user_changed
 from actions.water_control import water_control
@@ -53,35 +57,78 @@ def _get_current_field(obj, field):
         return str(getattr(obj, field, None))
 
 
-def init_old_fields(obj, fields):
-    obj._original_fields = getattr(obj, '_original_fields', {})
-    for field in fields:
-        obj._original_fields[field] = _get_current_field(obj, field)
+@functools.lru_cache(maxsize=None)
+def _tracked_attnames(model, fields):
+    return tuple(model._meta.get_field(field).attname for field in fields)
 
 
-def save_old_fields(obj, fields):
-    date_time = datetime.now(timezone.utc).isoformat()
-    d = (getattr(obj, 'json', None) or {}).get('history', {})
+def init_old_fields(obj, fields):
+    # Compact snapshot of the raw values, only converted when a save path needs them.
+    # Deferred fields are not loaded here, see _get_old_field().
+    d = obj.__dict__
+    obj._tracked_fields = fields
+    obj._original_values = tuple(d.get(attname, DEFERRED)
+                                 for attname in _tracked_attnames(type(obj), fields))
+
+
+def resolve_old_fields(obj):
+    """Read the old values of the tracked fields that were deferred when the object was
+    loaded, in a single query. Call it before saving the object."""
+    fields = getattr(obj, '_tracked_fields', ())
+    deferred = [i for i, value in enumerate(obj._original_values) if value is DEFERRED]
+    if not deferred:
+        return
+    attnames = _tracked_attnames(type(obj), fields)
+    values = None
+    if obj.pk is not None and not obj._state.adding:
+        values = type(obj)._base_manager.filter(pk=obj.pk).values_list(
+            *[attnames[i] for i in deferred]).first()
+    values = dict(zip(deferred, values or (None,) * len(deferred)))
+    obj._original_values = tuple(values.get(i, value)
+                                 for i, value in enumerate(obj._original_values))
+
+
+def get_field_history(obj, fields):
+    """Return the unsaved FieldHistory entries with the previous values of the changed fields.
+    Call it before saving the object: the deferred old values are read from the database."""
+    from misc.models import FieldHistory
+    content_type = ContentType.objects.get_for_model(obj)
+    date_time = timezone.now()
+    entries = []
     for field in fields:
-        v = _get_current_field(obj, field)
-        if v is None or v == obj._original_fields.get(field, None):
+        old = _get_old_field(obj, field)
+        if _get_current_field(obj, field) == old:
             continue
-        if field not in d:
-            d[field] = []
-        l = d[field]
-        l.append({'date_time': date_time, 'value': obj._original_fields[field]})
-        # Update the new value.
-        # obj._original_fields[field] = v
-        # Set the object's JSON if necessary.
-        if not obj.json:
-            obj.json = {}
-        if 'history' not in obj.json:
-            obj.json['history'] = {}
-        obj.json['history'].update(d)
+        entries.append(FieldHistory(
+            content_type=content_type, field_name=field,
+            value=old if old != 'None' else None, date_time=date_time))
+    return entries
+
+
+def save_old_fields(obj, entries):
+    """Append the entries returned by get_field_history() to the field history once the
+    object is saved, in a single insert."""
+    from misc.models import FieldHistory
+    for entry in entries:
+        entry.object_id = obj.pk
+    FieldHistory.objects.bulk_create(entries)
 
 
 def _get_old_field(obj, field):
-    return obj._original_fields.get(field, None)
+    fields = getattr(obj, '_tracked_fields', ())
+    if field not in fields:
+        return None
+    i = fields.index(field)
+    value = obj._original_values[i]
+    if value is DEFERRED:
+        # The field was deferred when the object was loaded: get its value in the database.
+        attname = _tracked_attnames(type(obj), fields)[i]
+        value = None
+        if obj.pk is not None and not obj._state.adding:
+            value = type(obj)._base_manager.filter(pk=obj.pk).values_list(
+                attname, flat=True).first()
+        obj._original_values = obj._original_values[:i] + (value,) + obj._original_values[i + 1:]
+    return str(value)
 
 
 def _has_field_changed(obj, field):
@@ -204,7 +251,7 @@ class Subject(BaseModel):
 
     # We save the history of these fields.
     _fields_history = ('nickname', 'responsible_user', 'cage')
-    # We track the changes of these fields without saving their history in the JSON.
+    # We track the changes of these fields without saving their history.
     _track_field_changes = ('request', 'responsible_user', 'litter', 'genotype_date',
                             'death_date', 'reduced')
 
@@ -259,18 +306,26 @@ class Subject(BaseModel):
             return pytz.timezone(self.lab.timezone)
 
     def reinit_water_control(self):
+        # Discard the data prefetched by prefetch_water_control(), which may be outdated.
+        for attr in ('_prefetched_water_restrictions', '_prefetched_water_administrations',
+                     '_prefetched_weighings'):
+            self.__dict__.pop(attr, None)
         self._water_control = water_control(self)
         return self._water_control
 
     @property
     def water_control(self):
         if self._water_control is None:
-            self.reinit_water_control()
+            self._water_control = water_control(self)
         return self._water_control
 
     def zygosity_strings(self):
-        alleles = self.line.alleles.all() if self.line else Allele.objects.all()
-        return list(map(str, self.zygosity_set.filter(allele__in=alleles)))
+        # Filter in Python so that prefetched zygosities and line alleles are used.
+        zygosities = self.zygosity_set.all()
+        if self.line:
+            alleles = {allele.pk for allele in self.line.alleles.all()}
+            zygosities = [z for z in zygosities if z.allele_id in alleles]
+        return list(map(str, zygosities))
 
     def is_negative(self):
         """Genotype is -/- for all genes."""
@@ -314,9 +369,19 @@ class Subject(BaseModel):
                                                 line=self.line)
             if srs:
                 self.request = srs[0]
-        # Keep the history of some fields in the JSON.
-        save_old_fields(self, self._fields_history)
-        return super(Subject, self).save(*args, **kwargs)
+        # Keep the history of some fields. The old values are read before the update, as the
+        # post_save receivers compare with them too.
+        resolve_old_fields(self)
+        history = get_field_history(self, self._fields_history)
+        out = super(Subject, self).save(*args, **kwargs)
+        save_old_fields(self, history)
+        return out
+
+    def responsible_user_at(self, date_time):
+        """Return the responsible user of the subject at a given time."""
+        from misc.models import FieldHistory
+        user_id = FieldHistory.value_at(self, 'responsible_user', date_time)
+        return get_user_model().objects.filter(pk=user_id).first() if user_id else None
 
     def __str__(self):
         return self.nickname
@@ -489,6 +554,8 @@ class BreedingPair(BaseModel):
     class Meta:
         ordering = ['name']
         verbose_name_plural = 'Breeding pairs'
+        # Current breeding pairs, used by the breeder filter of the subject admin.
+        indexes = [models.Index(fields=['end_date', 'start_date'])]
 
     def save(self, *args, **kwargs):
         if self.line and self.name in (None, '', '-'):
@@ -546,33 +613,67 @@ class Line(BaseModel):
     def __str__(self):
         return self.name
 
+    # Counter field and name format of the autonames of each kind of object.
+    _autonames = {
+        'breeding_pair': ('breeding_pair_autoname_index', '%s_BP_%03d'),
+        'litter': ('litter_autoname_index', '%s_L_%03d'),
+        'subject': ('subject_autoname_index', '%s_%04d'),
+    }
+
+    def reserve_autonames(self, kind, count=1):
+        """Reserve `count` consecutive autonames of a kind of object ('subject', 'litter' or
+        'breeding_pair') for this line.
+
+        The counter is incremented with a single UPDATE ... RETURNING query, which locks the
+        line row until the end of the transaction, so that concurrent reservations never get
+        the same names.
+
+        """
+        field, fmt = self._autonames[kind]
+        if count <= 0:
+            return []
+        qn = connection.ops.quote_name
+        sql = 'UPDATE {table} SET {col} = {col} + %s, {updated} = %s WHERE {pk} = %s ' \
+              'RETURNING {col}'.format(
+                  table=qn(self._meta.db_table), col=qn(self._meta.get_field(field).column),
+                  updated=qn(self._meta.get_field('auto_datetime').column),
+                  pk=qn(self._meta.pk.column))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [count, timezone.now(), self.pk])
+            last = cursor.fetchone()[0]
+        # The raw query sends no signal.
+        bump_table_version(Line)
+        setattr(self, field, last)
+        return [fmt % (self.nickname, i) for i in range(last - count + 1, last + 1)]
+
     def new_breeding_pair_autoname(self):
-        self.breeding_pair_autoname_index = self.breeding_pair_autoname_index + 1
-        self.save()
-        return '%s_BP_%03d' % (self.nickname, self.breeding_pair_autoname_index)
+        return self.reserve_autonames('breeding_pair')[0]
 
     def new_litter_autoname(self):
-        self.litter_autoname_index = self.litter_autoname_index + 1
-        self.save()
-        return '%s_L_%03d' % (self.nickname, self.litter_autoname_index)
+        return self.reserve_autonames('litter')[0]
 
     def new_subject_autoname(self):
-        self.subject_autoname_index = self.subject_autoname_index + 1
-        self.save()
-        return '%s_%04d' % (self.nickname, self.subject_autoname_index)
+        return self.reserve_autonames('subject')[0]
+
+    def set_autonames(self, objs):
+        """Set the autonames of several subjects, litters or breeding pairs, with one query
+        per kind of object."""
+        kinds = OrderedDict()
+        for obj in objs:
+            if isinstance(obj, BreedingPair):
+                kind, field = 'breeding_pair', 'name'
+            elif isinstance(obj, Litter):
+                kind, field = 'litter', 'name'
+            elif isinstance(obj, Subject):
+                kind, field = 'subject', 'nickname'
+            if getattr(obj, field, None) in (None, '-'):
+                kinds.setdefault((kind, field), []).append(obj)
+        for (kind, field), kind_objs in kinds.items():
+            for obj, name in zip(kind_objs, self.reserve_autonames(kind, len(kind_objs))):
+                setattr(obj, field, name)
 
     def set_autoname(self, obj):
-        if isinstance(obj, BreedingPair):
-            field = 'name'
-            m = self.new_breeding_pair_autoname
-        elif isinstance(obj, Litter):
-            field = 'name'
-            m = self.new_litter_autoname
-        elif isinstance(obj, Subject):
-            field = 'nickname'
-            m = self.new_subject_autoname
-        if getattr(obj, field, None) in (None, '-'):
-            setattr(obj, field, m())
+        self.set_autonames([obj])
 
 
 class SpeciesManager(models.Manager):
@@ -648,15 +749,11 @@ class Source(BaseModel):
 
 def _update_zygosities(line, sequence):
     # Apply the rule.
-    zf = ZygosityFinder()
     # Subjects from the line and that have a test with the first sequence.
-    subjects = set(gt.subject for gt in GenotypeTest.objects.filter(
-        sequence=sequence,
-        subject__line=line))
-    for subject in sorted(subjects, key=attrgetter('nickname')):
-        # Note: need force=True when deleting a zygosity rule.
-        zf.genotype_from_litter(subject, force=True)
-        zf.update_subject(subject)
+    subjects = Subject.objects.filter(
+        genotypetest__sequence=sequence, line=line).distinct().order_by('nickname')
+    # Note: need force=True when deleting a zygosity rule.
+    BatchZygosityFinder().update_subjects(subjects, force_litter=True)
 
 
 class ZygosityRule(BaseModel):
@@ -826,6 +923,164 @@ class ZygosityFinder(object):
             self._create_zygosity(subject, allele, z, force=force)
 
 
+class BatchZygosityFinder(ZygosityFinder):
+    """Genotype a set of subjects with a constant number of queries.
+
+    The rules, the genotype tests and the zygosities of the subjects and their parents are
+    loaded at once, the subjects are genotyped in memory in the given order, as
+    genotype_from_litter() followed by update_subject() would do for each subject, and the
+    zygosities are written in bulk.
+
+    """
+
+    def update_subjects(self, subjects, from_litter=True, from_rules=True,
+                        force_litter=False, force_rules=True):
+        if isinstance(subjects, models.QuerySet):
+            subjects = subjects.select_related('litter__breeding_pair')
+        subjects = list(subjects)
+        if not subjects:
+            return
+        bps = {subject.pk: subject.litter.breeding_pair
+               for subject in subjects if subject.litter and subject.litter.breeding_pair}
+        parent_ids = {pk for bp in bps.values() for pk in (bp.mother1_id, bp.father_id) if pk}
+        # Zygosities of the subjects and their parents: {subject_id: {allele_id: zygosity}}.
+        self._zygosities = {}
+        subject_ids = parent_ids | {subject.pk for subject in subjects}
+        for z in Zygosity.objects.filter(subject__in=subject_ids).select_related('allele'):
+            self._zygosities.setdefault(z.subject_id, {}).setdefault(z.allele_id, z)
+        # Rules: {line_id: {allele_id: [rules]}}.
+        rules = {}
+        if from_rules:
+            for rule in ZygosityRule.objects.filter(
+                    line__in={subject.line_id for subject in subjects if subject.line_id},
+                    allele__isnull=False):
+                rules.setdefault(rule.line_id, {}).setdefault(rule.allele_id, []).append(rule)
+        # Genotype tests: {subject_id: {sequence_id: test_result}}.
+        tests = {}
+        if from_rules:
+            for test in GenotypeTest.objects.filter(subject__in=subjects):
+                tests.setdefault(test.subject_id, {})[test.sequence_id] = test.test_result
+        self._created, self._updated = {}, {}
+
+        for subject in subjects:
+            bp = bps.get(subject.pk, None)
+            if from_litter and bp:
+                zms = self._zygosities.get(bp.mother1_id, {})
+                zfs = self._zygosities.get(bp.father_id, {})
+                for allele_id in set(zms) | set(zfs):
+                    zm = zms[allele_id].symbol() if allele_id in zms else None
+                    zf = zfs[allele_id].symbol() if allele_id in zfs else None
+                    z = self._zygosity_from_parents(zm, zf)
+                    if z:
+                        self._set_zygosity(subject, allele_id, z, force=force_litter)
+            if from_rules and subject.line_id:
+                subject_tests = tests.get(subject.pk, None)
+                for allele_id, allele_rules in rules.get(subject.line_id, {}).items():
+                    z = self._find_zygosity_from_results(allele_rules, subject_tests)
+                    if z is not None:
+                        self._set_zygosity(subject, allele_id, ZYGOSITY_SYMBOLS[z],
+                                           force=force_rules)
+
+        now = timezone.now()
+        for z in self._updated.values():
+            z.auto_datetime = now
+        with transaction.atomic():
+            Zygosity.objects.bulk_create(list(self._created.values()))
+            Zygosity.objects.bulk_update(list(self._updated.values()),
+                                         ('zygosity', 'auto_datetime'))
+        # The bulk operations send no signal.
+        bump_table_version(Zygosity)
+        logger.debug("Genotyped %d subjects: %d zygosities created, %d updated.",
+                     len(subjects), len(self._created), len(self._updated))
+
+    def _find_zygosity_from_results(self, rules, tests):
+        # Same as _find_zygosity(), with tests as a dictionary {sequence_id: test_result}.
+        if not tests:
+            return
+        for rule in rules:
+            result0 = tests.get(rule.sequence0_id, None)
+            result1 = tests.get(rule.sequence1_id, None)
+            pass0 = rule.sequence0_result == result0
+            pass1 = rule.sequence1_result == result1
+            if (result1 is None and pass0) or (result1 is not None and pass0 and pass1):
+                return rule.zygosity
+
+    def _set_zygosity(self, subject, allele_id, symbol, force=True):
+        # Same as _create_zygosity(), in memory.
+        z = Zygosity.from_symbol(symbol)
+        zygosities = self._zygosities.setdefault(subject.pk, {})
+        zygosity = zygosities.get(allele_id, None)
+        if zygosity is None:
+            zygosity = Zygosity(subject_id=subject.pk, allele_id=allele_id, zygosity=z)
+            zygosities[allele_id] = zygosity
+            self._created[zygosity.pk] = zygosity
+            return
+        if z == zygosity.zygosity:
+            return
+        if not force:
+            logger.warning("Zygosity mismatch for %s: was %s, would have been set "
+                           "to %s but aborting now.", subject, zygosity, symbol)
+            return
+        logger.warning("Zygosity mismatch for %s: was %s, now set to %s.",
+                       subject, zygosity, symbol)
+        zygosity.zygosity = z
+        if zygosity.pk not in self._created:
+            self._updated[zygosity.pk] = zygosity
+
+
+def _assign_subject_requests(subjects):
+    """Assign the latest request of the responsible user for the line, as in Subject.save(),
+    with a single query over all (user, line) pairs."""
+    subjects = [subject for subject in subjects
+                if subject.responsible_user_id and subject.line_id and
+                subject.request_id is None and _has_field_changed(subject, 'responsible_user')]
+    if not subjects:
+        return
+    pairs = Q(pk__in=[])
+    for user_id, line_id in {(s.responsible_user_id, s.line_id) for s in subjects}:
+        pairs |= Q(user_id=user_id, line_id=line_id)
+    requests = {}
+    for request in SubjectRequest.objects.filter(pairs):
+        requests.setdefault((request.user_id, request.line_id), request)
+    for subject in subjects:
+        request = requests.get((subject.responsible_user_id, subject.line_id), None)
+        if request is not None:
+            subject.request = request
+
+
+def bulk_create_subjects(subjects):
+    """Insert new subjects in bulk, with the defaults of Subject.save(): the autonames are
+    reserved with one query per line, the strain comes from the line, the subject requests
+    of the responsible users are assigned, and the zygosities are inferred from the litter.
+    Within a revision, as in the admin, the new subjects are added to the reversion history.
+
+    Like any bulk insert, this sends no post_save signal: the notifications about changes
+    of existing subjects do not apply to new subjects anyway.
+
+    """
+    subjects = list(subjects)
+    if not subjects:
+        return subjects
+    lines = OrderedDict()
+    for subject in subjects:
+        if subject.line:
+            lines.setdefault(subject.line.pk, (subject.line, []))[1].append(subject)
+            if not subject.strain:
+                subject.strain = subject.line.strain
+        if subject.reduced and _has_field_changed(subject, 'reduced'):
+            subject.reduced_date = timezone.now().date()
+    for line, line_subjects in lines.values():
+        line.set_autonames(line_subjects)
+    _assign_subject_requests(subjects)
+    Subject.objects.bulk_create(subjects)
+    bump_table_version(Subject)
+    BatchZygosityFinder().update_subjects(subjects, from_rules=False)
+    if reversion.is_active() and reversion.is_registered(Subject):
+        for subject in subjects:
+            reversion.add_to_revision(subject)
+    return subjects
+
+
 @receiver(post_delete)
 def delete_zygosity_rule(sender, instance, **kwargs):
     if isinstance(instance, ZygosityRule):
@@ -885,6 +1140,8 @@ class Zygosity(BaseModel):
 
     class Meta:
         verbose_name_plural = "zygosities"
+        # Used by the zygosity filter of the subject admin.
+        indexes = [models.Index(fields=['subject', 'zygosity'])]
 
 
 class SequenceManager(models.Manager):
@@ -1,15 +1,24 @@
+from datetime import datetime
+from io import StringIO
 import logging
 from operator import attrgetter
 import os.path as op
 import sys
+import tempfile
+import time
 from uuid import UUID
 import warnings
 
 from django.contrib.auth import get_user_model
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+import reversion
+from reversion.models import Version
 
+from misc.backups import load_archive
 from .admin import mysite
 
 logger = logging.getLogger(__file__)
@@ -56,7 +65,7 @@ class ModelAdminTests(TestCase, metaclass=MyTestsMeta):
 
     @classmethod
     def setUpTestData(cls):
-        call_command('loaddata', op.join(DATA_DIR, 'all_dumped_anon.json.gz'), verbosity=1)
+        load_archive(op.join(DATA_DIR, 'all_dumped_anon.json.gz'))
 
     def ar(self, r):
         r.render()
@@ -96,6 +105,87 @@ class ModelAdminTests(TestCase, metaclass=MyTestsMeta):
             self.request.user = user
             self._test_list_change(self.site._registry[cls])
 
+    def _assert_changelist_queries_constant(self, model):
+        ma = self.site._registry[model]
+        self.request.user = self.users[0]
+        list_per_page = ma.list_per_page
+
+        def _count_queries(n):
+            ma.list_per_page = n
+            with CaptureQueriesContext(connection) as queries:
+                self.ar(ma.changelist_view(self.request))
+            return len(queries)
+
+        try:
+            _count_queries(1)  # warm up the caches
+            # The number of queries does not depend on the number of objects on the page.
+            self.assertEqual(_count_queries(2), _count_queries(50))
+        finally:
+            ma.list_per_page = list_per_page
+
+    def test_subject_changelist_queries(self):
+        from subjects.models import Subject
+        self._assert_changelist_queries_constant(Subject)
+
+    def test_session_changelist_queries(self):
+        from actions.models import Session
+        self._assert_changelist_queries_constant(Session)
+
+    def test_waterrestriction_changelist(self):
+        from actions.models import WaterRestriction
+        self._assert_changelist_queries_constant(WaterRestriction)
+
+    def test_subject_filters_synthetic_colony(self):
+        from subjects import models as m
+        from subjects.admin import BreederListFilter, ZygosityFilter
+        ma = self.site._registry[m.Subject]
+        self.request.user = self.users[0]
+
+        # Synthetic colony: subjects with various zygosities, and some breeding pairs.
+        line = m.Line.objects.create(nickname='colony', lab=self.lab)
+        alleles = m.Allele.objects.bulk_create(
+            [m.Allele(nickname='colony_allele_%d' % i) for i in range(3)])
+        subjects = m.Subject.objects.bulk_create(
+            [m.Subject(nickname='colony_%04d' % i, sex='MF'[i % 2], line=line, lab=self.lab)
+             for i in range(600)])
+        m.Zygosity.objects.bulk_create(
+            [m.Zygosity(subject=subject, allele=allele, zygosity=(i + j) % 4)
+             for i, subject in enumerate(subjects) if i % 5
+             for j, allele in enumerate(alleles[:1 + i % 3])])
+        m.BreedingPair.objects.bulk_create(
+            [m.BreedingPair(name='colony_bp_%d' % i, line=line,
+                            father=subjects[i], mother1=subjects[i + 1],
+                            mother2=subjects[i + 3] if i % 4 == 0 else None,
+                            start_date='2019-01-01', end_date='2019-02-01' if i % 3 == 0 else None)
+             for i in range(0, 100, 2)])
+        colony = m.Subject.objects.filter(line=line)
+
+        # Expected results, computed in Python.
+        zygosities = {}
+        for z in m.Zygosity.objects.filter(subject__line=line):
+            zygosities.setdefault(z.subject_id, []).append(z.zygosity)
+        breeders = set()
+        for bp in m.BreedingPair.objects.filter(line=line, end_date__isnull=True):
+            breeders.update((bp.father_id, bp.mother1_id, bp.mother2_id))
+        breeders.discard(None)
+        expected = {
+            (ZygosityFilter, 'p'): {s for s, z in zygosities.items() if 0 not in z},
+            (ZygosityFilter, 'h'): {s for s, z in zygosities.items() if not set(z) & {0, 1, 3}},
+            (BreederListFilter, 'yes'): breeders,
+            (BreederListFilter, None): {s.pk for s in subjects} - breeders,
+        }
+
+        for (cls, value), pks in expected.items():
+            params = {cls.parameter_name: value} if value else {}
+            f = cls(self.request, params, m.Subject, ma)
+            t0 = time.perf_counter()
+            # A single query whatever the size of the colony.
+            with self.assertNumQueries(1):
+                result = set(f.queryset(self.request, colony).values_list('pk', flat=True))
+            logger.debug("%s=%s on %d subjects: %.1f ms.", cls.parameter_name, value,
+                         len(subjects), 1000 * (time.perf_counter() - t0))
+            self.assertEqual(result, pks)
+
     def test_history(self):
         from subjects.models import Subject, _has_field_changed
 
@@ -106,7 +196,8 @@ class ModelAdminTests(TestCase, metaclass=MyTestsMeta):
         s.nickname = 'new_nickname'
         s.save()
 
-        self.assertEqual(s.json['history']['nickname'][-1]['value'], old_nickname)
+        from misc.models import FieldHistory
+        self.assertEqual(FieldHistory.for_object(s, 'nickname').last().value, old_nickname)
 
         self.assertTrue(_has_field_changed(s, 'nickname'))
         self.assertFalse(_has_field_changed(s, 'death_date'))
@@ -116,6 +207,182 @@ class ModelAdminTests(TestCase, metaclass=MyTestsMeta):
         s.responsible_user = get_user_model().objects.last()
         self.assertTrue(_has_field_changed(s, 'responsible_user'))
 
+    def test_responsible_user_at(self):
+        from subjects.models import Subject
+
+        s = Subject.objects.filter(responsible_user__isnull=False).first()
+        old_user = s.responsible_user
+        new_user = get_user_model().objects.exclude(pk=old_user.pk).first()
+        before = datetime.now()
+        s.responsible_user = new_user
+        s.save()
+        self.assertEqual(s.responsible_user_at(before), old_user)
+        self.assertEqual(s.responsible_user_at(datetime.now()), new_user)
+
+    def test_history_deferred(self):
+        from subjects.models import Subject, _has_field_changed
+
+        s = Subject.objects.only('nickname').first()
+        self.assertFalse(_has_field_changed(s, 'responsible_user'))
+        s.responsible_user = get_user_model().objects.exclude(
+            pk=Subject.objects.get(pk=s.pk).responsible_user_id).first()
+        self.assertTrue(_has_field_changed(s, 'responsible_user'))
+
+    def test_history_deferred_save(self):
+        from misc.models import FieldHistory
+        from subjects.models import Subject
+
+        s = Subject.objects.first()
+        old_nickname = s.nickname
+        s = Subject.objects.only('pk').get(pk=s.pk)
+        s.nickname = 'deferred_nickname'
+        s.save()
+        self.assertEqual(Subject.objects.get(pk=s.pk).nickname, 'deferred_nickname')
+        self.assertEqual(FieldHistory.for_object(s, 'nickname').last().value, old_nickname)
+
+    def test_subject_instantiation_benchmark(self):
+        from subjects.models import Subject, _has_field_changed
+
+        s = Subject.objects.first()
+        field_names = [f.attname for f in Subject._meta.concrete_fields]
+        values = tuple(getattr(s, name) for name in field_names)
+        n = 50000
+        # Instantiating subjects from the database does not run any query.
+        with self.assertNumQueries(0):
+            t0 = time.perf_counter()
+            subjects = [Subject.from_db('default', field_names, values) for _ in range(n)]
+            dt = time.perf_counter() - t0
+        logger.debug("Instantiated %d subjects in %.3f s (%.1f us per subject).",
+                     n, dt, 1e6 * dt / n)
+        # The change tracking still works.
+        subjects[-1].nickname = 'new_nickname'
+        self.assertTrue(_has_field_changed(subjects[-1], 'nickname'))
+        self.assertFalse(_has_field_changed(subjects[0], 'nickname'))
+
+    def test_zygosities_batch(self):
+        from subjects import models as m
+        seq = [m.Sequence.objects.create(name='batch_sequence%d' % i) for i in range(2)]
+        alleles = [m.Allele.objects.create(nickname='batch_allele%d' % i) for i in range(3)]
+        line = m.Line.objects.create(nickname='batch_line', lab=self.lab)
+        line.alleles.add(*alleles)
+        m.ZygosityRule.objects.create(
+            line=line, allele=alleles[0], sequence0=seq[0], sequence0_result=1, zygosity=2)
+        m.ZygosityRule.objects.create(
+            line=line, allele=alleles[0], sequence0=seq[0], sequence0_result=0, zygosity=0)
+        m.ZygosityRule.objects.create(
+            line=line, allele=alleles[1], sequence0=seq[0], sequence0_result=1,
+            sequence1=seq[1], sequence1_result=0, zygosity=1)
+
+        # Parents with various genotypes.
+        father = m.Subject.objects.create(
+            nickname='batch_father', sex='M', line=line, lab=self.lab)
+        mother = m.Subject.objects.create(
+            nickname='batch_mother', sex='F', line=line, lab=self.lab)
+        m.Zygosity.objects.create(subject=father, allele=alleles[0], zygosity=2)
+        m.Zygosity.objects.create(subject=mother, allele=alleles[0], zygosity=2)
+        m.Zygosity.objects.create(subject=mother, allele=alleles[2], zygosity=0)
+        bp = m.BreedingPair.objects.create(line=line, father=father, mother1=mother)
+        litter = m.Litter.objects.create(line=line, breeding_pair=bp)
+
+        # The pups are genotyped subject per subject on creation.
+        pups = [m.Subject.objects.create(
+            nickname='batch_pup%d' % i, line=line, litter=litter, lab=self.lab)
+            for i in range(10)]
+        for i, pup in enumerate(pups):
+            m.GenotypeTest.objects.create(subject=pup, sequence=seq[0], test_result=i % 2)
+            if i % 3:
+                m.GenotypeTest.objects.create(subject=pup, sequence=seq[1], test_result=0)
+        zygosities = m.Zygosity.objects.filter(subject__in=pups)
+        expected = set(zygosities.values_list('subject', 'allele', 'zygosity'))
+        self.assertTrue(expected)
+
+        def _genotype(subjects):
+            zygosities.delete()
+            with CaptureQueriesContext(connection) as queries:
+                m.BatchZygosityFinder().update_subjects(
+                    m.Subject.objects.filter(pk__in=[s.pk for s in subjects]))
+            return len(queries)
+
+        # Same results as the per-subject logic, with a constant number of queries.
+        self.assertEqual(_genotype(pups[:2]), _genotype(pups))
+        self.assertEqual(set(zygosities.values_list('subject', 'allele', 'zygosity')), expected)
+
+    def test_update_zygosities_resume(self):
+        from subjects.management.commands import update_zygosities as uz
+        from subjects.models import Subject
+        path = op.join(tempfile.mkdtemp(), 'checkpoint.json')
+        # Interrupted run: all families but one are done.
+        keys = list(uz._partition_by_family(Subject.objects.all()))
+        uz._save_checkpoint(path, [], keys[1:])
+        out = StringIO()
+        call_command('update_zygosities', workers=1, checkpoint=path, stdout=out)
+        self.assertTrue('Resuming: %d/%d families' % (len(keys) - 1, len(keys))
+                        in out.getvalue())
+        self.assertTrue('(%d/%d families)' % (len(keys), len(keys)) in out.getvalue())
+        # The checkpoint is removed at the end of a complete run.
+        self.assertFalse(op.exists(path))
+
+    def test_update_zygosities_families(self):
+        from subjects import models as m
+        from subjects.management.commands import update_zygosities as uz
+        line, other = [m.Line.objects.create(nickname=name, lab=self.lab)
+                       for name in ('family_line', 'family_other')]
+        # Parents from another line.
+        father = m.Subject.objects.create(nickname='family_a_father', line=other, lab=self.lab)
+        mother = m.Subject.objects.create(nickname='family_a_mother', line=other, lab=self.lab)
+        bp = m.BreedingPair.objects.create(name='family_bp', line=line, father=father,
+                                           mother1=mother)
+        litter = m.Litter.objects.create(name='family_litter', line=line, breeding_pair=bp)
+        pup = m.Subject.objects.create(nickname='family_pup', line=line, litter=litter,
+                                       lab=self.lab)
+        single = m.Subject.objects.create(nickname='family_single', line=line, lab=self.lab)
+        partitions = list(uz._partition_by_family(
+            m.Subject.objects.filter(nickname__startswith='family_')).values())
+        # The pup is genotyped by the same worker as its parents, after them.
+        self.assertTrue([father.pk, mother.pk, pup.pk] in partitions)
+        self.assertTrue([single.pk] in partitions)
+
+    def test_autonames(self):
+        from subjects import models as m
+        line = m.Line.objects.create(nickname='autoname', lab=self.lab)
+        self.assertEqual(line.reserve_autonames('subject', 3),
+                         ['autoname_0001', 'autoname_0002', 'autoname_0003'])
+        # The counter is incremented in the database, even through a stale instance.
+        stale = m.Line.objects.get(pk=line.pk)
+        self.assertEqual(stale.new_subject_autoname(), 'autoname_0004')
+        self.assertEqual(line.reserve_autonames('subject', 1), ['autoname_0005'])
+        self.assertEqual(line.new_litter_autoname(), 'autoname_L_001')
+        self.assertEqual(m.Line.objects.get(pk=line.pk).subject_autoname_index, 5)
+
+        # Pups created in bulk get consecutive names and the genotype of their parents.
+        allele = m.Allele.objects.create(nickname='autoname_allele')
+        father = m.Subject.objects.create(nickname='autoname_father', sex='M', lab=self.lab)
+        mother = m.Subject.objects.create(nickname='autoname_mother', sex='F', lab=self.lab)
+        m.Zygosity.objects.create(subject=father, allele=allele, zygosity=2)
+        m.Zygosity.objects.create(subject=mother, allele=allele, zygosity=2)
+        bp = m.BreedingPair.objects.create(line=line, father=father, mother1=mother)
+        litter = m.Litter.objects.create(line=line, breeding_pair=bp)
+        self.assertEqual(bp.name, 'autoname_BP_001')
+        self.assertEqual(litter.name, 'autoname_L_002')
+        pups = m.bulk_create_subjects(
+            [m.Subject(line=line, litter=litter, lab=self.lab) for _ in range(3)])
+        self.assertEqual([pup.nickname for pup in pups],
+                         ['autoname_0006', 'autoname_0007', 'autoname_0008'])
+        self.assertEqual(
+            list(m.Zygosity.objects.filter(subject__in=pups).values_list('zygosity', flat=True)),
+            [2, 2, 2])
+
+        # As with save(), the pups get the request of their responsible user for the line,
+        # and they are added to the current revision.
+        user = self.users[0]
+        request = m.SubjectRequest.objects.create(user=user, line=line, count=2)
+        pup = m.Subject(line=line, litter=litter, lab=self.lab)
+        pup.responsible_user = user
+        with reversion.create_revision():
+            m.bulk_create_subjects([pup])
+        self.assertEqual(m.Subject.objects.get(pk=pup.pk).request, request)
+        self.assertEqual(Version.objects.get_for_object(pup).count(), 1)
+
     def test_zygosities_1(self):
         from subjects import models as m
         sequence = m.Sequence.objects.create(name='sequence')
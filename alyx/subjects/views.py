@@ -1,7 +1,10 @@
+from django.contrib.auth import get_user_model
 from rest_framework import generics, permissions
 import django_filters
 from django_filters.rest_framework import FilterSet
 
+from alyx.base import CachedListMixin, ConditionalDetailMixin
+from data.models import DataRepository
 from .models import Subject, Project
 from .serializers import (SubjectListSerializer,
                           SubjectDetailSerializer,
@@ -52,21 +55,26 @@ class SubjectList(generics.ListCreateAPIView):
     filter_class = SubjectFilter
 
 
-class SubjectDetail(generics.RetrieveUpdateDestroyAPIView):
+class SubjectDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Subject.objects.all()
     serializer_class = SubjectDetailSerializer
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = 'nickname'
+    etag_related = ('weighings', 'water_administrations', 'actions_waterrestrictions',
+                    'zygosity')
+    # The expected and remaining water depend on the current date.
+    etag_daily = True
 
 
-class ProjectList(generics.ListCreateAPIView):
+class ProjectList(CachedListMixin, generics.ListCreateAPIView):
     queryset = Project.objects.all()
     serializer_class = ProjectSerializer
     permission_classes = (permissions.IsAuthenticated,)
     lookup_field = 'name'
+    cache_models = (Project, get_user_model(), DataRepository)
 
 
-class ProjectDetail(generics.RetrieveUpdateDestroyAPIView):
+class ProjectDetail(ConditionalDetailMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Project.objects.all()
     serializer_class = ProjectSerializer
     permission_classes = (permissions.IsAuthenticated,)
@@ -16,7 +16,5 @@ rm ./scripts/sync_ucl/cortexlab.sql
 
 cd alyx
 source ../venv/bin/activate
-echo "Cascade deleting all non-IBL subjects"
-./manage.py shell < ../scripts/sync_ucl/prune_cortexlab.py
-echo "Load pruned cortexlab data into ibl"
-./manage.py loaddata ../scripts/sync_ucl/cortexlab_pruned.json 
+echo "Import the IBL objects of cortexlab changed since the last sync"
+./manage.py sync_ucl --source cortexlab --state ../scripts/sync_ucl/sync_state.json
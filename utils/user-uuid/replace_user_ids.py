@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
 
+"""Convert a dump of the old database schema to the current one, streaming the objects from
+the input dump to the output dump so that the memory usage does not depend on its size."""
+
 import os
 import os.path as op
 import sys
 import json
 import uuid
-import re
+
+sys.path.insert(0, op.join(op.dirname(op.realpath(__file__)), '../../alyx'))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "alyx.settings")
+
+import django  # noqa
+django.setup()
+
+from misc.backups import iter_json_array, remap_users  # noqa
+from misc.compression import CompressedWriter, compression_from_path, open_text  # noqa
 
 
 if len(sys.argv) > 1 and sys.argv[1] == 'test':
@@ -19,7 +30,7 @@ user_keys = {}
 
 if op.exists('user_keys.json'):
     with open('user_keys.json', 'r') as f:
-        user_keys.update({int(key): value for key, value in json.load(f).items()})
+        user_keys.update({str(key): value for key, value in json.load(f).items()})
 
 
 """
@@ -47,61 +58,21 @@ groups should not be dumped, but set up locally with a management command
 
 """
 
-# Load the database dump.
-with open(path, 'r') as f:
-    db = json.load(f)
+
+def new_user_key(pk):
+    # Only the integer primary keys of the old users are replaced by UUIDs.
+    return str(uuid.uuid4()) if isinstance(pk, int) else None
 
 
-# Generate and replace, if needed, the user UUID.
-for item in db:
+def convert_user(item):
     if item['model'] != 'auth.user':
-        continue
-    old_pk = item['pk']
+        return item
     # Remove the groups.
     item['fields'].pop('groups', [])
     item['fields'].pop('user_permissions', [])
-    if isinstance(old_pk, int):
-        if not user_keys.get(old_pk, None):
-            key = str(uuid.uuid4())
-            user_keys[old_pk] = key
+    if isinstance(item['pk'], int):
         item['model'] = 'misc.LabMember'
-        item['pk'] = user_keys[old_pk]
-
-
-users = [item for item in db if item['model'] == 'auth.user']
-assert all(isinstance(user['pk'], str) for user in users)
-
-
-# Replace the relationships.
-to_remove = []
-for i, item in enumerate(db):
-    for field, value in item['fields'].items():
-        if field in ('user', 'created_by', 'responsible_user'):
-            if value is None:
-                continue
-            if not isinstance(value, int):
-                continue
-            new_pk = user_keys[value]
-            item['fields'][field] = new_pk
-            assert isinstance(item['fields'][field], str)
-        elif field == 'users':
-            value = item['fields'][field]
-            item['fields'][field] = [user_keys.get(pk, pk) for pk in value]
-            assert all(isinstance(_, str) for _ in item['fields'][field])
-
-    # Mark some items to remove.
-    if item['model'] == 'subjects.species':
-        to_remove.append(i)
-    if (item['model'] in ('data.dataformat', 'data.datasettype') and
-            item['fields']['name'] == 'unknown'):
-        to_remove.append(i)
-    if item['model'] == 'subjects.stockmanager':
-        to_remove.append(i)
-
-
-# Remove items that are automatically created by the migrations.
-for i in sorted(to_remove, reverse=True):
-    db.pop(i)
+    return item
 
 
 # Hydrogel and water type
@@ -115,14 +86,6 @@ hydrogel = {
     'pk': 'c68ed3b4-8a3d-47e2-a010-de7b9c027439',
     'fields': {'name': 'Hydrogel', 'json': None}
 }
-db.extend([water, hydrogel])
-
-for item in db:
-    if item['model'] == 'actions.wateradministration':
-        if item['fields'].pop('hydrogel', None):
-            item['fields']['water_type'] = hydrogel['pk']
-        else:
-            item['fields']['water_type'] = water['pk']
 
 
 # sequences: line => allele
@@ -182,45 +145,6 @@ line_to_alleles = {
  '52fa8b8e-8b43-4fbf-af80-223de2874bf6': {'e4f5be9c-1df4-4495-9d44-821fc433016a'},
  '57077617-2a58-4472-b494-cdc7756590c8': {'6854013c-76b4-47be-ace2-3ae7cf6f8946'}}
 
-
-line_to_sequences = {}
-for item in db:
-    if item['model'] == 'subjects.line':
-        line_to_sequences[item['pk']] = item['fields'].pop('sequences', [])
-        item['fields']['alleles'] = list(line_to_alleles.get(item['pk'], []))
-
-
-# Set allele.sequences
-for item in db:
-    if item['model'] == 'subjects.allele':
-        # Search the line.
-        for line, alleles in line_to_alleles.items():
-            if item['pk'] in alleles:
-                item['fields']['sequences'] = line_to_sequences.get(line, [])
-                break
-
-
-# Check the change worked.
-for item in db:
-    for field, value in item['fields'].items():
-        if 'superuser' in field or 'permission' in field:
-            continue
-        if 'user' in field or 'created_by' in field:
-            if isinstance(value, list):
-                assert all(isinstance(_, str) for _ in value)
-            else:
-                assert value is None or isinstance(value, str)
-
-
-# Moved modules.
-for item in db:
-    if item['model'] == 'equipment.lablocation':
-        item['model'] = 'misc.lablocation'
-    item['fields'].pop('weighing_scale', None)
-    item['fields'].pop('brain_location', None)
-    item['fields'].pop('timescale', None)
-
-
 # Renames.
 """
 Species.binomial_name => name
@@ -245,53 +169,93 @@ renames = [
     ('data.datarepository', 'dns', 'hostname'),
 ]
 
-for item in db:
+# Primary keys of the removed objects, automatically created by the migrations. The species
+# are all removed, so the references to them are all removed.
+removed_pks = set()
+# Line => sequences, the lines being dumped before the alleles.
+line_to_sequences = {}
+
+
+def is_removed(item):
+    if item['model'] in ('subjects.species', 'subjects.stockmanager'):
+        return True
+    return (item['model'] in ('data.dataformat', 'data.datasettype') and
+            item['fields']['name'] == 'unknown')
+
+
+def convert(item):
+    fields = item['fields']
+
+    if item['model'] == 'actions.wateradministration':
+        if fields.pop('hydrogel', None):
+            fields['water_type'] = hydrogel['pk']
+        else:
+            fields['water_type'] = water['pk']
+
+    # Set line.alleles and allele.sequences
+    if item['model'] == 'subjects.line':
+        line_to_sequences[item['pk']] = fields.pop('sequences', [])
+        fields['alleles'] = list(line_to_alleles.get(item['pk'], []))
+    if item['model'] == 'subjects.allele':
+        # Search the line.
+        for line, alleles in line_to_alleles.items():
+            if item['pk'] in alleles:
+                fields['sequences'] = line_to_sequences.get(line, [])
+                break
+
+    # Check the change worked.
+    for field, value in fields.items():
+        if 'superuser' in field or 'permission' in field:
+            continue
+        if 'user' in field or 'created_by' in field:
+            if isinstance(value, list):
+                assert all(isinstance(_, str) for _ in value)
+            else:
+                assert value is None or isinstance(value, str)
+
+    # Moved modules.
+    if item['model'] == 'equipment.lablocation':
+        item['model'] = 'misc.lablocation'
+    fields.pop('weighing_scale', None)
+    fields.pop('brain_location', None)
+    fields.pop('timescale', None)
+
     for model, old, new in renames:
-        if item['model'] == model and old in item['fields']:
-            item['fields'][new] = item['fields'].pop(old)
-
-
-# Integrity check: remove non-existing foreign keys.
-pks = set(item['pk'] for item in db)
-UUID_REGEX = r'[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}'
-missing = []
-for item in db:
-    fields_to_remove = []
-    for field, value in item['fields'].items():
-        if field == 'md5' or 'globus' in field:
+        if item['model'] == model and old in fields:
+            fields[new] = fields.pop(old)
+
+    # Integrity check: remove the references to the removed objects.
+    if fields.get('species', None) is not None:
+        fields.pop('species')
+    for field in ('data_format', 'dataset_type'):
+        if fields.get(field, None) in removed_pks:
+            fields.pop(field)
+    return item
+
+
+def iter_converted(items):
+    for item in items:
+        if is_removed(item):
+            removed_pks.add(item['pk'])
             continue
-        # Foreign keys.
-        if isinstance(value, str):
-            if re.match(UUID_REGEX, value):
-                if value not in pks:
-                    assert field in ('species, data_format, dataset_type')
-                    fields_to_remove.append(field)
-                    missing.append((item, field, value))
-        # Many-to-many relationships.
-        if isinstance(value, list):
-            for _ in value:
-                if re.match(UUID_REGEX, str(_)):
-                    if _ not in pks:
-                        assert field in ('species, data_format, dataset_type')
-                        fields_to_remove.append(field)
-                        missing.append((item, field, _))
-    for f in fields_to_remove:
-        item['fields'].pop(f, None)
-    fields_to_remove = []
-missing_pks = set(pk for (item, field, pk) in missing)
-missing_item_field = set((item['model'], field) for (item, field, _) in missing)
-
-
-# Save the database dump.
-with open(out, 'w') as f:
-    json.dump(db, f, indent=1)
-
-
-# Replace lamis_cage by cage
-with open(out, 'r') as f:
-    contents = f.read().replace('lamis_cage', 'cage')
-with open(out, 'w') as f:
-    f.write(contents)
+        yield convert(item)
+    yield water
+    yield hydrogel
+
+
+# Stream the database dump.
+with open_text(path) as f, CompressedWriter(
+        out, compression=compression_from_path(out)) as f_out:
+    # Generate and replace, if needed, the user UUID, then replace the relationships.
+    items = map(convert_user, iter_json_array(f))
+    items = iter_converted(remap_users(items, user_keys, new_key=new_user_key))
+    f_out.write('[\n')
+    for i, item in enumerate(items):
+        if i:
+            f_out.write(',\n')
+        # Replace lamis_cage by cage
+        f_out.write(json.dumps(item, indent=1).replace('lamis_cage', 'cage'))
+    f_out.write('\n]\n')
 
 
 '''